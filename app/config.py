@@ -21,9 +21,23 @@ STATIC_DIR = REPO_DIR / "static"
 DATA_DIR = BASE_DIR / "data"
 
 USERS_FILE = DATA_DIR / "users.json"
-ORDERS_FILE = DATA_DIR / "orders.json"
+ORDERS_FILE = DATA_DIR / "orders.json"          # legacy array (migrated once into the log below)
+ORDERS_LOG_FILE = DATA_DIR / "orders.jsonl"     # append-only order history, one JSON row per line
 DRINKS_FILE = DATA_DIR / "drinks.json"
 
+# =========================
+# STORAGE BACKEND
+# =========================
+# "json"   (default) – one file per collection in app/data (easy to inspect/edit)
+# "sqlite" – single WAL-mode database with indexed tables for queue + history.
+#            Existing JSON data is imported the first time the database is created.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+SQLITE_DB_FILE = Path(os.getenv("SQLITE_DB_FILE", str(DATA_DIR / "smartbartender.db")))
+
+# In-process read cache for users / orders / drinks (parsed once, re-read only
+# when the file changes or this process writes). Set to 0 to always hit storage.
+STORAGE_CACHE = os.getenv("STORAGE_CACHE", "1").strip().lower() not in ("0", "false", "no", "off")
+
 # =========================
 # ESP POLLING (for published / online deployments)
 # =========================
@@ -31,18 +45,58 @@ DRINKS_FILE = DATA_DIR / "drinks.json"
 # Your ESP8266 uses the SAME value in its ESP_KEY.
 ESP_POLL_KEY = os.getenv("ESP_POLL_KEY", "win12345key")
 
+# Longest /api/esp/next?wait=N long-poll the server will hold open (seconds).
+# Keep it below your proxy's idle timeout (Render: 100 s).
+ESP_LONG_POLL_MAX_SEC = int(os.getenv("ESP_LONG_POLL_MAX_SEC", "30"))
+
+# Several dispensers can share one queue: each sends its own ?device=<id> to
+# /api/esp/next and /api/esp/complete (requests without one use ESP_DEFAULT_DEVICE).
+# A device counts as online (for queue ETAs) if it polled within ESP_DEVICE_ONLINE_SEC
+# or is currently pouring.
+ESP_DEFAULT_DEVICE = "default"
+ESP_DEVICE_ONLINE_SEC = int(os.getenv("ESP_DEVICE_ONLINE_SEC", "90"))
+
+# A claimed unit is leased to its device for ESP_LEASE_SEC. The device extends
+# the lease via /api/esp/heartbeat (completing a unit or re-polling also renews it);
+# a background reaper puts units with an expired lease back to Pending.
+ESP_LEASE_SEC = int(os.getenv("ESP_LEASE_SEC", "60"))
+ESP_REAPER_INTERVAL_SEC = int(os.getenv("ESP_REAPER_INTERVAL_SEC", "5"))
+
+# Batch dispatch: /api/esp/next?batch=N hands a device up to N units at once
+# (capped at ESP_MAX_BATCH to fit the ESP8266's payload budget); it pours
+# them back to back and reports them via /api/esp/complete or /api/esp/complete-batch.
+ESP_MAX_BATCH = int(os.getenv("ESP_MAX_BATCH", "4"))
+
 # Where queued orders are stored for the ESP to pick up.
 ESP_QUEUE_FILE = DATA_DIR / "esp_queue.json"
 
-# Completed orders (archive)
-ESP_DONE_FILE = DATA_DIR / "esp_done.json"
+# The queue is held in memory by the server; each change is appended to this
+# journal and folded into ESP_QUEUE_FILE every QUEUE_COMPACT_OPS changes.
+ESP_QUEUE_JOURNAL_FILE = DATA_DIR / "esp_queue.journal.jsonl"
+QUEUE_COMPACT_OPS = int(os.getenv("QUEUE_COMPACT_OPS", "200"))
+# The journal is the source of truth until it is folded in. It is also folded
+# into ESP_QUEUE_FILE on startup and after QUEUE_COMPACT_IDLE_SEC without queue
+# writes, so the file is the whole queue whenever things are quiet. Editing the
+# file by hand drops journal entries not yet folded in (the edit wins).
+QUEUE_COMPACT_IDLE_SEC = int(os.getenv("QUEUE_COMPACT_IDLE_SEC", "5"))
+
+# Queue responses carry a weak ETag built from the queue version, so repeat polls
+# get 304 Not Modified. While a unit is pouring its remaining time counts down,
+# so the tag also rolls over every QUEUE_ETAG_TICK_SEC (how stale an ETA may get).
+QUEUE_ETAG_TICK_SEC = int(os.getenv("QUEUE_ETAG_TICK_SEC", "5"))
+
+# Completed orders (archive): one JSON-lines segment per UTC day, older days
+# gzip-compressed and sealed, plus a manifest for date-range lookups.
+ESP_DONE_DIR = DATA_DIR / "esp_done"
+ESP_DONE_FILE = DATA_DIR / "esp_done.json"  # legacy array (split into segments once)
 
 # =========================
 # ETA MODEL (Capstone)
 # =========================
 # Simple, explainable estimation model:
 #   order_seconds = ETA_ORDER_OVERHEAD_SEC + total_qty * ETA_SECONDS_PER_DRINK
-# Tune these values to match your physical pump timing.
+# Tune these values to match your physical pump timing (they are the fallback
+# for drinks the learned model below hasn't seen enough of yet).
 
 ETA_ORDER_OVERHEAD_SEC = int(os.getenv("ETA_ORDER_OVERHEAD_SEC", "8"))
 ETA_SECONDS_PER_DRINK = int(os.getenv("ETA_SECONDS_PER_DRINK", "25"))
@@ -50,3 +104,68 @@ ETA_SECONDS_PER_DRINK = int(os.getenv("ETA_SECONDS_PER_DRINK", "25"))
 
 # Prep time between drinks/orders for the machine to reset
 ESP_PREP_SECONDS = int(os.getenv('ESP_PREP_SECONDS', '10'))
+
+# Same-recipe runs (batching scheduler below) skip most of the changeover:
+# a unit poured right after one of the same drink pays these instead.
+ETA_BATCH_OVERHEAD_SEC = int(os.getenv("ETA_BATCH_OVERHEAD_SEC", "2"))
+ESP_BATCH_PREP_SECONDS = int(os.getenv("ESP_BATCH_PREP_SECONDS", "3"))
+
+# Learned ETAs: every completed unit's measured start -> complete time updates an
+# exponentially weighted mean for its drinkId (weight ETA_MODEL_ALPHA). Once a
+# drink has ETA_MODEL_MIN_SAMPLES it replaces the constants above for that drink.
+# Samples over ETA_MODEL_MAX_SEC (stalls, forgotten completes) are ignored. On
+# startup the model is refit from the last ETA_MODEL_HISTORY_DAYS of the archive.
+ETA_LEARNING = os.getenv("ETA_LEARNING", "1").strip().lower() not in ("0", "false", "no", "off")
+ETA_MODEL_ALPHA = float(os.getenv("ETA_MODEL_ALPHA", "0.2"))
+ETA_MODEL_MIN_SAMPLES = int(os.getenv("ETA_MODEL_MIN_SAMPLES", "3"))
+ETA_MODEL_MAX_SEC = int(os.getenv("ETA_MODEL_MAX_SEC", "300"))
+ETA_MODEL_HISTORY_DAYS = int(os.getenv("ETA_MODEL_HISTORY_DAYS", "14"))
+
+# =========================
+# QUEUE SCHEDULING
+# =========================
+# Order in which Pending units are handed to the dispensers:
+#   "fifo"  (default) – strict arrival order
+#   "batch" – run units of the same recipe (else the same ingredient set) back to
+#             back, looking at most QUEUE_BATCH_WINDOW pending units ahead; a unit
+#             is passed over at most QUEUE_BATCH_WINDOW times.
+#   "fair"  – round-robin between customers (by username), so one big order
+#             can't hold up everyone behind it. QUEUE_FAIR_WEIGHTS="alice:2,bob:0.5"
+#             gives some users a larger/smaller share (weighted-fair).
+QUEUE_POLICY = os.getenv("QUEUE_POLICY", "fifo").strip().lower()
+QUEUE_BATCH_WINDOW = int(os.getenv("QUEUE_BATCH_WINDOW", "6"))
+QUEUE_FAIR_WEIGHTS = os.getenv("QUEUE_FAIR_WEIGHTS", "")
+
+# "fair" only: at most this many of one user's units pouring at once across all
+# dispensers (0 = no cap). Another device takes someone else's unit instead.
+QUEUE_USER_MAX_INFLIGHT = int(os.getenv("QUEUE_USER_MAX_INFLIGHT", "0"))
+
+# =========================
+# RECOMMENDER
+# =========================
+# With NumPy installed (optional, not in requirements.txt) the similar-user search
+# packs the user x drink matrix into a dense array and scores every user with one
+# matrix-vector product. Set to 0 to force the pure-Python search (same results).
+RECOMMENDER_NUMPY = os.getenv("RECOMMENDER_NUMPY", "1").strip().lower() not in ("0", "false", "no", "off")
+
+# With this many accounts or more, similar users come from an approximate
+# random-projection LSH index (app/ml/ann.py) instead of an exact scan over all
+# users; 0 = always exact. More tables = better recall, more bits = fewer
+# candidates per query; app.ml.ann.benchmark() reports recall vs latency.
+RECOMMENDER_ANN_MIN_USERS = int(os.getenv("RECOMMENDER_ANN_MIN_USERS", "20000"))
+RECOMMENDER_ANN_TABLES = int(os.getenv("RECOMMENDER_ANN_TABLES", "16"))
+RECOMMENDER_ANN_BITS = int(os.getenv("RECOMMENDER_ANN_BITS", "12"))
+
+# Collaborative filtering used by recommend_for_user():
+#   "user" (default) – user-user: drinks liked by the 25 most similar users
+#   "item"           – item-item (opt-in): drinks most often ordered by the same
+#                      users as the ones you order (RECOMMENDER_ITEM_NEIGHBOURS per drink)
+RECOMMENDER_CF = os.getenv("RECOMMENDER_CF", "user").strip().lower()
+RECOMMENDER_ITEM_NEIGHBOURS = int(os.getenv("RECOMMENDER_ITEM_NEIGHBOURS", "20"))
+
+# Recommendation results are cached per (user, mood, k) in a bounded LRU
+# (RECOMMEND_CACHE_SIZE entries, 0 = off). An entry is recomputed as soon as that
+# user checks out or the drink catalog changes; other customers' orders (which
+# shift popularity and similar users a little) show up within RECOMMEND_CACHE_TTL_SEC.
+RECOMMEND_CACHE_SIZE = int(os.getenv("RECOMMEND_CACHE_SIZE", "1024"))
+RECOMMEND_CACHE_TTL_SEC = int(os.getenv("RECOMMEND_CACHE_TTL_SEC", "300"))
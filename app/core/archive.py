@@ -0,0 +1,224 @@
+"""Segmented archive of completed ESP orders (JSON backend).
+
+Completed entries are appended to one JSON-lines segment per UTC day in
+app/data/esp_done/. Once a day is over its segment is sealed: gzip-compressed
+and never written again. manifest.json records each segment's time span and
+row count, so a date-range query only opens the segments it overlaps.
+
+The legacy esp_done.json array is split into segments once, the first time
+the archive is used, and left in place as a backup.
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import threading
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+from app.core.storage import _read_json, _utc_now, _write_json
+
+# Bucket for entries with no usable timestamp (only returned by unbounded queries)
+UNDATED = "undated"
+
+
+def _as_utc(value) -> datetime | None:
+    """datetime / date / ISO string -> tz-aware UTC datetime (None if unusable)."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, date):
+        dt = datetime(value.year, value.month, value.day)
+    else:
+        try:
+            dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except Exception:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def entry_time(o: dict) -> datetime | None:
+    """When an archived entry was completed (falls back to start/order time for old rows)."""
+    for key in ("completedAt", "startedAt", "ts"):
+        dt = _as_utc(o.get(key))
+        if dt is not None:
+            return dt
+    return None
+
+
+class DoneArchive:
+    def __init__(self, directory: Path, legacy_file: Path | None = None):
+        self.dir = Path(directory)
+        self.manifest_file = self.dir / "manifest.json"
+        self.legacy_file = legacy_file
+        self.lock = threading.RLock()
+        self._manifest: dict | None = None
+
+    # -------------------------
+    # Manifest
+    # -------------------------
+
+    def _load_manifest(self) -> dict:
+        if self._manifest is None:
+            data = _read_json(self.manifest_file, default=None)
+            if isinstance(data, dict) and isinstance(data.get("segments"), dict):
+                self._manifest = data
+            else:
+                self._manifest = {"segments": {}}
+                self._migrate_legacy()
+        return self._manifest
+
+    def _save_manifest(self):
+        _write_json(self.manifest_file, self._manifest)
+
+    def _migrate_legacy(self):
+        """One-shot: split the old esp_done.json array into day segments."""
+        if self.legacy_file is None:
+            return
+        data = _read_json(self.legacy_file, default=[])
+        if isinstance(data, list) and data:
+            self._append_rows([o for o in data if isinstance(o, dict)])
+        self._save_manifest()
+        self._seal_before(_utc_now().date().isoformat())
+
+    # -------------------------
+    # Segments
+    # -------------------------
+
+    def _path(self, seg: dict) -> Path:
+        return self.dir / seg["file"]
+
+    def _open_segment(self, seg: dict):
+        """Text handle on a segment (None if its file is gone). Call with
+        `lock` held: once open it survives the file being sealed or deleted."""
+        opener = gzip.open if seg.get("sealed") else open
+        try:
+            return opener(self._path(seg), "rt", encoding="utf-8")
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_rows(f) -> Iterator[dict]:
+        with f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except Exception:
+                    continue  # torn last line
+                if isinstance(row, dict):
+                    yield row
+
+    def _seal_before(self, today: str):
+        """Compress every open segment older than `today` (YYYY-MM-DD)."""
+        for day, seg in sorted(self._manifest["segments"].items()):
+            if seg.get("sealed") or day == UNDATED or day >= today:
+                continue
+            src = self._path(seg)
+            gz_name = seg["file"] + ".gz"
+            tmp = self.dir / (gz_name + ".tmp")
+            with gzip.open(tmp, "wt", encoding="utf-8") as out:
+                if src.exists():
+                    out.write(src.read_text(encoding="utf-8"))
+            os.replace(tmp, self.dir / gz_name)
+            seg["file"] = gz_name
+            seg["sealed"] = True
+            self._save_manifest()
+            src.unlink(missing_ok=True)
+
+    def _append_rows(self, rows: Iterable[dict]):
+        by_day: dict = {}
+        for o in rows:
+            dt = entry_time(o)
+            by_day.setdefault(dt.date().isoformat() if dt else UNDATED, []).append((dt, o))
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        segments = self._manifest["segments"]
+        for day, items in by_day.items():
+            # A late row for an already sealed day (clock skew, replace()) goes
+            # to a numbered side segment; sealed files are never reopened.
+            key, n = day, 0
+            while segments.get(key, {}).get("sealed"):
+                n += 1
+                key = f"{day}+{n}"
+            seg = segments.get(key)
+            if seg is None:
+                name = f"{day}.{n}.jsonl" if n else f"{day}.jsonl"
+                seg = segments[key] = {"file": name, "count": 0, "first": None, "last": None, "sealed": False}
+            with open(self._path(seg), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(o, separators=(",", ":")) + "\n" for _, o in items))
+            seg["count"] += len(items)
+            for dt, _ in items:
+                if dt is None:
+                    continue
+                iso = dt.isoformat()
+                if seg["first"] is None or iso < seg["first"]:
+                    seg["first"] = iso
+                if seg["last"] is None or iso > seg["last"]:
+                    seg["last"] = iso
+
+    # -------------------------
+    # Public
+    # -------------------------
+
+    def append(self, rows: List[dict]):
+        """Append completed entries to their day segments (sealing finished days)."""
+        rows = [o for o in rows if isinstance(o, dict)]
+        with self.lock:
+            self._load_manifest()
+            self._append_rows(rows)
+            self._save_manifest()
+            self._seal_before(_utc_now().date().isoformat())
+
+    def iter_range(self, start=None, end=None) -> Iterator[dict]:
+        """Entries completed in [start, end) (either bound optional), oldest segment first.
+
+        Only segments whose manifest span overlaps the range are opened.
+        """
+        lo, hi = _as_utc(start), _as_utc(end)
+        # Pick the segments and open them under the lock, so sealing (which
+        # swaps a day's .jsonl for a .gz and deletes it) can't pull one away
+        # mid-query; the rows are read after releasing it.
+        with self.lock:
+            files = []
+            for _, seg in sorted(self._load_manifest()["segments"].items()):
+                if lo is not None or hi is not None:
+                    first, last = _as_utc(seg.get("first")), _as_utc(seg.get("last"))
+                    if first is None or last is None:
+                        continue  # undated rows can't match a bounded query
+                    if (lo is not None and last < lo) or (hi is not None and first >= hi):
+                        continue
+                f = self._open_segment(seg)
+                if f is not None:
+                    files.append(f)
+
+        try:
+            for f in files:
+                for o in self._read_rows(f):
+                    if lo is not None or hi is not None:
+                        dt = entry_time(o)
+                        if dt is None or (lo is not None and dt < lo) or (hi is not None and dt >= hi):
+                            continue
+                    yield o
+        finally:
+            for f in files:
+                f.close()
+
+    def replace(self, rows: List[dict]):
+        """Rewrite the whole archive (rare; used by save_esp_done)."""
+        with self.lock:
+            manifest = self._load_manifest()
+            for seg in manifest["segments"].values():
+                self._path(seg).unlink(missing_ok=True)
+            manifest["segments"] = {}
+            self._append_rows([o for o in rows if isinstance(o, dict)])
+            self._save_manifest()
+            self._seal_before(_utc_now().date().isoformat())
+
+    def manifest(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps(self._load_manifest()))
@@ -0,0 +1,99 @@
+"""Learned per-drink unit durations for queue ETAs.
+
+Each completed unit records when it was claimed, started and completed
+(entry["unitTimes"], archived with the entry). The measured start -> complete
+time goes into an exponentially weighted mean per drinkId; until a drink has
+ETA_MODEL_MIN_SAMPLES, estimate_order_seconds() keeps using the constants
+(ETA_ORDER_OVERHEAD_SEC + qty * ETA_SECONDS_PER_DRINK) for it.
+
+The model lives in memory: fitted once from the recent archive on first use,
+then updated by every completion (QueueEngine._complete_one).
+"""
+from __future__ import annotations
+
+import threading
+from datetime import timedelta
+from typing import Dict, Iterable
+
+from app.config import (
+    ETA_LEARNING,
+    ETA_MODEL_ALPHA,
+    ETA_MODEL_HISTORY_DAYS,
+    ETA_MODEL_MAX_SEC,
+    ETA_MODEL_MIN_SAMPLES,
+)
+
+
+def unit_seconds_of(record: dict) -> float | None:
+    """Measured seconds of one unitTimes record (None if incomplete)."""
+    from app.core.archive import _as_utc
+
+    started, completed = _as_utc(record.get("startedAt")), _as_utc(record.get("completedAt"))
+    if started is None or completed is None:
+        return None
+    return (completed - started).total_seconds()
+
+
+class EtaModel:
+    def __init__(self, alpha: float = ETA_MODEL_ALPHA, min_samples: int = ETA_MODEL_MIN_SAMPLES, max_seconds: float = ETA_MODEL_MAX_SEC):
+        self.alpha = min(1.0, max(0.0, float(alpha)))
+        self.min_samples = max(1, int(min_samples))
+        self.max_seconds = float(max_seconds)
+        self.lock = threading.Lock()
+        self._stats: Dict[str, list] = {}  # drinkId -> [mean seconds, samples]
+
+    def observe(self, drink_id, seconds: float | None) -> bool:
+        """Fold in one measured unit time. True if the drink's estimate
+        (in whole seconds) changed, i.e. queued ETAs should be refreshed."""
+        if not drink_id or seconds is None or not (0 < seconds <= self.max_seconds):
+            return False
+        key = str(drink_id)
+        with self.lock:
+            before = self.unit_seconds(key)
+            st = self._stats.setdefault(key, [0.0, 0])
+            st[1] += 1
+            # Plain running mean for the first 1/alpha samples, EWMA after that
+            st[0] += max(self.alpha, 1.0 / st[1]) * (seconds - st[0])
+            after = self.unit_seconds(key)
+        return (None if before is None else round(before)) != (None if after is None else round(after))
+
+    def fit(self, rows: Iterable[dict]):
+        """Replay archived entries (oldest first)."""
+        for row in rows:
+            for rec in row.get("unitTimes") or ():
+                if isinstance(rec, dict):
+                    self.observe(rec.get("drinkId"), unit_seconds_of(rec))
+
+    def unit_seconds(self, drink_id) -> float | None:
+        """Learned seconds per unit of this drink, or None (not enough samples yet)."""
+        st = self._stats.get(str(drink_id))
+        if st is None or st[1] < self.min_samples:
+            return None
+        return st[0]
+
+    def stats(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                did: {"seconds": round(mean, 1), "samples": n, "active": n >= self.min_samples}
+                for did, (mean, n) in self._stats.items()
+            }
+
+
+_MODEL: EtaModel | None = None
+_MODEL_LOCK = threading.Lock()
+
+
+def get_eta_model() -> EtaModel | None:
+    """The process-wide model (fitted from the archive on first use); None if ETA_LEARNING is off."""
+    global _MODEL
+    if not ETA_LEARNING:
+        return None
+    if _MODEL is None:
+        with _MODEL_LOCK:
+            if _MODEL is None:
+                from app.core.storage import _utc_now, iter_esp_done
+
+                model = EtaModel()
+                model.fit(iter_esp_done(start=_utc_now() - timedelta(days=ETA_MODEL_HISTORY_DAYS)))
+                _MODEL = model
+    return _MODEL
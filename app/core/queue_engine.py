@@ -0,0 +1,892 @@
+"""In-memory ESP queue engine.
+
+The queue is owned in memory by one QueueEngine per process and persisted
+through the storage backend's queue journal (JSON: an append-only journal
+file folded into esp_queue.json every QUEUE_COMPACT_OPS changes; SQLite:
+row-level upserts/deletes in one transaction).
+
+With the JSON backend the live queue is esp_queue.json plus the journal:
+the journal is the source of truth for everything since the last
+compaction. The snapshot is compacted on startup and whenever the journal
+has been idle for QUEUE_COMPACT_IDLE_SEC, so at rest esp_queue.json is the
+whole queue. A hand edit of the file is merged against the snapshot it was
+made from: entries the edit changed, added or removed take the edit's
+version (a journaled change it overrides is logged), all others keep their
+live state, so nothing journaled since the last compaction is lost.
+
+Indexes kept alongside the entries:
+  - id -> slot                    (lookup / complete: O(1))
+  - min-heap of Pending slots     (claim oldest: O(log n), lazy deletion)
+  - Fenwick trees over slots      (position + seconds ahead: O(log n))
+
+Slots are assigned in enqueue order, so slot order == queue order.
+In Progress entries count towards positions but their remaining time
+shrinks while they run, so their seconds are added at query time instead
+of being stored in the tree (one per machine, or a few in batch mode).
+
+Several dispensers may share the queue. A claimed entry records the
+claiming device in its "device" field; each device gets its own In Progress
+slot and the next Pending unit. Devices seen recently (or pouring) are
+"online" and ETAs split the backlog between them.
+
+A device may also take a batch of units at once (active_units(limit=N)).
+It pours them back to back, so each held unit after the first gets a
+planned startedAt: the previous unit's start + its duration + prep. These
+start times are re-planned whenever one of the device's units completes.
+
+Which Pending unit goes next is up to the scheduling policy (scheduler.py).
+For FIFO the Fenwick trees answer positions directly; other policies walk
+their dispatch order once per queue change into a cached plan
+({id: (ahead, seconds ahead, planned duration)}) that queries read.
+
+Claims are leases: a claimed entry carries "leaseUntil", renewed by the
+device's heartbeats, polls and completions. requeue_expired() returns units
+whose device went quiet to Pending (in their original place in line) and
+notes the event in the entry's "requeues" list, which is archived with it.
+A renewal only moves a deadline, so it stays in memory (no journal line, no
+version bump); on load every In Progress unit gets a fresh lease instead.
+
+Every queue change (enqueue, claim, complete, requeue) bumps
+QueueSignal.version and wakes async waiters (long-poll ESP requests, SSE
+streams), so nobody has to poll the queue to notice new work.
+
+Assumes a single server process (e.g. one uvicorn worker).
+"""
+from __future__ import annotations
+
+import asyncio
+import copy
+import heapq
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Iterable, List
+
+from app.config import ESP_DEFAULT_DEVICE, ESP_DEVICE_ONLINE_SEC, ESP_LEASE_SEC, ESP_PREP_SECONDS, QUEUE_COMPACT_IDLE_SEC, QUEUE_COMPACT_OPS
+from app.core.archive import _as_utc
+from app.core.eta_model import get_eta_model, unit_seconds_of
+from app.core.scheduler import get_policy
+from app.core.storage import (
+    _ahead_cost,
+    _consume_one_unit,
+    _prep_seconds,
+    _recipe_key,
+    _queue_info,
+    _utc_now,
+    _utc_now_iso,
+    estimate_order_seconds,
+)
+
+ACTIVE = ("Pending", "In Progress")
+
+log = logging.getLogger(__name__)
+
+
+def _dump(o: dict | None) -> str:
+    """Canonical JSON of an entry, to tell whether it changed."""
+    return json.dumps(o, sort_keys=True, separators=(",", ":"))
+
+
+class _Fenwick:
+    """Prefix sums over a fixed number of slots (binary indexed tree)."""
+
+    def __init__(self, values: List[int]):
+        n = len(values)
+        tree = [0] * (n + 1)
+        for i, v in enumerate(values, start=1):
+            tree[i] += v
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.n = n
+        self.tree = tree
+
+    def add(self, i: int, delta: int):
+        i += 1
+        tree, n = self.tree, self.n
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i: int) -> int:
+        """Sum of slots [0, i)."""
+        s = 0
+        tree = self.tree
+        while i > 0:
+            s += tree[i]
+            i -= i & -i
+        return s
+
+
+class QueueSignal:
+    """Change counter + wake-up for coroutines waiting on the queue.
+
+    notify() is called from worker threads (sync endpoints), so waiters are
+    woken through their own event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._waiters: set = set()  # (loop, asyncio.Event)
+
+    def notify(self):
+        with self._lock:
+            self.version += 1
+            waiters, self._waiters = self._waiters, set()
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # loop already closed
+
+    async def wait(self, since: int, timeout: float) -> int:
+        """Wait until version != since (or timeout); returns the current version."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self._lock:
+            if self.version != since:
+                return self.version
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+        return self.version
+
+
+class QueueEngine:
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.RLock()
+        self.signal = QueueSignal()
+        self._seen: Dict[str, float] = {}  # device -> monotonic time of its last request
+        self.policy = get_policy()
+        self._last_claim: Dict[str, dict] = {}  # device -> unit it claimed last (policy's "prev")
+        self._last_any: dict | None = None
+        self._plan_cache: tuple | None = None  # ((signal version, devices), {id: (ahead, ahead_cost, est)}, [units])
+        self._last_write = time.monotonic()
+        self._written: Dict[str, str] = {}  # id -> _dump() of the entry in the last snapshot we wrote
+        self._load()
+
+    # -------------------------
+    # Loading / indexing
+    # -------------------------
+
+    def _load(self, edited: bool = False):
+        if edited:
+            entries = self._merge_edit(self.backend.load_queue_snapshot())
+        else:
+            entries, _ = self.backend.load_queue_state()
+        self._rebuild(entries)
+        # Renewals aren't persisted: give every device a full lease to come back
+        for o in self._in_progress.values():
+            self._renew_lease(o)
+        # Start from a snapshot that is the whole queue (and exists)
+        self._compact()
+
+    def _rebuild(self, entries: Iterable[dict], capacity: int = 0):
+        self._by_slot: Dict[int, dict] = {}  # insertion order == slot order
+        self._slot_of: Dict[str, int] = {}
+        for o in entries:
+            if not isinstance(o, dict):
+                continue
+            oid = str(o.get("id"))
+            if oid in self._slot_of:
+                continue  # ids are uuid4; a duplicate can only come from a hand edit
+            self._slot_of[oid] = len(self._by_slot)
+            self._by_slot[len(self._by_slot)] = o
+
+        self._next_slot = len(self._by_slot)
+        size = max(64, capacity, 2 * self._next_slot)
+        self._cnt = [0] * size
+        self._cost = [0] * size
+        self._pending: List[int] = []
+        self._in_progress: Dict[int, dict] = {}
+        for slot, o in self._by_slot.items():
+            self._classify(slot, o)
+        self._cnt_tree = _Fenwick(self._cnt)
+        self._cost_tree = _Fenwick(self._cost)
+        heapq.heapify(self._pending)
+
+    def _classify(self, slot: int, o: dict):
+        """Set per-slot weights/sets for `o` without touching the trees (rebuild only)."""
+        status = o.get("status")
+        self._cnt[slot] = 1 if status in ACTIVE else 0
+        self._cost[slot] = _ahead_cost(o) if status == "Pending" else 0
+        if status == "Pending":
+            self._pending.append(slot)
+        elif status == "In Progress":
+            self._in_progress[slot] = o
+
+    def _reindex(self, slot: int):
+        """Refresh indexes after the entry in `slot` changed status/items (or was removed)."""
+        o = self._by_slot.get(slot)
+        status = o.get("status") if o is not None else None
+        cnt = 1 if status in ACTIVE else 0
+        cost = _ahead_cost(o) if status == "Pending" else 0
+        if cnt != self._cnt[slot]:
+            self._cnt_tree.add(slot, cnt - self._cnt[slot])
+            self._cnt[slot] = cnt
+        if cost != self._cost[slot]:
+            self._cost_tree.add(slot, cost - self._cost[slot])
+            self._cost[slot] = cost
+        if status == "In Progress":
+            self._in_progress[slot] = o
+        else:
+            self._in_progress.pop(slot, None)
+        if status == "Pending" and self.policy.fifo:
+            heapq.heappush(self._pending, slot)  # stale duplicates are skipped on pop
+
+    def _new_slot(self) -> int:
+        if self._next_slot >= len(self._cnt):
+            live = len(self._by_slot)
+            # Mostly dead slots => renumber; otherwise grow. Either way O(n), amortized.
+            self._rebuild(list(self._by_slot.values()), capacity=4 * live if live * 2 >= len(self._cnt) else 0)
+        slot = self._next_slot
+        self._next_slot += 1
+        return slot
+
+    def _merge_edit(self, edited: List[dict]) -> List[dict]:
+        """The live queue with a hand edit of the snapshot applied (see the
+        module docstring). `self._written` is that snapshot as we wrote it."""
+        live = {oid: self._by_slot[slot] for oid, slot in self._slot_of.items()}
+        out: List[dict] = []
+        seen = set()
+        for o in edited:
+            if not isinstance(o, dict) or str(o.get("id")) in seen:
+                continue
+            oid = str(o.get("id"))
+            seen.add(oid)
+            if _dump(o) == self._written.get(oid):
+                # Untouched by the edit: keep the live entry (or its completion)
+                if oid in live:
+                    out.append(live[oid])
+                continue
+            if oid in self._written and _dump(live.get(oid)) != self._written[oid]:
+                log.warning("hand edit of queue entry %s overrides a change made since the last compaction", oid)
+            out.append(o)
+        for oid in self._written.keys() - seen:
+            if oid in live and _dump(live[oid]) != self._written[oid]:
+                log.warning("hand edit removed queue entry %s, which changed since the last compaction", oid)
+        # Enqueued since the last compaction: the edit couldn't have seen them
+        out.extend(o for oid, o in live.items() if oid not in self._written and oid not in seen)
+        return out
+
+    def _check_external_edit(self):
+        """Pick up a hand-edited queue file (JSON backend) by reloading from storage."""
+        stamp = self.backend.stamp("esp_queue")
+        if stamp != self._stamp:
+            self._load(edited=True)
+            self.signal.notify()
+
+    # -------------------------
+    # Persistence
+    # -------------------------
+
+    def _persist(self, ops: List[tuple]):
+        if not ops:
+            return
+        self.backend.journal_queue(ops)
+        self._ops_since_compact += len(ops)
+        self._last_write = time.monotonic()
+        if self._ops_since_compact >= QUEUE_COMPACT_OPS:
+            self._compact()
+        self.signal.notify()
+
+    def _compact(self):
+        entries = list(self._by_slot.values())
+        self.backend.compact_queue(entries)
+        self._written = {str(o.get("id")): _dump(o) for o in entries}
+        self._stamp = self.backend.stamp("esp_queue")
+        self._ops_since_compact = 0
+
+    def compact_if_idle(self, idle_seconds: float = QUEUE_COMPACT_IDLE_SEC) -> bool:
+        """Fold the journal into the snapshot once nothing was written for
+        `idle_seconds`, so esp_queue.json is current while the queue is quiet."""
+        with self.lock:
+            self._check_external_edit()
+            if not self._ops_since_compact or time.monotonic() - self._last_write < idle_seconds:
+                return False
+            self._compact()
+            return True
+
+    # -------------------------
+    # Devices
+    # -------------------------
+
+    def touch_device(self, device: str):
+        with self.lock:
+            self._seen[str(device)] = time.monotonic()
+
+    def keep_alive(self, device: str):
+        """touch_device() plus a lease renewal on every unit `device` holds
+        (a poll answered 304 never reaches dispatch())."""
+        device = str(device)
+        with self.lock:
+            self._check_external_edit()
+            self.touch_device(device)
+            for slot in self._device_units(device):
+                self._renew_lease(self._in_progress[slot])
+
+    def online_devices(self) -> List[str]:
+        """Devices that polled within ESP_DEVICE_ONLINE_SEC or are pouring right now."""
+        with self.lock:
+            cutoff = time.monotonic() - ESP_DEVICE_ONLINE_SEC
+            online = {d for d, t in self._seen.items() if t >= cutoff}
+            online.update(str(o.get("device") or ESP_DEFAULT_DEVICE) for o in self._in_progress.values())
+            return sorted(online)
+
+    def _device_count(self) -> int:
+        return max(1, len(self.online_devices()))
+
+    @staticmethod
+    def _renew_lease(o: dict):
+        o["leaseUntil"] = (_utc_now() + timedelta(seconds=ESP_LEASE_SEC)).isoformat()
+
+    def _device_slot(self, device: str) -> int | None:
+        """This device's In Progress slot (an unowned one is adopted, e.g. from before devices existed)."""
+        unowned = None
+        for slot in sorted(self._in_progress):
+            owner = self._in_progress[slot].get("device")
+            if owner == device:
+                return slot
+            if owner is None and unowned is None:
+                unowned = slot
+        return unowned
+
+    def _device_units(self, device: str) -> List[int]:
+        """Slots of the units `device` holds, in the order it claimed (and pours) them."""
+        slots = [s for s, o in self._in_progress.items() if o.get("device") == device]
+        return sorted(slots, key=lambda s: (str(self._in_progress[s].get("claimedAt") or self._in_progress[s].get("startedAt") or ""), s))
+
+    def _stagger(self, slots: List[int], first_start=None):
+        """Plan back-to-back start times for a device's held units.
+
+        The first unit keeps its startedAt (unless `first_start` is given, e.g.
+        after the unit before it completed); each later one starts when the one
+        before it is planned to finish plus prep, but never in the past.
+        """
+        now = _utc_now()
+        t = None
+        for slot in slots:
+            o = self._in_progress[slot]
+            if t is None:
+                started = first_start if first_start is not None else (_as_utc(o.get("startedAt")) or now)
+            else:
+                started = max(t, now)
+            o["startedAt"] = started.isoformat()
+            o.setdefault("estSeconds", estimate_order_seconds(o))
+            t = started + timedelta(seconds=int(o["estSeconds"]) + int(o.get("prepSeconds", ESP_PREP_SECONDS)))
+
+    # -------------------------
+    # Scheduling plan (non-FIFO policies)
+    # -------------------------
+
+    def _pending_units(self) -> Iterable[dict]:
+        """Pending entries in arrival order (lazy, so a claim only walks the front)."""
+        return (o for o in self._by_slot.values() if o.get("status") == "Pending")
+
+    def _plan(self) -> tuple:
+        """({id: (pending ahead, seconds ahead, planned duration)}, [units in dispatch order]).
+
+        Rebuilt only when the queue (or, for a capped policy, the number of
+        devices) changed since the last call.
+        """
+        version = (self.signal.version, self._device_count() if self.policy.capped else 1)
+        if self._plan_cache is not None and self._plan_cache[0] == version:
+            return self._plan_cache[1], self._plan_cache[2]
+        chained = self.policy.chained
+        prev = self._last_any
+        seq = [o for o, _ in self.policy.order(self._pending_units(), prev, self._in_progress.values())]
+        if self.policy.capped:
+            seq = self._capped_order(seq, version[1])
+        plan: Dict[str, tuple] = {}
+        ahead_cost = 0
+        for i, o in enumerate(seq):
+            est = estimate_order_seconds(o, prev) if chained else int(o.get("estSeconds") or estimate_order_seconds(o))
+            plan[str(o.get("id"))] = (i, ahead_cost, est)
+            nxt = seq[i + 1] if chained and i + 1 < len(seq) else None
+            ahead_cost += est + _prep_seconds(o, nxt)
+            prev = o
+        self._plan_cache = (version, plan, seq)
+        return plan, seq
+
+    def _capped_order(self, seq: List[dict], devices: int) -> List[dict]:
+        """`seq` as successive _claim() calls would dispatch it under the
+        policy's per-user cap: each claim takes the first eligible unit while
+        the ones claimed just before it still pour (one per other device;
+        the oldest finishes first). If none is eligible the first one waits
+        for a unit to finish and goes next."""
+        others = max(0, devices - 1)
+        poured = [self._in_progress[s] for s in sorted(self._in_progress)]
+        waiting: List[dict] = list(seq)
+        out: List[dict] = []
+        while waiting:
+            running = poured[len(poured) - others:] if others else []
+            i = next((i for i, o in enumerate(waiting) if self.policy.eligible(o, running)), 0)
+            o = waiting.pop(i)
+            out.append(o)
+            poured.append(o)
+        return out
+
+    def _planned_info(self, slot: int, devices: int) -> dict:
+        o = self._by_slot[slot]
+        if o.get("status") == "In Progress":
+            return _queue_info(sum(1 for s in self._in_progress if s < slot), 0, o, devices)
+        i, ahead_cost, est = self._plan()[0][str(o.get("id"))]
+        running = sum(_ahead_cost(r) for r in self._in_progress.values())
+        return _queue_info(len(self._in_progress) + i, running + ahead_cost, o, devices, est=est)
+
+    # -------------------------
+    # Queries
+    # -------------------------
+
+    def _info(self, slot: int, devices: int = 1) -> dict:
+        if not self.policy.fifo:
+            return self._planned_info(slot, devices)
+        o = self._by_slot[slot]
+        ahead = self._cnt_tree.prefix(slot)
+        ahead_remaining = self._cost_tree.prefix(slot)
+        for s, running in self._in_progress.items():
+            if s < slot:
+                ahead_remaining += _ahead_cost(running)
+        return _queue_info(ahead, ahead_remaining, o, devices)
+
+    def version_state(self) -> tuple:
+        """(queue version, whether anything is pouring) -- what an ETag needs, without computing positions."""
+        with self.lock:
+            self._check_external_edit()
+            return self.signal.version, bool(self._in_progress)
+
+    def get(self, order_id: str) -> dict | None:
+        with self.lock:
+            self._check_external_edit()
+            slot = self._slot_of.get(str(order_id))
+            return copy.deepcopy(self._by_slot[slot]) if slot is not None else None
+
+    def entries(self) -> List[dict]:
+        with self.lock:
+            self._check_external_edit()
+            return copy.deepcopy(list(self._by_slot.values()))
+
+    def position(self, order_id: str) -> dict | None:
+        with self.lock:
+            self._check_external_edit()
+            slot = self._slot_of.get(str(order_id))
+            if slot is None or self._by_slot[slot].get("status") not in ACTIVE:
+                return None
+            return self._info(slot, self._device_count())
+
+    def positions(self, order_ids: Iterable[str]) -> Dict[str, dict]:
+        out: Dict[str, dict] = {}
+        with self.lock:
+            for oid in order_ids:
+                info = self.position(oid)
+                if info is not None:
+                    out[str(oid)] = info
+        return out
+
+    def snapshot(self) -> List[tuple]:
+        """[(entry copy, info)] for every active entry, in queue order. O(n)."""
+        with self.lock:
+            self._check_external_edit()
+            devices = self._device_count()
+            out: List[tuple] = []
+            if not self.policy.fifo:
+                # Pouring units first, then Pending ones in dispatch order
+                running = 0
+                for slot in sorted(self._in_progress):
+                    o = self._in_progress[slot]
+                    out.append((copy.deepcopy(o), _queue_info(len(out), 0, o, devices)))
+                    running += _ahead_cost(o)
+                plan, seq = self._plan()
+                for o in seq:
+                    i, ahead_cost, est = plan[str(o.get("id"))]
+                    out.append((copy.deepcopy(o), _queue_info(len(out), running + ahead_cost, o, devices, est=est)))
+                return out
+            ahead_remaining = 0
+            for o in self._by_slot.values():
+                if o.get("status") not in ACTIVE:
+                    continue
+                out.append((copy.deepcopy(o), _queue_info(len(out), ahead_remaining, o, devices)))
+                ahead_remaining += _ahead_cost(o)
+            return out
+
+    # -------------------------
+    # Mutations
+    # -------------------------
+
+    def replace(self, entries: List[dict]):
+        with self.lock:
+            self._rebuild(copy.deepcopy([o for o in entries if isinstance(o, dict)]))
+            self.backend.save_esp_queue(list(self._by_slot.values()))
+            self._stamp = self.backend.stamp("esp_queue")
+            self._ops_since_compact = 0
+            self.signal.notify()
+
+    def enqueue(self, orders: List[dict]) -> List[dict | None]:
+        with self.lock:
+            self._check_external_edit()
+            added: List[dict] = []
+            seen = set(self._slot_of)
+            for o in orders:
+                oid = str(o.get("id"))
+                if oid not in seen:
+                    seen.add(oid)
+                    added.append(copy.deepcopy(o))
+            self.policy.on_enqueue(added, self._by_slot.values())
+            for o in added:
+                slot = self._new_slot()
+                self._by_slot[slot] = o
+                self._slot_of[str(o.get("id"))] = slot
+                self._reindex(slot)
+            self._persist([("put", o) for o in added])
+            # Slots may have been renumbered by a rebuild above; look them up now
+            added_ids = {id(o) for o in added}
+            devices = self._device_count()
+            out: List[dict | None] = []
+            for o in orders:
+                slot = self._slot_of.get(str(o.get("id")))
+                ok = slot is not None and self._cnt[slot] and id(self._by_slot[slot]) in added_ids
+                out.append(self._info(slot, devices) if ok else None)
+            return out
+
+    def _pop_oldest_pending(self) -> int | None:
+        while self._pending:
+            slot = heapq.heappop(self._pending)
+            o = self._by_slot.get(slot)
+            if o is not None and o.get("status") == "Pending":
+                return slot
+        return None
+
+    def _claim(self, device: str | None, changed: List[dict]) -> int | None:
+        """Move the next Pending unit (per the scheduling policy) to In Progress.
+        Entries to persist are appended to `changed`; returns the slot or None."""
+        if self.policy.fifo:
+            slot = self._pop_oldest_pending()
+            if slot is None:
+                return None
+            prev = None
+        else:
+            prev = self._last_claim.get(str(device)) if device is not None else self._last_any
+            running = list(self._in_progress.values())
+            first = next(
+                (x for x in self.policy.order(self._pending_units(), prev, running) if self.policy.eligible(x[0], running)),
+                None,
+            )
+            if first is None:
+                return None
+            picked, skipped = first
+            for p in skipped:
+                p["bypassed"] = int(p.get("bypassed") or 0) + 1
+            changed.extend(skipped)
+            slot = self._slot_of[str(picked.get("id"))]
+        o = self._by_slot[slot]
+        o["status"] = "In Progress"
+        o["claimedAt"] = _utc_now_iso()
+        self._renew_lease(o)
+        if device is not None:
+            o["device"] = str(device)
+        if self.policy.chained:
+            # Planned duration after `prev`; short prep if the next unit is the same recipe
+            o["estSeconds"] = estimate_order_seconds(o, prev)
+            nxt = next(self.policy.order(self._pending_units(), o, self._in_progress.values()), None)
+            o["prepSeconds"] = _prep_seconds(o, nxt[0] if nxt else None)
+        self._reindex(slot)
+        last = {"items": copy.deepcopy((o.get("items") or [])[:1])}
+        self._last_any = self._last_claim[str(device or ESP_DEFAULT_DEVICE)] = last
+        changed.append(o)
+        return slot
+
+    def claim_next_pending(self, set_started: bool = False, device: str | None = None) -> dict | None:
+        """Next Pending entry (per the scheduling policy) -> In Progress
+        (optionally stamping startedAt / the claiming device)."""
+        with self.lock:
+            self._check_external_edit()
+            changed: List[dict] = []
+            slot = self._claim(device, changed)
+            if slot is None:
+                return None
+            o = self._by_slot[slot]
+            if set_started:
+                # Add startedAt for remaining-time estimation
+                o.setdefault("startedAt", _utc_now_iso())
+                o.setdefault("estSeconds", estimate_order_seconds(o))
+            self._persist([("put", x) for x in changed])
+            return copy.deepcopy(o)
+
+    def active_order(self, device: str = ESP_DEFAULT_DEVICE) -> dict | None:
+        """This device's In Progress entry, else claim the oldest Pending one for it."""
+        units = self.active_units(device, 1)
+        return units[0] if units else None
+
+    def _active_slots(self, device: str, limit: int, ops: List[tuple]) -> List[int]:
+        """Up to `limit` slots for this device, in pouring order: the ones it
+        already holds (leases renewed), topped up with fresh claims."""
+        self.touch_device(device)
+        held = self._device_units(device)
+        if not held:
+            slot = self._device_slot(device)
+            if slot is not None:
+                held = [slot]
+        changed: List[dict] = []
+        for slot in held:
+            o = self._in_progress[slot]
+            if o.get("device") != device:
+                o["device"] = device  # adopted (claimed before devices existed)
+                changed.append(o)
+            # The device is alive and asking for its jobs: renew its leases
+            # (in memory only -- see the module docstring)
+            self._renew_lease(o)
+        while len(held) < limit:
+            slot = self._claim(device, changed)
+            if slot is None:
+                break
+            held.append(slot)
+        self._stagger(held)
+        ops.extend(("put", x) for x in changed)
+        return held[:max(1, limit)]
+
+    def active_units(self, device: str = ESP_DEFAULT_DEVICE, limit: int = 1) -> List[dict]:
+        """Up to `limit` units for this device, in pouring order: the ones it
+        already holds (leases renewed), topped up with fresh claims."""
+        device = str(device)
+        with self.lock:
+            self._check_external_edit()
+            ops: List[tuple] = []
+            held = self._active_slots(device, limit, ops)
+            self._persist(ops)
+            return [copy.deepcopy(self._by_slot[s]) for s in held]
+
+    def dispatch(self, device: str = ESP_DEFAULT_DEVICE, limit: int = 1) -> tuple:
+        """active_units() plus the first unit's queue info, from one look at the
+        queue and one write: (units, info or None, queue version after it)."""
+        device = str(device)
+        with self.lock:
+            self._check_external_edit()
+            ops: List[tuple] = []
+            held = self._active_slots(device, limit, ops)
+            self._persist(ops)
+            return (*self._dispatched(held), self.signal.version)
+
+    def _dispatched(self, held: List[int]) -> tuple:
+        if not held:
+            return [], None
+        return [copy.deepcopy(self._by_slot[s]) for s in held], self._info(held[0], self._device_count())
+
+    def heartbeat(self, order_id: str, device: str = ESP_DEFAULT_DEVICE) -> dict | None:
+        """Extend the lease on `device`'s In Progress unit. None if it isn't (or no longer) theirs."""
+        device = str(device)
+        with self.lock:
+            self._check_external_edit()
+            self.touch_device(device)
+            slot = self._slot_of.get(str(order_id))
+            o = self._in_progress.get(slot) if slot is not None else None
+            if o is None or o.get("device") not in (None, device):
+                return None
+            changed = [] if o.get("device") == device else [o]
+            o["device"] = device
+            # Units waiting in the device's batch are kept alive too (in memory only)
+            for s in self._device_units(device):
+                self._renew_lease(self._in_progress[s])
+            self._persist([("put", x) for x in changed])
+            return copy.deepcopy(o)
+
+    def requeue_expired(self) -> List[dict]:
+        """Put In Progress units whose lease ran out back to Pending. Returns copies of them."""
+        with self.lock:
+            self._check_external_edit()
+            now = _utc_now()
+            changed: List[dict] = []
+            for slot, o in list(self._in_progress.items()):
+                lease = _as_utc(o.get("leaseUntil"))
+                if lease is None:
+                    # Claimed before leases existed: start the clock now
+                    self._renew_lease(o)
+                    changed.append(o)
+                    continue
+                if lease > now:
+                    continue
+                o.setdefault("requeues", []).append(
+                    {"at": now.isoformat(), "device": o.get("device"), "startedAt": o.get("startedAt")}
+                )
+                o["status"] = "Pending"
+                for k in ("device", "claimedAt", "startedAt", "leaseUntil", "prepSeconds"):
+                    o.pop(k, None)
+                self._reindex(slot)
+                changed.append(o)
+            self._persist([("put", o) for o in changed])
+            return [copy.deepcopy(o) for o in changed if o.get("status") == "Pending"]
+
+    def mark_complete(self, order_id: str) -> bool:
+        with self.lock:
+            self._check_external_edit()
+            slot = self._slot_of.get(str(order_id))
+            if slot is None:
+                return False
+            o = self._by_slot[slot]
+            o["status"] = "complete"
+            self._reindex(slot)
+            self._persist([("put", o)])
+            return True
+
+    def _complete_one(self, order_id: str, ops: List[tuple], span: tuple | None = None) -> bool:
+        slot = self._slot_of.get(str(order_id))
+        if slot is None:
+            return False
+        o = self._by_slot[slot]
+        device = o.get("device")
+        self._record_unit(o, ops, span)
+
+        if _consume_one_unit(o):
+            self._renew_lease(o)
+            self._reindex(slot)
+            ops.append(("put", o))
+        else:
+            # Otherwise (no items left) => fully complete + archive
+            o["status"] = "complete"
+            o["completedAt"] = _utc_now_iso()
+            del self._by_slot[slot]
+            del self._slot_of[str(order_id)]
+            self._reindex(slot)
+            ops.extend([("done", o), ("del", str(order_id))])
+
+        held = self._device_units(device) if device is not None else []
+        if held:
+            # The device preps, then pours its next held unit
+            prep = int(o.get("prepSeconds", ESP_PREP_SECONDS))
+            self._stagger(held, first_start=_utc_now() + timedelta(seconds=prep))
+            ops.extend(("put", self._in_progress[s]) for s in held if self._in_progress[s] is not o)
+        return True
+
+    def _record_unit(self, o: dict, ops: List[tuple], span: tuple | None = None):
+        """Log the unit being completed (kept in the entry, archived with it)
+        and teach the ETA model its measured duration. `span` overrides the
+        (startedAt, completedAt) pair, see _split_batch()."""
+        rec = {
+            "drinkId": _recipe_key(o),
+            "claimedAt": o.get("claimedAt"),
+            "startedAt": o.get("startedAt"),
+            "completedAt": _utc_now_iso(),
+        }
+        if span is not None:
+            rec["startedAt"], rec["completedAt"] = (t.isoformat() for t in span[:2])
+            rec["batchOf"] = span[2]
+        o.setdefault("unitTimes", []).append(rec)
+        model = get_eta_model()
+        if model is not None and model.observe(rec["drinkId"], unit_seconds_of(rec)):
+            ops.extend(("put", x) for x in self._refresh_estimates() if x is not o)
+
+    def _refresh_estimates(self) -> List[dict]:
+        """Re-estimate Pending units after the ETA model moved (their estSeconds
+        was stamped at enqueue). Returns the entries that changed."""
+        changed: List[dict] = []
+        for slot, o in self._by_slot.items():
+            if o.get("status") == "Pending":
+                est = estimate_order_seconds(o)
+                if o.get("estSeconds") != est:
+                    o["estSeconds"] = est
+                    changed.append(o)
+                cost = _ahead_cost(o)
+                if cost != self._cost[slot]:
+                    self._cost_tree.add(slot, cost - self._cost[slot])
+                    self._cost[slot] = cost
+        self._plan_cache = None
+        return changed
+
+    def complete_units(self, order_ids: Iterable[str], device: str | None = None, guard=None) -> tuple:
+        """Consume one unit per id (in order) with a single queue write.
+
+        With a `device`, every known id must be a unit that device is pouring
+        (In Progress, claimed by it or by no device yet). `guard(entries)` (the
+        live entries for `order_ids`, None for unknown ids; read only) runs next
+        under the same lock. On a refusal from either, nothing is completed.
+        Returns (refusal payload or None, [found per id]).
+        """
+        order_ids = [str(oid) for oid in order_ids]
+        with self.lock:
+            self._check_external_edit()
+            ops: List[tuple] = []
+            refusal, found = self._complete_checked(order_ids, device, guard, ops)
+            self._persist(ops)
+            return refusal, found
+
+    def _complete_checked(self, order_ids: List[str], device: str | None, guard, ops: List[tuple]) -> tuple:
+        if device is not None:
+            self.touch_device(device)
+            refusal = self._not_pouring(order_ids, device)
+            if refusal is not None:
+                return refusal, []
+        if guard is not None:
+            refusal = guard([self._by_slot.get(self._slot_of.get(oid, -1)) for oid in order_ids])
+            if refusal is not None:
+                return refusal, []
+        spans = self._split_batch(order_ids)
+        return None, [self._complete_one(oid, ops, span) for oid, span in zip(order_ids, spans)]
+
+    def _split_batch(self, order_ids: List[str]) -> List[tuple | None]:
+        """(startedAt, completedAt, batch size) to record per id when several
+        In Progress units complete in one call, else None.
+
+        Only the first of a batch really has a startedAt (the later ones carry
+        planned, staggered starts), so the time since it started, less prep
+        between units, is split evenly and laid out back to back.
+        """
+        units = [self._in_progress.get(self._slot_of.get(oid, -1)) for oid in order_ids]
+        batch = [o for o in units if o is not None]
+        spans: List[tuple | None] = [None] * len(order_ids)
+        if len(batch) < 2:
+            return spans
+        now = _utc_now()
+        starts = [t for t in (_as_utc(o.get("startedAt")) for o in batch) if t is not None and t <= now]
+        if not starts:
+            return spans
+        preps = [int(o.get("prepSeconds", ESP_PREP_SECONDS)) for o in batch[1:]]
+        share = max(0.0, (now - min(starts)).total_seconds() - sum(preps)) / len(batch)
+        t, preps = min(starts), [0] + preps
+        for i, o in enumerate(units):
+            if o is None:
+                continue
+            t += timedelta(seconds=preps.pop(0))
+            spans[i] = (t, t + timedelta(seconds=share), len(batch))
+            t += timedelta(seconds=share)
+        return spans
+
+    def _not_pouring(self, order_ids: List[str], device: str) -> dict | None:
+        """Refusal payload if `device` isn't pouring one of these units (unknown
+        ids are left to be reported as not found)."""
+        for oid in order_ids:
+            o = self._by_slot.get(self._slot_of.get(oid, -1))
+            if o is None:
+                continue
+            if o.get("device") not in (None, device):
+                return {"ok": False, "error": "Order is claimed by another device"}
+            if o.get("status") != "In Progress":
+                return {"ok": False, "error": "Order is not in progress"}
+        return None
+
+    def complete_and_dispatch(self, order_id: str, device: str = ESP_DEFAULT_DEVICE, limit: int = 1, guard=None) -> tuple:
+        """complete_units([order_id]) followed by dispatch(device, limit), in one
+        critical section and one write. Returns (refusal, found, units, info);
+        nothing is dispatched when the completion was refused or not found."""
+        device = str(device)
+        with self.lock:
+            self._check_external_edit()
+            ops: List[tuple] = []
+            refusal, found = self._complete_checked([str(order_id)], device, guard, ops)
+            held = self._active_slots(device, limit, ops) if refusal is None and found[0] else []
+            self._persist(ops)
+            return (refusal, bool(found and found[0])) + self._dispatched(held)
+
+    def complete_unit(self, order_id: str, device: str | None = None) -> bool:
+        """Consume one drink unit; archive + drop the entry once nothing remains.
+        False if not found, or (with a `device`) not a unit it is pouring."""
+        found = self.complete_units([order_id], device)[1]
+        return bool(found and found[0])
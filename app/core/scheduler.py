@@ -0,0 +1,198 @@
+"""Dispatch policies for the ESP queue (QUEUE_POLICY in config.py).
+
+A policy decides which Pending unit a dispenser gets next. order() takes the
+Pending units in arrival order, the unit poured last and the units pouring
+now, and yields (unit, passed_over) in dispatch order. The engine claims the
+first eligible() one, and walks the whole sequence (cached until the queue
+changes) for positions/ETAs -- re-checking eligible() claim by claim if the
+policy is `capped`.
+
+  fifo  – arrival order (the engine answers this one from its Fenwick trees)
+  batch – same recipe, else same ingredient set, back to back within a
+          bounded look-ahead window
+  fair  – round-robin / weighted-fair between users
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from app.config import QUEUE_BATCH_WINDOW, QUEUE_FAIR_WEIGHTS, QUEUE_POLICY, QUEUE_USER_MAX_INFLIGHT
+from app.core.storage import _recipe_key, _same_recipe, load_drinks
+
+
+class FifoPolicy:
+    name = "fifo"
+    fifo = True      # dispatch order == arrival order
+    chained = False  # a unit's duration doesn't depend on the one before it
+    capped = False   # eligible() never refuses a unit
+
+    def order(self, pending: Iterable[dict], prev: dict | None = None, running: Iterable[dict] = ()) -> Iterator[Tuple[dict, List[dict]]]:
+        for o in pending:
+            yield o, []
+
+    def eligible(self, o: dict, running: Iterable[dict]) -> bool:
+        return True
+
+    def on_enqueue(self, new: List[dict], active: Iterable[dict]):
+        pass
+
+
+class BatchPolicy:
+    """Group identical drinks to cut changeover time.
+
+    Looks at the first `window` Pending units; if one matches the recipe just
+    poured (else its ingredient set) it goes first. Units passed over are
+    counted (entry["bypassed"]) and one passed over `window` times can't be
+    passed again, so nobody waits more than `window` extra units.
+    """
+
+    name = "batch"
+    fifo = False
+    chained = True
+    capped = False
+
+    def __init__(self, window: int):
+        self.window = max(1, int(window))
+        self._catalog: tuple = (None, {})
+
+    def _ingredients(self, o: dict | None) -> frozenset | None:
+        items = (o or {}).get("items") or []
+        first = items[0] if isinstance(items, list) and items and isinstance(items[0], dict) else {}
+        ratios = first.get("ratios")
+        if isinstance(ratios, dict) and ratios:
+            return frozenset(ratios)
+        drinks = load_drinks()
+        if self._catalog[0] is not drinks:
+            self._catalog = (
+                drinks,
+                {str(d.get("id")): frozenset(d.get("ingredients") or ()) for d in drinks if isinstance(d, dict)},
+            )
+        return self._catalog[1].get(_recipe_key(o)) or None
+
+    def _pick(self, window: List[dict], prev: dict | None, passed) -> int:
+        limit = len(window)
+        for j, o in enumerate(window):
+            if passed(o) >= self.window:
+                limit = j + 1  # can't jump past this one
+                break
+        if prev is None:
+            return 0
+        for i in range(limit):
+            if _same_recipe(prev, window[i]):
+                return i
+        ingredients = self._ingredients(prev)
+        if ingredients:
+            for i in range(limit):
+                if self._ingredients(window[i]) == ingredients:
+                    return i
+        return 0
+
+    def order(self, pending: Iterable[dict], prev: dict | None = None, running: Iterable[dict] = ()) -> Iterator[Tuple[dict, List[dict]]]:
+        it = iter(pending)
+        window: List[dict] = []
+        extra: Dict[int, int] = {}  # id(unit) -> times passed over so far in this walk
+
+        def passed(o: dict) -> int:
+            return int(o.get("bypassed") or 0) + extra.get(id(o), 0)
+
+        while True:
+            while len(window) < self.window:
+                o = next(it, None)
+                if o is None:
+                    break
+                window.append(o)
+            if not window:
+                return
+            i = self._pick(window, prev, passed)
+            skipped = window[:i]
+            for o in skipped:
+                extra[id(o)] = extra.get(id(o), 0) + 1
+            prev = window.pop(i)
+            yield prev, skipped
+
+    def eligible(self, o: dict, running: Iterable[dict]) -> bool:
+        return True
+
+    def on_enqueue(self, new: List[dict], active: Iterable[dict]):
+        pass
+
+
+def _user(o: dict) -> str:
+    return str(o.get("username"))
+
+
+class FairPolicy:
+    """Weighted-fair queuing between users (plain round-robin with equal weights).
+
+    Start-time fair queuing: each unit gets a virtual start tag when enqueued,
+        fairTag = max(V, end of that user's previous unit)
+    where a unit ends at fairTag + 1 / weight and V is the tag of the unit
+    being served now (the newest pouring, else the oldest waiting). Units go
+    out in tag order, ties in arrival order, so each round serves one unit per
+    waiting customer and a one-drink order never sits behind a whole
+    twelve-drink one.
+    """
+
+    name = "fair"
+    fifo = False
+    chained = False
+
+    def __init__(self, weights: Dict[str, float], max_inflight: int = 0):
+        self.weights = weights
+        self.max_inflight = max(0, int(max_inflight))
+        self.capped = bool(self.max_inflight)
+
+    def _weight(self, user: str) -> float:
+        return self.weights.get(user, 1.0)
+
+    def on_enqueue(self, new: List[dict], active: Iterable[dict]):
+        """Stamp fairTag on newly enqueued units (`active`: units already queued)."""
+        running, waiting, ends = [], [], {}
+        for o in active:
+            tag = float(o.get("fairTag") or 0.0)
+            if o.get("status") == "In Progress":
+                running.append(tag)
+            elif o.get("status") == "Pending":
+                waiting.append(tag)
+            else:
+                continue
+            u = _user(o)
+            ends[u] = max(ends.get(u, 0.0), tag + 1.0 / self._weight(u))
+        vtime = max(running) if running else (min(waiting) if waiting else 0.0)
+        for o in new:
+            u = _user(o)
+            o["fairTag"] = start = max(vtime, ends.get(u, 0.0))
+            ends[u] = start + 1.0 / self._weight(u)
+
+    def order(self, pending: Iterable[dict], prev: dict | None = None, running: Iterable[dict] = ()) -> Iterator[Tuple[dict, List[dict]]]:
+        ranked = sorted(enumerate(pending), key=lambda x: (float(x[1].get("fairTag") or 0.0), x[0]))
+        for _, o in ranked:
+            yield o, []
+
+    def eligible(self, o: dict, running: Iterable[dict]) -> bool:
+        """Per-user cap on units pouring at once (QUEUE_USER_MAX_INFLIGHT)."""
+        if not self.max_inflight:
+            return True
+        user = _user(o)
+        return sum(1 for r in running if _user(r) == user) < self.max_inflight
+
+
+def _parse_weights(spec: str) -> Dict[str, float]:
+    """Parse QUEUE_FAIR_WEIGHTS, e.g. "alice:2,bob:0.5" (bad or non-positive entries ignored)."""
+    weights: Dict[str, float] = {}
+    for part in spec.split(","):
+        user, _, w = part.strip().rpartition(":")
+        try:
+            if user and float(w) > 0:
+                weights[user] = float(w)
+        except ValueError:
+            continue
+    return weights
+
+
+def get_policy(name: str = QUEUE_POLICY):
+    if name == "batch":
+        return BatchPolicy(QUEUE_BATCH_WINDOW)
+    if name == "fair":
+        return FairPolicy(_parse_weights(QUEUE_FAIR_WEIGHTS), QUEUE_USER_MAX_INFLIGHT)
+    return FifoPolicy()
@@ -0,0 +1,320 @@
+"""SQLite storage backend (STORAGE_BACKEND=sqlite).
+
+Exposes the same methods as storage.JsonBackend, backed by one WAL-mode
+database. History lookups and queue/archive row updates go through indexes
+instead of re-reading and rewriting whole JSON files; the queue's journal
+is simply row upserts/deletes (the WAL does the journaling).
+
+Each row keeps the original dict as JSON in `data`; the other columns are
+only there to be indexed.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+from app.core.archive import _as_utc, entry_time
+from app.core.storage import JsonBackend, _utc_now_iso
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    username      TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT,
+    ts       TEXT,
+    data     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (username, seq);
+CREATE TABLE IF NOT EXISTS drinks (
+    pos  INTEGER PRIMARY KEY,
+    id   TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS esp_queue (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    id       TEXT NOT NULL,
+    status   TEXT,
+    username TEXT,
+    data     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_queue_id ON esp_queue (id);
+CREATE TABLE IF NOT EXISTS esp_done (
+    seq          INTEGER PRIMARY KEY AUTOINCREMENT,
+    id           TEXT,
+    completed_at TEXT,
+    data         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_done_id ON esp_done (id);
+CREATE INDEX IF NOT EXISTS idx_done_completed ON esp_done (completed_at);
+"""
+
+# Rows fetched per round trip when streaming order history
+_ORDERS_PAGE = 500
+
+
+def _dump(obj) -> str:
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _queue_row(o: dict) -> tuple:
+    username = o.get("username")
+    return (str(o.get("id")), o.get("status"), str(username) if username is not None else None, _dump(o))
+
+
+def _done_time(o: dict) -> str | None:
+    dt = entry_time(o)
+    return dt.isoformat() if dt is not None else None
+
+
+class SqliteBackend:
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        if conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone() is None:
+            self._import_json()
+
+    # -------------------------
+    # Connection / transactions
+    # -------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread (FastAPI runs sync endpoints in a threadpool)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        """Write transaction. BEGIN IMMEDIATE takes the write lock up front so
+        read-modify-write sequences (claim, complete) can't interleave."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _import_json(self):
+        """First start on SQLite: copy whatever the JSON backend has."""
+        src = JsonBackend()
+        with self._tx() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users (username, password_hash) VALUES (?, ?)",
+                list(src.load_users().items()),
+            )
+            self._insert_orders(conn, src.iter_orders())
+            if src.has_drinks():
+                self._insert_drinks(conn, src.load_drinks())
+            self._insert_queue(conn, src.load_esp_queue())
+            self._insert_done(conn, src.load_esp_done())
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (_utc_now_iso(),))
+
+    def stamp(self, name: str):
+        # Writes all go through storage.py, whose write-version counter keys the cache
+        return None
+
+    # -------------------------
+    # Users
+    # -------------------------
+
+    def load_users(self) -> Dict[str, str]:
+        rows = self._conn().execute("SELECT username, password_hash FROM users ORDER BY rowid").fetchall()
+        return {u: h for u, h in rows}
+
+    def save_users(self, users: Dict[str, str]):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                [(str(u), str(h)) for u, h in users.items()],
+            )
+
+    # -------------------------
+    # Orders
+    # -------------------------
+
+    @staticmethod
+    def _insert_orders(conn: sqlite3.Connection, rows: Iterable[dict]) -> int:
+        params = [
+            (str(r.get("username")) if r.get("username") is not None else None, r.get("ts"), _dump(r))
+            for r in rows
+            if isinstance(r, dict)
+        ]
+        conn.executemany("INSERT INTO orders (username, ts, data) VALUES (?, ?, ?)", params)
+        return len(params)
+
+    def migrate_orders_json(self) -> int:
+        # JSON data (including legacy orders.json) is imported when the database is created
+        return 0
+
+    def iter_orders(self) -> Iterator[dict]:
+        # Keyset pagination: each page is a short, fully-drained statement, so
+        # the caller may write to the database while still iterating.
+        conn = self._conn()
+        last = 0
+        while True:
+            page = conn.execute(
+                "SELECT seq, data FROM orders WHERE seq > ? ORDER BY seq LIMIT ?", (last, _ORDERS_PAGE)
+            ).fetchall()
+            if not page:
+                return
+            for seq, data in page:
+                last = seq
+                try:
+                    row = json.loads(data)
+                except Exception:
+                    continue
+                if isinstance(row, dict):
+                    yield row
+
+    def append_orders(self, rows: Iterable[dict]) -> int:
+        with self._tx() as conn:
+            return self._insert_orders(conn, rows)
+
+    def save_orders(self, orders: List[dict]):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM orders")
+            self._insert_orders(conn, orders)
+
+    def user_order_refs(self, username: str) -> List[int]:
+        """Ascending refs (row seq) of this user's rows -- an index-only scan."""
+        rows = self._conn().execute("SELECT seq FROM orders WHERE username = ? ORDER BY seq", (str(username),))
+        return [seq for (seq,) in rows]
+
+    def read_orders_at(self, refs: List[int]) -> List[dict]:
+        out: List[dict] = []
+        conn = self._conn()
+        for i in range(0, len(refs), _ORDERS_PAGE):
+            chunk = refs[i:i + _ORDERS_PAGE]
+            marks = ",".join("?" * len(chunk))
+            for (d,) in conn.execute(f"SELECT data FROM orders WHERE seq IN ({marks}) ORDER BY seq", chunk):
+                out.append(json.loads(d))
+        return out
+
+    # -------------------------
+    # Drinks
+    # -------------------------
+
+    @staticmethod
+    def _insert_drinks(conn: sqlite3.Connection, drinks: List[dict]):
+        conn.executemany(
+            "INSERT INTO drinks (pos, id, data) VALUES (?, ?, ?)",
+            [(i, str(d.get("id")) if isinstance(d, dict) else None, _dump(d)) for i, d in enumerate(drinks)],
+        )
+
+    def load_drinks(self) -> List[dict]:
+        return [json.loads(d) for (d,) in self._conn().execute("SELECT data FROM drinks ORDER BY pos")]
+
+    def has_drinks(self) -> bool:
+        return self._conn().execute("SELECT 1 FROM drinks LIMIT 1").fetchone() is not None
+
+    def save_drinks(self, drinks: List[dict]):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM drinks")
+            self._insert_drinks(conn, drinks)
+
+    # -------------------------
+    # ESP queue
+    # -------------------------
+
+    @staticmethod
+    def _insert_queue(conn: sqlite3.Connection, queue: Iterable[dict]):
+        conn.executemany(
+            "INSERT INTO esp_queue (id, status, username, data) VALUES (?, ?, ?, ?)",
+            [_queue_row(o) for o in queue if isinstance(o, dict)],
+        )
+
+    @staticmethod
+    def _insert_done(conn: sqlite3.Connection, done: Iterable[dict]):
+        conn.executemany(
+            "INSERT INTO esp_done (id, completed_at, data) VALUES (?, ?, ?)",
+            [
+                (str(o.get("id")), _done_time(o), _dump(o))
+                for o in done
+                if isinstance(o, dict)
+            ],
+        )
+
+    def load_esp_queue(self) -> List[dict]:
+        return [json.loads(d) for (d,) in self._conn().execute("SELECT data FROM esp_queue ORDER BY seq")]
+
+    def load_queue_state(self) -> tuple:
+        return self.load_esp_queue(), 0
+
+    def journal_queue(self, ops: List[tuple]):
+        with self._tx() as conn:
+            for kind, arg in ops:
+                if kind == "put":
+                    row = _queue_row(arg)
+                    cur = conn.execute(
+                        "UPDATE esp_queue SET status = ?, username = ?, data = ? WHERE id = ?",
+                        (*row[1:], row[0]),
+                    )
+                    if cur.rowcount == 0:
+                        self._insert_queue(conn, [arg])
+                elif kind == "del":
+                    conn.execute("DELETE FROM esp_queue WHERE id = ?", (str(arg),))
+                elif kind == "done":
+                    self._insert_done(conn, [arg])
+
+    def compact_queue(self, entries: List[dict]):
+        # Rows are updated in place; nothing to fold
+        pass
+
+    def load_queue_snapshot(self) -> List[dict]:
+        # No journal (and no hand-edited file to detect)
+        return self.load_esp_queue()
+
+    def save_esp_queue(self, queue: List[dict]):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM esp_queue")
+            self._insert_queue(conn, queue)
+
+    def load_esp_done(self) -> List[dict]:
+        return [json.loads(d) for (d,) in self._conn().execute("SELECT data FROM esp_done ORDER BY seq")]
+
+    def iter_esp_done(self, start=None, end=None) -> Iterator[dict]:
+        # completed_at is a UTC ISO string, so the range is an index scan on it
+        where, params = [], []
+        lo, hi = _as_utc(start), _as_utc(end)
+        if lo is not None:
+            where.append("completed_at >= ?")
+            params.append(lo.isoformat())
+        if hi is not None:
+            where.append("completed_at < ?")
+            params.append(hi.isoformat())
+        sql = "SELECT data FROM esp_done"
+        if where:
+            sql += " WHERE " + " AND ".join(where) + " ORDER BY completed_at, seq"
+        else:
+            sql += " ORDER BY seq"
+        for (d,) in self._conn().execute(sql, params).fetchall():
+            yield json.loads(d)
+
+    def save_esp_done(self, done: List[dict]):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM esp_done")
+            self._insert_done(conn, done)
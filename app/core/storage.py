@@ -1,17 +1,33 @@
 import json
+import os
+import threading
+import time
+import zlib
+from bisect import bisect_left
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 from app.config import (
     USERS_FILE,
     ORDERS_FILE,
+    ORDERS_LOG_FILE,
     DRINKS_FILE,
     ESP_QUEUE_FILE,
+    ESP_QUEUE_JOURNAL_FILE,
     ESP_DONE_FILE,
+    ESP_DONE_DIR,
     ETA_ORDER_OVERHEAD_SEC,
     ETA_SECONDS_PER_DRINK,
     ESP_PREP_SECONDS,
+    ETA_BATCH_OVERHEAD_SEC,
+    ESP_BATCH_PREP_SECONDS,
+    ESP_DEFAULT_DEVICE,
+    QUEUE_ETAG_TICK_SEC,
+    STORAGE_BACKEND,
+    SQLITE_DB_FILE,
+    STORAGE_CACHE,
 )
+from app.core.eta_model import get_eta_model
 
 
 def _utc_now() -> datetime:
@@ -22,20 +38,77 @@ def _utc_now_iso() -> str:
     return _utc_now().isoformat()
 
 
-def estimate_order_seconds(order: dict) -> int:
-    """Explainable ETA model used for queue + ESP display."""
-    total_qty = 0
+def _recipe_key(order: dict | None) -> str | None:
+    """drinkId of the unit's (first) item -- what the machine is set up for."""
+    items = (order or {}).get("items") or []
+    first = items[0] if isinstance(items, list) and items and isinstance(items[0], dict) else {}
+    did = first.get("drinkId")
+    return str(did) if did else None
+
+
+def _same_recipe(a: dict | None, b: dict | None) -> bool:
+    key = _recipe_key(a)
+    return key is not None and key == _recipe_key(b)
+
+
+def estimate_order_seconds(order: dict, prev: dict | None = None) -> int:
+    """Explainable ETA model used for queue + ESP display.
+
+    A drink with enough measured pours takes its learned unit time (see
+    eta_model.py; it already includes the machine's real per-unit overhead).
+    Other items use the constants: ETA_ORDER_OVERHEAD_SEC + qty * ETA_SECONDS_PER_DRINK.
+
+    `prev` is the unit poured just before this one, when the scheduler knows
+    it: right after the same recipe the changeover overhead drops to
+    ETA_BATCH_OVERHEAD_SEC.
+    """
+    model = get_eta_model()
+    learned = 0.0
+    fixed_qty = 0
     items = order.get("items") or []
     if isinstance(items, list):
         for it in items:
             if isinstance(it, dict):
                 try:
-                    total_qty += int(it.get("quantity", 1))
+                    qty = int(it.get("quantity", 1))
                 except Exception:
-                    total_qty += 1
-    if total_qty <= 0:
-        total_qty = 1
-    return int(ETA_ORDER_OVERHEAD_SEC + (total_qty * ETA_SECONDS_PER_DRINK))
+                    qty = 1
+                unit = model.unit_seconds(it.get("drinkId")) if model is not None else None
+                if unit is None:
+                    fixed_qty += qty
+                else:
+                    learned += qty * unit
+    if fixed_qty <= 0 and learned <= 0:
+        fixed_qty = 1
+    seconds = learned
+    if fixed_qty > 0:
+        seconds += ETA_ORDER_OVERHEAD_SEC + fixed_qty * ETA_SECONDS_PER_DRINK
+    if _same_recipe(prev, order):
+        seconds -= ETA_ORDER_OVERHEAD_SEC - ETA_BATCH_OVERHEAD_SEC
+    return max(1, int(round(seconds)))
+
+
+def _prep_seconds(order: dict, nxt: dict | None = None) -> int:
+    """Machine reset time after `order` (shorter when `nxt` is the same recipe)."""
+    return int(ESP_BATCH_PREP_SECONDS if _same_recipe(order, nxt) else ESP_PREP_SECONDS)
+
+
+def _elapsed_seconds(order: dict) -> int | None:
+    """Seconds since an In Progress order's startedAt (negative if it is planned
+    to start later, i.e. queued behind its device's current unit in a batch)."""
+    if order.get("status") != "In Progress":
+        return None
+    started_at = order.get("startedAt")
+    if not started_at:
+        return None
+    try:
+        started_dt = datetime.fromisoformat(str(started_at))
+        # Ensure tz-aware
+        if started_dt.tzinfo is None:
+            started_dt = started_dt.replace(tzinfo=timezone.utc)
+        return int((_utc_now() - started_dt).total_seconds())
+    except Exception:
+        return None
 
 
 def _remaining_seconds_for_order(order: dict) -> int:
@@ -45,22 +118,91 @@ def _remaining_seconds_for_order(order: dict) -> int:
     Otherwise return full estimated seconds.
     """
     est = int(order.get("estSeconds") or estimate_order_seconds(order))
-    status = order.get("status")
-    if status == "In Progress":
-        started_at = order.get("startedAt")
-        if started_at:
-            try:
-                started_dt = datetime.fromisoformat(str(started_at))
-                # Ensure tz-aware
-                if started_dt.tzinfo is None:
-                    started_dt = started_dt.replace(tzinfo=timezone.utc)
-                elapsed = int((_utc_now() - started_dt).total_seconds())
-                return max(1, est - elapsed)
-            except Exception:
-                pass
+    elapsed = _elapsed_seconds(order)
+    if elapsed is not None:
+        return max(1, est - elapsed)
     return max(0, est)
 
 
+def _ahead_cost(order: dict) -> int:
+    """Seconds an active order adds for everyone behind it (remaining time + prep).
+
+    A batched unit that hasn't started yet counts only its own pour: the wait
+    before it is already the cost of the units ahead of it on its device.
+    """
+    elapsed = _elapsed_seconds(order)
+    wait = -elapsed if elapsed is not None and elapsed < 0 else 0
+    return _remaining_seconds_for_order(order) - wait + int(order.get("prepSeconds", ESP_PREP_SECONDS))
+
+
+def _queue_info(ahead: int, ahead_remaining: int, order: dict, devices: int = 1, est: int | None = None) -> dict:
+    """Position/ETA payload for `order`, given how many active orders are ahead
+    of it (in dispatch order) and the sum of their _ahead_cost().
+
+    With several dispensers online the backlog ahead is shared between them:
+    a unit with fewer than `devices` orders ahead starts right away, otherwise
+    it waits for its share of the work ahead. `est` overrides the order's own
+    estimate (the scheduler's planned duration for a Pending unit).
+    """
+    this_remaining = _remaining_seconds_for_order(order) if est is None else int(est)
+    this_est = int(est if est is not None else (order.get('estSeconds') or estimate_order_seconds(order)))
+    devices = max(1, int(devices))
+    if order.get("status") == "In Progress" or ahead < devices:
+        ahead_remaining = 0
+    else:
+        ahead_remaining = -(-int(ahead_remaining) // devices)
+
+    # ETA until *completion* of this order
+    eta_to_complete = int(ahead_remaining + this_remaining)
+
+    return {
+        "position": ahead + 1,
+        "ahead": ahead,
+        "status": order.get("status"),
+        "etaSeconds": eta_to_complete,
+        "etaAheadSeconds": int(ahead_remaining),
+        "etaThisSeconds": int(this_remaining),
+        "estSeconds": int(this_est),
+    }
+
+
+def _consume_one_unit(order: dict) -> bool:
+    """Consume ONE drink unit from an active order (mutates `order`).
+
+    Decrements the first item's quantity (or pops it). Returns True if items
+    still remain (order stays In Progress with timing reset), False if the
+    order is now finished and should be archived.
+    """
+    items = order.get("items") or []
+    if not isinstance(items, list):
+        items = []
+
+    # If there are remaining items, consume ONE drink unit
+    if items:
+        first = items[0] if isinstance(items[0], dict) else {}
+        try:
+            qty = int(first.get("quantity", 1))
+        except Exception:
+            qty = 1
+
+        if qty > 1:
+            first["quantity"] = qty - 1
+            items[0] = first
+        else:
+            # qty <= 1 => remove this item
+            items.pop(0)
+
+        # If items still remain, keep order active and reset timing estimation
+        if items:
+            order["items"] = items
+            order["status"] = "In Progress"
+            order["startedAt"] = _utc_now_iso()
+            order["estSeconds"] = estimate_order_seconds(order)
+            return True
+
+    return False
+
+
 def _read_json(path, default=None) -> Any:
     """
     Read JSON safely.
@@ -78,8 +220,440 @@ def _read_json(path, default=None) -> Any:
 
 
 def _write_json(path, obj: Any):
+    """Write JSON atomically (tmp file + rename), so readers never see a half-written file."""
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(obj, indent=2), encoding="utf-8")
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(obj, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# -------------------------
+# JSON backend (default)
+# -------------------------
+# Every collection is one file in app/data. Easy to inspect and hand-edit,
+# but each mutation reads and rewrites the whole file.
+
+_ORDERS_LOCK = threading.Lock()
+
+
+def _order_line(row: dict) -> str:
+    return json.dumps(row, separators=(",", ":")) + "\n"
+
+
+def _rewrite_orders_log(rows: Iterable[dict]):
+    """Atomically replace the log contents (tmp file + rename). Caller holds _ORDERS_LOCK."""
+    ORDERS_LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = ORDERS_LOG_FILE.with_name(ORDERS_LOG_FILE.name + ".tmp")
+    tmp.write_text("".join(_order_line(o) for o in rows if isinstance(o, dict)), encoding="utf-8")
+    os.replace(tmp, ORDERS_LOG_FILE)
+
+
+class JsonBackend:
+    name = "json"
+
+    def __init__(self):
+        self._archive = None
+        # username -> byte offsets of that user's rows in orders.jsonl
+        self._user_index: Dict[str, List[int]] | None = None
+        self._user_index_stamp = None
+
+    _FILES = {"users": USERS_FILE, "orders": ORDERS_LOG_FILE, "drinks": DRINKS_FILE, "esp_queue": ESP_QUEUE_FILE}
+
+    def stamp(self, name: str):
+        """Cache key for a collection: changes whenever its file is rewritten/appended."""
+        try:
+            st = self._FILES[name].stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    # ---- Users ----
+
+    def load_users(self) -> Dict[str, str]:
+        data = _read_json(USERS_FILE, default={})
+        return data if isinstance(data, dict) else {}
+
+    def save_users(self, users: Dict[str, str]):
+        _write_json(USERS_FILE, users)
+
+    # ---- Orders (append-only JSONL log) ----
+    # History rows are only ever added, so they live in a line-delimited log:
+    # /checkout appends its new rows instead of re-serializing the whole history.
+    # The legacy orders.json array is imported once, the first time the log is needed.
+
+    def migrate_orders_json(self) -> int:
+        with _ORDERS_LOCK:
+            if ORDERS_LOG_FILE.exists():
+                return 0
+            data = _read_json(ORDERS_FILE, default=[])
+            rows = [o for o in data if isinstance(o, dict)] if isinstance(data, list) else []
+            _rewrite_orders_log(rows)
+            return len(rows)
+
+    def iter_orders(self) -> Iterator[dict]:
+        if not ORDERS_LOG_FILE.exists():
+            self.migrate_orders_json()
+        try:
+            f = ORDERS_LOG_FILE.open("r", encoding="utf-8")
+        except OSError:
+            return
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(row, dict):
+                    yield row
+
+    def append_orders(self, rows: Iterable[dict]) -> int:
+        rows = [r for r in rows if isinstance(r, dict)]
+        if not rows:
+            return 0
+        if not ORDERS_LOG_FILE.exists():
+            self.migrate_orders_json()
+        lines = [_order_line(r).encode("utf-8") for r in rows]
+        with _ORDERS_LOCK:
+            index_current = self._user_index is not None and self._user_index_stamp == self.stamp("orders")
+            with ORDERS_LOG_FILE.open("ab") as f:
+                pos = f.seek(0, os.SEEK_END)
+                if pos > 0:
+                    # Never glue a new row onto a torn last line
+                    with ORDERS_LOG_FILE.open("rb") as r:
+                        r.seek(pos - 1)
+                        if r.read(1) != b"\n":
+                            f.write(b"\n")
+                            pos += 1
+                f.write(b"".join(lines))
+            if index_current:
+                for r, line in zip(rows, lines):
+                    self._user_index.setdefault(str(r.get("username")), []).append(pos)
+                    pos += len(line)
+                self._user_index_stamp = self.stamp("orders")
+        return len(rows)
+
+    def save_orders(self, orders: List[dict]):
+        with _ORDERS_LOCK:
+            _rewrite_orders_log(orders)
+            self._user_index = None
+
+    # ---- Per-user history index ----
+    # Built with one scan of the log, then extended by append_orders(); rebuilt
+    # if the log changes behind our back (stamp mismatch).
+
+    def _ensure_user_index(self) -> Dict[str, List[int]]:
+        if not ORDERS_LOG_FILE.exists():
+            self.migrate_orders_json()
+        with _ORDERS_LOCK:
+            stamp = self.stamp("orders")
+            if self._user_index is None or self._user_index_stamp != stamp:
+                index: Dict[str, List[int]] = {}
+                try:
+                    with ORDERS_LOG_FILE.open("rb") as f:
+                        pos = 0
+                        for line in f:
+                            try:
+                                row = json.loads(line)
+                            except Exception:
+                                row = None
+                            if isinstance(row, dict):
+                                index.setdefault(str(row.get("username")), []).append(pos)
+                            pos += len(line)
+                except OSError:
+                    pass
+                self._user_index = index
+                self._user_index_stamp = stamp
+            return self._user_index
+
+    def user_order_refs(self, username: str) -> List[int]:
+        """Ascending refs (byte offsets) of this user's rows."""
+        return list(self._ensure_user_index().get(str(username), ()))
+
+    def read_orders_at(self, refs: List[int]) -> List[dict]:
+        out: List[dict] = []
+        with ORDERS_LOG_FILE.open("rb") as f:
+            for ref in refs:
+                f.seek(ref)
+                try:
+                    row = json.loads(f.readline())
+                except Exception:
+                    continue
+                if isinstance(row, dict):
+                    out.append(row)
+        return out
+
+    # ---- Drinks ----
+
+    def load_drinks(self) -> List[dict]:
+        data = _read_json(DRINKS_FILE, default=[])
+        return data if isinstance(data, list) else []
+
+    def has_drinks(self) -> bool:
+        try:
+            size = DRINKS_FILE.stat().st_size
+        except OSError:
+            return False
+        # Only a tiny file can be whitespace-only; skip the read otherwise
+        if size > 16:
+            return True
+        return bool(size) and bool(DRINKS_FILE.read_text(encoding="utf-8").strip())
+
+    def save_drinks(self, drinks: List[dict]):
+        _write_json(DRINKS_FILE, drinks)
+
+    # ---- ESP queue (polling) ----
+    # The queue itself lives in memory (app/core/queue_engine.py). Changes are
+    # appended to esp_queue.journal.jsonl and folded into the esp_queue.json
+    # snapshot on compaction; replaying a journal is idempotent (put = upsert).
+
+    def _read_queue_journal(self) -> List[dict]:
+        ops: List[dict] = []
+        try:
+            f = ESP_QUEUE_JOURNAL_FILE.open("r", encoding="utf-8")
+        except OSError:
+            return ops
+        with f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except Exception:
+                    continue  # torn last line
+                if isinstance(op, dict):
+                    ops.append(op)
+        return ops
+
+    def load_queue_state(self) -> tuple:
+        """(entries, journal ops replayed) -- snapshot + journal."""
+        queue = self.load_queue_snapshot()
+        ops = self._read_queue_journal()
+        if not ops:
+            return queue, 0
+
+        by_id: Dict[str, dict] = {}
+        for o in queue:
+            if isinstance(o, dict):
+                by_id.setdefault(str(o.get("id")), o)
+        for op in ops:
+            if op.get("op") == "put" and isinstance(op.get("entry"), dict):
+                by_id[str(op["entry"].get("id"))] = op["entry"]
+            elif op.get("op") == "del":
+                by_id.pop(str(op.get("id")), None)
+        return list(by_id.values()), len(ops)
+
+    def load_esp_queue(self) -> List[dict]:
+        return self.load_queue_state()[0]
+
+    def journal_queue(self, ops: List[tuple]):
+        lines = []
+        done = []
+        for kind, arg in ops:
+            if kind == "put":
+                lines.append(json.dumps({"op": "put", "entry": arg}, separators=(",", ":")) + "\n")
+            elif kind == "del":
+                lines.append(json.dumps({"op": "del", "id": str(arg)}, separators=(",", ":")) + "\n")
+            elif kind == "done":
+                done.append(arg)
+        if done:
+            # Archive before the queue delete is journaled: a crash in between
+            # leaves the entry in the queue rather than losing it
+            self.done_archive().append(done)
+        if lines:
+            ESP_QUEUE_JOURNAL_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with ESP_QUEUE_JOURNAL_FILE.open("a", encoding="utf-8") as f:
+                f.write("".join(lines))
+
+    def compact_queue(self, entries: List[dict]):
+        """Write the full snapshot, then start a fresh journal."""
+        _write_json(ESP_QUEUE_FILE, entries)
+        ESP_QUEUE_JOURNAL_FILE.unlink(missing_ok=True)
+
+    def load_queue_snapshot(self) -> List[dict]:
+        """esp_queue.json alone, without replaying the journal (to read a hand edit)."""
+        data = _read_json(ESP_QUEUE_FILE, default=[])
+        return data if isinstance(data, list) else []
+
+    def save_esp_queue(self, queue: List[dict]):
+        self.compact_queue(queue)
+
+    # ---- Completed-order archive (day segments, app/core/archive.py) ----
+
+    def done_archive(self):
+        if self._archive is None:
+            from app.core.archive import DoneArchive
+            self._archive = DoneArchive(ESP_DONE_DIR, legacy_file=ESP_DONE_FILE)
+        return self._archive
+
+    def iter_esp_done(self, start=None, end=None) -> Iterator[dict]:
+        return self.done_archive().iter_range(start, end)
+
+    def load_esp_done(self) -> List[dict]:
+        return list(self.iter_esp_done())
+
+    def save_esp_done(self, done: List[dict]):
+        self.done_archive().replace(done)
+
+
+# -------------------------
+# Backend selection
+# -------------------------
+# STORAGE_BACKEND=json (default) or sqlite. Both expose the same methods;
+# the module-level functions below are the API the rest of the app uses.
+
+_BACKEND = None
+_BACKEND_LOCK = threading.Lock()
+_QUEUE = None
+
+
+def get_backend():
+    global _BACKEND
+    if _BACKEND is None:
+        with _BACKEND_LOCK:
+            if _BACKEND is None:
+                if STORAGE_BACKEND == "sqlite":
+                    from app.core.sqlite_backend import SqliteBackend
+                    _BACKEND = SqliteBackend(SQLITE_DB_FILE)
+                else:
+                    _BACKEND = JsonBackend()
+    return _BACKEND
+
+
+def get_queue_engine():
+    """The process-wide in-memory queue (loaded from the backend on first use)."""
+    global _QUEUE
+    if _QUEUE is None:
+        backend = get_backend()
+        with _BACKEND_LOCK:
+            if _QUEUE is None:
+                from app.core.queue_engine import QueueEngine
+                _QUEUE = QueueEngine(backend)
+    return _QUEUE
+
+
+# -------------------------
+# Read cache
+# -------------------------
+# users / orders / drinks are read on nearly every request but change rarely.
+# Parsed data is cached per collection and handed out as read-only snapshots,
+# keyed on (backend stamp, local write version): the backend stamp is the
+# file mtime/size for JSON, and the write version is bumped by every write
+# made through this module (that alone covers SQLite, single process).
+
+class FrozenDict(dict):
+    """Read-only dict used in cached snapshots (still a dict for JSON/isinstance)."""
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached storage snapshot is read-only; copy it first (dict(...))")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        # copy/deepcopy/pickle produce a plain, mutable dict
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """Read-only list used in cached snapshots."""
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached storage snapshot is read-only; copy it first (list(...))")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = remove = pop = clear = sort = reverse = _readonly
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def _freeze(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(_freeze(v) for v in obj)
+    return obj
+
+
+class _SnapshotCache:
+    def __init__(self):
+        # One lock per collection, so a cold parse of the orders log doesn't
+        # stall logins or drink-list reads
+        self._locks: Dict[str, threading.RLock] = {}
+        self._locks_guard = threading.Lock()
+        self._entries: Dict[str, tuple] = {}
+        self._versions: Dict[str, int] = {}
+        self._hits: Dict[str, int] = {}
+        self._misses: Dict[str, int] = {}
+
+    def lock(self, name: str) -> threading.RLock:
+        """The lock for one collection: held around a write and the cache
+        update that goes with it."""
+        with self._locks_guard:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.RLock()
+            return lock
+
+    def stamp(self, name: str):
+        return (get_backend().stamp(name), self._versions.get(name, 0))
+
+    def get(self, name: str, loader):
+        with self.lock(name):
+            # Stamp BEFORE loading: the stored data is then never older than its key
+            stamp = self.stamp(name)
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == stamp:
+                self._hits[name] = self._hits.get(name, 0) + 1
+                return entry[1]
+            self._misses[name] = self._misses.get(name, 0) + 1
+            value = _freeze(loader())
+            self._entries[name] = (stamp, value)
+            return value
+
+    def written(self, name: str):
+        """Local write: bump the version so the next read reloads."""
+        with self.lock(name):
+            self._versions[name] = self._versions.get(name, 0) + 1
+            self._entries.pop(name, None)
+
+    def appended(self, name: str, before, rows: List[dict]):
+        """Local append to a list collection: extend the cached snapshot in
+        place of a reload, if it was current right before the write."""
+        with self.lock(name):
+            entry = self._entries.get(name)
+            self.written(name)
+            if entry is not None and entry[0] == before:
+                self._entries[name] = (self.stamp(name), FrozenList([*entry[1], *map(_freeze, rows)]))
+
+    def stats(self) -> Dict[str, dict]:
+        # Copies, read without the collection locks: a cold load doesn't hold up stats
+        entries, versions = dict(self._entries), dict(self._versions)
+        hits, misses = dict(self._hits), dict(self._misses)
+        out = {}
+        for name in sorted(set(hits) | set(misses) | set(versions)):
+            h, m = hits.get(name, 0), misses.get(name, 0)
+            out[name] = {
+                "hits": h,
+                "misses": m,
+                "hitRate": round(h / (h + m), 4) if (h + m) else 0.0,
+                "version": versions.get(name, 0),
+                "cached": name in entries,
+            }
+        return out
+
+
+_CACHE = _SnapshotCache()
+
+
+def cache_stats() -> Dict[str, dict]:
+    """Hit/miss counters of the read cache, per collection."""
+    return _CACHE.stats()
 
 
 # -------------------------
@@ -87,25 +661,125 @@ def _write_json(path, obj: Any):
 # -------------------------
 
 def load_users() -> Dict[str, str]:
-    data = _read_json(USERS_FILE, default={})
-    return data if isinstance(data, dict) else {}
+    """username -> password hash (a mutable copy; pass it back to save_users)."""
+    if not STORAGE_CACHE:
+        return get_backend().load_users()
+    return dict(_CACHE.get("users", get_backend().load_users))
 
 
 def save_users(users: Dict[str, str]):
-    _write_json(USERS_FILE, users)
+    with _CACHE.lock("users"):
+        get_backend().save_users(users)
+        _CACHE.written("users")
 
 
 # -------------------------
 # Orders
 # -------------------------
 
+def migrate_orders_json() -> int:
+    """One-shot import of the legacy orders.json array into the order log.
+
+    No-op once the log exists. The old file is left untouched as a backup.
+    Returns the number of rows migrated.
+    """
+    return get_backend().migrate_orders_json()
+
+
+def iter_orders() -> Iterator[dict]:
+    """Iterate order rows, oldest first.
+
+    Prefer this over load_orders() when you only need a single pass. With the
+    read cache on this walks the cached snapshot; otherwise rows are streamed
+    from the log one at a time. Torn/invalid lines (e.g. a crash mid-append)
+    are skipped.
+    """
+    if not STORAGE_CACHE:
+        return get_backend().iter_orders()
+    return iter(load_orders())
+
+
 def load_orders() -> List[dict]:
-    data = _read_json(ORDERS_FILE, default=[])
-    return data if isinstance(data, list) else []
+    """All order rows. With the read cache on, a shared read-only snapshot."""
+    if not STORAGE_CACHE:
+        return list(get_backend().iter_orders())
+    return _CACHE.get("orders", lambda: list(get_backend().iter_orders()))
+
+
+def append_orders(rows: Iterable[dict]) -> int:
+    """Append new history rows to the log (writes only the new rows)."""
+    rows = [r for r in rows if isinstance(r, dict)]
+    if not rows:
+        return 0
+    with _CACHE.lock("orders"):
+        before = _CACHE.stamp("orders")
+        n = get_backend().append_orders(rows)
+        _CACHE.appended("orders", before, rows)
+        after = _CACHE.stamp("orders")
+        for listener in list(_ORDERS_LISTENERS):
+            try:
+                listener(before, after, rows)
+            except Exception:
+                pass  # a broken listener must not fail the checkout
+    return n
+
+
+# Callbacks run by append_orders() as listener(before, after, rows), in log
+# order under the orders cache lock. `before`/`after` are orders_stamp() around the
+# write: a listener whose derived state was built at `before` can fold `rows`
+# in instead of re-reading the log (app/ml/user_matrix.py does this).
+_ORDERS_LISTENERS: List = []
+
+
+def add_orders_listener(listener):
+    """Register listener(before, after, rows) for every append_orders()."""
+    with _CACHE.lock("orders"):
+        if listener not in _ORDERS_LISTENERS:
+            _ORDERS_LISTENERS.append(listener)
+
+
+def orders_stamp():
+    """Changes whenever the order log changes (this process or on disk)."""
+    return _CACHE.stamp("orders")
+
+
+def read_orders_stamped() -> tuple:
+    """(stamp, rows): every order row plus the orders_stamp() they were read at."""
+    with _CACHE.lock("orders"):
+        return _CACHE.stamp("orders"), load_orders()
+
+
+def user_orders_page(username: str, limit: int | None = None, before: int | None = None) -> tuple:
+    """One page of a user's history via the per-user index: (rows, next_before).
+
+    Rows are the `limit` most recent rows strictly older than cursor `before`
+    (None = newest), returned oldest-first. `next_before` is the cursor for the
+    next (older) page, or None when there is nothing older. limit=None means
+    every remaining row.
+    """
+    backend = get_backend()
+    refs = backend.user_order_refs(username)
+    if before is not None:
+        refs = refs[: bisect_left(refs, int(before))]
+    if limit is not None:
+        limit = max(0, int(limit))
+        page = refs[len(refs) - limit:] if limit else []
+    else:
+        page = refs
+    next_before = page[0] if page and len(page) < len(refs) else None
+    return backend.read_orders_at(page), next_before
+
+
+def iter_user_orders(username: str) -> Iterator[dict]:
+    """All rows for one user, oldest first (reads only that user's rows)."""
+    return iter(user_orders_page(username)[0])
 
 
 def save_orders(orders: List[dict]):
-    _write_json(ORDERS_FILE, orders)
+    """Replace the whole history (rare; use append_orders for new rows)."""
+    with _CACHE.lock("orders"):
+        get_backend().save_orders(orders)
+        _CACHE.written("orders")
 
 
 # -------------------------
@@ -113,16 +787,22 @@ def save_orders(orders: List[dict]):
 # -------------------------
 
 def load_drinks() -> List[dict]:
-    data = _read_json(DRINKS_FILE, default=[])
-    return data if isinstance(data, list) else []
+    """Drink catalog. With the read cache on, a shared read-only snapshot."""
+    if not STORAGE_CACHE:
+        return get_backend().load_drinks()
+    return _CACHE.get("drinks", get_backend().load_drinks)
+
+
+def drinks_stamp():
+    """Changes whenever the drink catalog changes."""
+    return _CACHE.stamp("drinks")
 
 
 def ensure_drinks_file():
     """Create drinks.json if missing/empty (starter list)."""
-    if DRINKS_FILE.exists():
-        raw = DRINKS_FILE.read_text(encoding="utf-8").strip()
-        if raw:
-            return
+    backend = get_backend()
+    if backend.has_drinks():
+        return
 
     starter = [
         {"id": "amber_storm", "name": "Amber Storm", "calories": 104, "ingredients": ["Coca-Cola", "Ginger Ale"]},
@@ -149,7 +829,9 @@ def ensure_drinks_file():
         {"id": "base_red_bull", "name": "Red Bull", "calories": 110},
     ]
 
-    _write_json(DRINKS_FILE, starter)
+    with _CACHE.lock("drinks"):
+        backend.save_drinks(starter)
+        _CACHE.written("drinks")
 
 
 # -------------------------
@@ -157,74 +839,115 @@ def ensure_drinks_file():
 # -------------------------
 
 def load_esp_queue() -> List[dict]:
-    data = _read_json(ESP_QUEUE_FILE, default=[])
-    return data if isinstance(data, list) else []
+    """Copy of every queue entry (any status), in queue order."""
+    return get_queue_engine().entries()
 
 
 def save_esp_queue(queue: List[dict]):
-    _write_json(ESP_QUEUE_FILE, queue)
+    get_queue_engine().replace(queue)
+
+
+def get_queue_entry(order_id: str) -> dict | None:
+    """Copy of one queue entry by id (any status), or None."""
+    return get_queue_engine().get(order_id)
+
+
+def enqueue_esp_orders(orders: List[dict]) -> List[dict | None]:
+    """Append several queue entries in ONE write (e.g. every unit of a checkout).
+
+    Returns queue_position()-style info for each new entry, in the same order
+    (None for an entry that isn't Pending/In Progress).
+    """
+    orders = [o for o in orders if isinstance(o, dict)]
+    for o in orders:
+        # Store estimation fields once at enqueue-time (used for UI + queue ETA)
+        if "estSeconds" not in o:
+            o["estSeconds"] = estimate_order_seconds(o)
+    if not orders:
+        return []
+    return get_queue_engine().enqueue(orders)
 
 
 def enqueue_esp_order(order: dict):
-    # Store estimation fields once at enqueue-time (used for UI + queue ETA)
-    if "estSeconds" not in order:
-        order["estSeconds"] = estimate_order_seconds(order)
-    queue = load_esp_queue()
-    queue.append(order)
-    save_esp_queue(queue)
+    enqueue_esp_orders([order])
 
 
 def claim_next_Pending_order() -> dict | None:
     """Return the oldest Pending order and mark it In Progress."""
-    queue = load_esp_queue()
-    for o in queue:
-        if o.get("status") == "Pending":
-            o["status"] = "In Progress"
-            save_esp_queue(queue)
-            return o
-    return None
+    return get_queue_engine().claim_next_pending()
 
 
 def mark_order_complete(order_id: str) -> bool:
-    queue = load_esp_queue()
-    for o in queue:
-        if o.get("id") == order_id:
-            o["status"] = "complete"
-            save_esp_queue(queue)
-            return True
-    return False
+    return get_queue_engine().mark_complete(order_id)
 
 
 def load_esp_done() -> List[dict]:
-    data = _read_json(ESP_DONE_FILE, default=[])
-    return data if isinstance(data, list) else []
+    """Every archived (completed) order. Prefer iter_esp_done() with a range."""
+    return get_backend().load_esp_done()
+
+
+def iter_esp_done(start=None, end=None) -> Iterator[dict]:
+    """Archived orders completed in [start, end) -- datetimes, dates or ISO strings,
+    either bound optional. Only the archive segments overlapping the range are read.
+    """
+    return get_backend().iter_esp_done(start, end)
 
 
 def save_esp_done(done: List[dict]):
-    _write_json(ESP_DONE_FILE, done)
+    get_backend().save_esp_done(done)
 
 
-def get_active_order_for_esp() -> dict | None:
+def get_active_order_for_esp(device: str = ESP_DEFAULT_DEVICE) -> dict | None:
+    """
+    Returns this device's current In Progress order if one exists.
+    Otherwise, claims the oldest Pending order for it by marking it In Progress,
+    so devices sharing the queue never get the same unit.
     """
-    Returns the current In Progress order if one exists.
-    Otherwise, claims the oldest Pending order by marking it In Progress.
+    return get_queue_engine().active_order(device)
+
+
+def dispatch_esp_units(device: str = ESP_DEFAULT_DEVICE, limit: int = 1) -> tuple:
+    """Up to `limit` units for this device, in pouring order: the ones it already
+    holds, topped up with fresh claims (batch dispatch, see /api/esp/next?batch=N).
+
+    Returns (units, queue_position() info of the first unit or None, the
+    queue version they reflect), taken from one look at the queue with a
+    single write.
+    """
+    return get_queue_engine().dispatch(device, limit)
+
+
+def heartbeat_esp_order(order_id: str, device: str = ESP_DEFAULT_DEVICE) -> dict | None:
+    """Extend the device's lease on the unit it is pouring.
+
+    Returns the updated entry, or None if the unit is not In Progress for this
+    device (e.g. its lease already expired and it went back to Pending).
     """
-    queue = load_esp_queue()
-    for o in queue:
-        if o.get("status") == "In Progress":
-            return o
-    for o in queue:
-        if o.get("status") == "Pending":
-            o["status"] = "In Progress"
-            # Add startedAt for remaining-time estimation
-            o.setdefault("startedAt", _utc_now_iso())
-            o.setdefault("estSeconds", estimate_order_seconds(o))
-            save_esp_queue(queue)
-            return o
-    return None
-
-
-def complete_and_archive_order(order_id: str) -> bool:
+    return get_queue_engine().heartbeat(order_id, device)
+
+
+def requeue_expired_claims() -> List[dict]:
+    """Return In Progress units with an expired lease to Pending (see the reaper in main.py)."""
+    return get_queue_engine().requeue_expired()
+
+
+def touch_esp_device(device: str):
+    """Record that a dispenser is alive: it counts as online for queue ETAs
+    and the units it holds get their leases renewed."""
+    get_queue_engine().keep_alive(device)
+
+
+def online_esp_devices() -> List[str]:
+    """Dispensers currently sharing the queue (polled recently or pouring)."""
+    return get_queue_engine().online_devices()
+
+
+def compact_idle_queue() -> bool:
+    """Fold the queue journal into esp_queue.json if it has been idle a while."""
+    return get_queue_engine().compact_if_idle()
+
+
+def complete_and_archive_order(order_id: str, device: str | None = None) -> bool:
     """Advance a multi-item order OR complete it.
 
     ESP calls /api/esp/complete after finishing ONE drink unit.
@@ -232,56 +955,33 @@ def complete_and_archive_order(order_id: str) -> bool:
     Behavior:
       - If the active order still has remaining items/quantity, we decrement the first item's quantity
         (or pop it) and KEEP the order in the queue as In Progress.
-      - If nothing remains, we mark the order complete, remove it from the queue,
-        and archive into esp_done.json.
+      - If nothing remains, we mark the order complete (stamping completedAt),
+        remove it from the queue, and append it to the completed-order archive.
+
+    With a `device`, only a unit that device is pouring (In Progress and
+    claimed by it) is completed.
 
     Returns True if the order id was found (advanced or completed).
     """
-    queue = load_esp_queue()
-    for idx, o in enumerate(queue):
-        if str(o.get("id")) != str(order_id):
-            continue
+    return get_queue_engine().complete_unit(order_id, device)
 
-        # Normalize items list
-        items = o.get("items") or []
-        if not isinstance(items, list):
-            items = []
 
-        # If there are remaining items, consume ONE drink unit
-        if items:
-            first = items[0] if isinstance(items[0], dict) else {}
-            try:
-                qty = int(first.get("quantity", 1))
-            except Exception:
-                qty = 1
-
-            if qty > 1:
-                first["quantity"] = qty - 1
-                items[0] = first
-            else:
-                # qty <= 1 => remove this item
-                items.pop(0)
-
-            # If items still remain, keep order active and reset timing estimation
-            if items:
-                o["items"] = items
-                o["status"] = "In Progress"
-                o["startedAt"] = _utc_now_iso()
-                o["estSeconds"] = estimate_order_seconds(o)
-                save_esp_queue(queue)
-                return True
-
-        # Otherwise (no items left) => fully complete + archive
-        o["status"] = "complete"
-        done = load_esp_done()
-        done.append(o)
-        save_esp_done(done)
-        queue.pop(idx)
-        save_esp_queue(queue)
-        return True
+def complete_esp_units(order_ids: Iterable[str], device: str | None = None, guard=None) -> tuple:
+    """complete_and_archive_order() for several units in one queue write
+    (ids may repeat for multi-drink orders).
+
+    With a `device`, refused unless that device is pouring every unit.
+    `guard(entries)` sees the current entries for `order_ids` (None if unknown;
+    read only) in the same critical section and may refuse by returning an
+    error payload. Returns (refusal or None, [found per id]).
+    """
+    return get_queue_engine().complete_units(order_ids, device, guard)
 
-    return False
 
+def complete_and_dispatch_esp(order_id: str, device: str = ESP_DEFAULT_DEVICE, limit: int = 1, guard=None) -> tuple:
+    """complete_esp_units([order_id]) + dispatch_esp_units(device, limit) as one
+    queue transaction: (refusal, found, units, info)."""
+    return get_queue_engine().complete_and_dispatch(order_id, device, limit, guard)
 
 
 def queue_position(order_id: str) -> dict | None:
@@ -290,27 +990,73 @@ def queue_position(order_id: str) -> dict | None:
     Position counts only active (Pending/In Progress) orders.
     position is 1-based.
     """
-    q = load_esp_queue()
-    active = [o for o in q if o.get("status") in ("Pending", "In Progress")]
-
-    for i, o in enumerate(active):
-        if str(o.get("id")) == str(order_id):
-            # Seconds remaining for all orders ahead
-            ahead_orders = active[:i]
-            ahead_remaining = sum((_remaining_seconds_for_order(x) + int(ESP_PREP_SECONDS)) for x in ahead_orders)
-            this_remaining = _remaining_seconds_for_order(o)
-            this_est = int(o.get('estSeconds') or estimate_order_seconds(o))
-
-            # ETA until *completion* of this order
-            eta_to_complete = int(ahead_remaining + this_remaining)
-
-            return {
-                "position": i + 1,
-                "ahead": i,
-                "status": o.get("status"),
-                "etaSeconds": eta_to_complete,
-                "etaAheadSeconds": int(ahead_remaining),
-                "etaThisSeconds": int(this_remaining),
-                "estSeconds": int(this_est),
-            }
-    return None
\ No newline at end of file
+    return get_queue_engine().position(order_id)
+
+
+def queue_snapshot() -> List[tuple]:
+    """All active (Pending/In Progress) entries in queue order, each paired with
+    its queue_position() info: [(entry, info), ...].
+
+    One pass with a running sum of remaining seconds, so answering N orders
+    costs O(n) rather than N separate queue_position() calls.
+    """
+    return get_queue_engine().snapshot()
+
+
+def queue_positions(order_ids: Iterable[str]) -> Dict[str, dict]:
+    """queue_position() for several orders at once: {order_id: info}.
+
+    Orders no longer in the active queue are simply absent.
+    """
+    return get_queue_engine().positions(order_ids)
+
+
+def eta_model_stats() -> Dict[str, dict]:
+    """Learned unit seconds per drinkId (empty when ETA_LEARNING is off)."""
+    model = get_eta_model()
+    return model.stats() if model is not None else {}
+
+
+def queue_version() -> int:
+    """Counter bumped on every queue change (enqueue, claim, complete, replace).
+
+    Takes the engine lock (it notices hand edits of the queue file): call it
+    from a worker thread, not the event loop.
+    """
+    return get_queue_engine().version_state()[0]
+
+
+def queue_etag(scope: str = "", version: int | None = None, ticking: bool = True) -> str:
+    """Weak ETag for a response computed from the queue.
+
+    Built from queue_version() (or `version`, the one the caller computed
+    the response at) plus `scope` (whatever else the response depends on, e.g. the
+    username). With `ticking`, while a unit is pouring the tag also changes
+    every QUEUE_ETAG_TICK_SEC, because remaining times count down.
+    """
+    if version is None or ticking:
+        current, pouring = get_queue_engine().version_state()
+        version = current if version is None else version
+    else:
+        pouring = False  # nothing to look up: no engine lock, safe on the event loop
+    tag = f"q{version}"
+    if ticking and pouring:
+        tag += f".{int(time.time()) // max(1, QUEUE_ETAG_TICK_SEC)}"
+    if scope:
+        tag += "-" + format(zlib.crc32(scope.encode("utf-8")), "x")
+    return f'W/"{tag}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """True if an If-None-Match header value covers `etag` (weak comparison)."""
+    if not if_none_match:
+        return False
+    strip = lambda t: t.strip().removeprefix("W/")
+    return any(t.strip() == "*" or strip(t) == strip(etag) for t in if_none_match.split(","))
+
+
+async def wait_for_queue_change(since: int, timeout: float) -> int:
+    """Wait (without holding a worker thread) until queue_version() != since,
+    or `timeout` seconds pass. Returns the current version.
+    """
+    return await get_queue_engine().signal.wait(since, timeout)
@@ -0,0 +1,144 @@
+"""Compact binary wire format for the ESP endpoints.
+
+A device that sends `Accept: application/x-msgpack` gets the response as
+MessagePack with short field ids (ESP_FIELDS) instead of JSON: ArduinoJson
+parses it natively (deserializeMsgPack) and the poll answer shrinks to
+roughly a third. JSON stays the default.
+
+Keys stay (short) strings because ArduinoJson only reads string map keys.
+The encoder is a small pure-Python MessagePack writer covering the types our
+payloads use, so the server needs no extra dependency.
+"""
+from __future__ import annotations
+
+import struct
+
+MSGPACK_TYPES = ("application/x-msgpack", "application/msgpack", "application/vnd.msgpack")
+MSGPACK_MEDIA_TYPE = MSGPACK_TYPES[0]
+
+# JSON field name -> short id (fields not listed keep their name)
+ESP_FIELDS = {
+    "ok": "ok",
+    "order": "o",
+    "jobs": "j",
+    "next": "nx",
+    "completed": "c",
+    "notFound": "nf",
+    "error": "er",
+    "waitSeconds": "w",
+    "id": "i",
+    "device": "dv",
+    "drinkId": "d",
+    "drinkName": "n",
+    "quantity": "q",
+    "remainingItems": "r",
+    "etaSeconds": "e",
+    "queuePosition": "p",
+    "queueAhead": "a",
+    "queueEtaSeconds": "qe",
+    "stepSeconds": "s",
+    "prepSeconds": "pp",
+    "leaseSeconds": "l",
+    "leaseUntil": "lu",
+}
+
+
+def wants_msgpack(accept: str | None) -> bool:
+    """True if an Accept header asks for MessagePack (JSON otherwise)."""
+    if not accept:
+        return False
+    return any(part.split(";")[0].strip().lower() in MSGPACK_TYPES for part in accept.split(","))
+
+
+def shorten(obj, fields: dict = ESP_FIELDS):
+    """Copy of `obj` with dict keys replaced by their short ids."""
+    if isinstance(obj, dict):
+        return {fields.get(k, k): shorten(v, fields) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [shorten(v, fields) for v in obj]
+    return obj
+
+
+def packb(obj) -> bytes:
+    """Encode `obj` (None/bool/int/float/str/bytes/list/dict) as MessagePack."""
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _pack(obj, out: bytearray):
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        _pack_int(obj, out)
+    elif isinstance(obj, float):
+        out += b"\xcb" + struct.pack(">d", obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        n = len(data)
+        if n < 32:
+            out.append(0xA0 | n)
+        elif n <= 0xFF:
+            out += b"\xd9" + struct.pack(">B", n)
+        elif n <= 0xFFFF:
+            out += b"\xda" + struct.pack(">H", n)
+        else:
+            out += b"\xdb" + struct.pack(">I", n)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        n = len(obj)
+        if n <= 0xFF:
+            out += b"\xc4" + struct.pack(">B", n)
+        elif n <= 0xFFFF:
+            out += b"\xc5" + struct.pack(">H", n)
+        else:
+            out += b"\xc6" + struct.pack(">I", n)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n <= 0xFFFF:
+            out += b"\xdc" + struct.pack(">H", n)
+        else:
+            out += b"\xdd" + struct.pack(">I", n)
+        for v in obj:
+            _pack(v, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n <= 0xFFFF:
+            out += b"\xde" + struct.pack(">H", n)
+        else:
+            out += b"\xdf" + struct.pack(">I", n)
+        for k, v in obj.items():
+            _pack(k if isinstance(k, str) else str(k), out)
+            _pack(v, out)
+    else:
+        _pack(str(obj), out)
+
+
+def _pack_int(n: int, out: bytearray):
+    if 0 <= n < 0x80:
+        out.append(n)
+    elif -32 <= n < 0:
+        out.append(n & 0xFF)
+    elif n >= 0:
+        for tag, fmt, hi in ((0xCC, ">B", 0xFF), (0xCD, ">H", 0xFFFF), (0xCE, ">I", 0xFFFFFFFF)):
+            if n <= hi:
+                out.append(tag)
+                out += struct.pack(fmt, n)
+                return
+        out += b"\xcf" + struct.pack(">Q", n)
+    else:
+        for tag, fmt, lo in ((0xD0, ">b", -0x80), (0xD1, ">h", -0x8000), (0xD2, ">i", -0x80000000)):
+            if n >= lo:
+                out.append(tag)
+                out += struct.pack(fmt, n)
+                return
+        out += b"\xd3" + struct.pack(">q", n)
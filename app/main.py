@@ -1,10 +1,15 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 
-from app.config import SESSION_SECRET, STATIC_DIR
+from app.config import SESSION_SECRET, STATIC_DIR, ESP_REAPER_INTERVAL_SEC
 from app.core.auth import init_default_admin
-from app.core.storage import ensure_drinks_file
+from app.core.storage import compact_idle_queue, ensure_drinks_file, migrate_orders_json, requeue_expired_claims
+from app.ml.user_matrix import get_user_matrix
 
 from app.routers.auth_routes import router as auth_router
 from app.routers.pages_routes import router as pages_router
@@ -14,8 +19,29 @@ from app.routers.recommend_routes import router as recommend_router
 from app.routers.esp_routes import router as esp_router
 
 
+async def _lease_reaper():
+    """Every ESP_REAPER_INTERVAL_SEC: requeue units whose device stopped heartbeating
+    and fold an idle queue journal into esp_queue.json."""
+    while True:
+        await asyncio.sleep(ESP_REAPER_INTERVAL_SEC)
+        try:
+            await run_in_threadpool(requeue_expired_claims)
+            await run_in_threadpool(compact_idle_queue)
+        except Exception:
+            pass  # keep reaping; a bad tick shouldn't kill the task
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    reaper = asyncio.create_task(_lease_reaper())
+    try:
+        yield
+    finally:
+        reaper.cancel()
+
+
 def create_app() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     # sessions
     app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET)
@@ -26,7 +52,9 @@ def create_app() -> FastAPI:
 
     # data init
     ensure_drinks_file()
+    migrate_orders_json()  # one-shot: orders.json -> orders.jsonl
     init_default_admin()  # admin / 1234
+    get_user_matrix()  # one scan of the order log; checkouts keep it current
 
     # routers
     app.include_router(auth_router)
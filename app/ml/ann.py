@@ -0,0 +1,197 @@
+"""Approximate similar-user search: random-projection LSH (SimHash) for cosine.
+
+Every table hashes a user's drink-count vector to `bits` sign bits, one per
+random hyperplane. Two users share a bucket with probability
+(1 - angle / pi) ** bits, so close neighbours collide often and unrelated
+users rarely. A query takes the union of the target's buckets over all
+tables and ranks only those candidates by exact cosine. More tables raise
+recall; more bits shrink the buckets (faster, lower recall). benchmark()
+measures both against the exact scan; `python -m app.ml.ann` prints it for
+the live order history (or, with --synthetic N, for N made-up users).
+
+Hyperplane coordinates are drawn per drinkId from a seeded RNG, so a new
+drink needs no rebuild and signatures are the same after a restart.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from typing import Dict, Iterable, List, Set
+
+
+class CosineLSH:
+    def __init__(self, tables: int = 8, bits: int = 10, seed: int = 0):
+        self.tables = max(1, int(tables))
+        self.bits = max(1, int(bits))
+        self.seed = seed
+        self._planes: Dict[str, List[float]] = {}  # drinkId -> coordinate in every hyperplane
+        self._keys: Dict[str, tuple] = {}          # user -> bucket key per table
+        self._buckets: List[Dict[int, Set[str]]] = [{} for _ in range(self.tables)]
+
+    def _plane(self, drink_id: str) -> List[float]:
+        plane = self._planes.get(drink_id)
+        if plane is None:
+            rnd = random.Random(f"{self.seed}:{drink_id}")
+            plane = self._planes[drink_id] = [rnd.gauss(0.0, 1.0) for _ in range(self.tables * self.bits)]
+        return plane
+
+    def signature(self, vec: Dict[str, int]) -> tuple:
+        """Bucket key of a drinkId -> count vector in each table."""
+        proj = [0.0] * (self.tables * self.bits)
+        for did, cnt in vec.items():
+            proj = [p + cnt * h for p, h in zip(proj, self._plane(did))]
+        keys = []
+        for t in range(self.tables):
+            key = 0
+            for p in proj[t * self.bits:(t + 1) * self.bits]:
+                key = (key << 1) | (p > 0.0)
+            keys.append(key)
+        return tuple(keys)
+
+    def update(self, user: str, vec: Dict[str, int]):
+        """(Re)index one user after their vector changed."""
+        new = self.signature(vec)
+        old = self._keys.get(user)
+        if old == new:
+            return
+        if old is not None:
+            for buckets, key in zip(self._buckets, old):
+                members = buckets.get(key)
+                if members is not None:
+                    members.discard(user)
+                    if not members:
+                        del buckets[key]
+        for buckets, key in zip(self._buckets, new):
+            buckets.setdefault(key, set()).add(user)
+        self._keys[user] = new
+
+    def fit(self, rows: Dict[str, Dict[str, int]]):
+        for user, vec in rows.items():
+            self.update(user, vec)
+
+    def fit_dense(self, users: List[str], dense, drink_ids: List[str]):
+        """fit() from a NumPy users x drinks count array (column j = drink_ids[j]):
+        every signature in one matrix product."""
+        import numpy as np
+
+        if not users:
+            return
+        planes = np.array([self._plane(did) for did in drink_ids]).reshape(len(drink_ids), -1)
+        signs = (dense @ planes > 0.0).reshape(len(users), self.tables, self.bits)
+        keys = (signs * (1 << np.arange(self.bits - 1, -1, -1))).sum(axis=2)
+        for user, row in zip(users, keys.tolist()):
+            self._keys[user] = key = tuple(row)
+            for buckets, k in zip(self._buckets, key):
+                buckets.setdefault(k, set()).add(user)
+
+    def candidates(self, user: str) -> Set[str]:
+        """Users sharing at least one bucket with `user` (not `user` itself)."""
+        out: Set[str] = set()
+        for buckets, key in zip(self._buckets, self._keys.get(user, ())):
+            out |= buckets.get(key, set())
+        out.discard(user)
+        return out
+
+
+def benchmark(
+    matrix=None,
+    configs: Iterable[tuple] = ((4, 8), (8, 8), (8, 10), (16, 10), (16, 12), (24, 12)),
+    sample: int = 200,
+    limit: int = 25,
+    seed: int = 0,
+) -> dict:
+    """Recall@limit and latency of LSH (tables, bits) configs vs the exact search.
+
+    Runs on a private copy of `matrix` (default: the live user matrix), so
+    recommendations aren't blocked meanwhile. Recall is the share of the exact
+    top-`limit` neighbours the index finds, averaged over `sample` users.
+    """
+    from app.ml.user_matrix import UserDrinkMatrix, get_user_matrix
+
+    live = matrix if matrix is not None else get_user_matrix()
+    copy = UserDrinkMatrix(live.use_numpy, ann_min_users=0)
+    with live.lock:
+        for user, vec in live.rows.items():
+            for did, cnt in vec.items():
+                copy._add({"username": user, "drinkId": did, "quantity": cnt})
+    users = list(copy.rows)
+    users = random.Random(seed).sample(users, min(int(sample), len(users)))
+    if not users:
+        return {"users": 0, "sample": 0, "exact": None, "configs": []}
+
+    t0 = time.perf_counter()
+    exact = {u: {other for other, _ in copy.similar_users_exact(u, limit)} for u in users}
+    exact_ms = (time.perf_counter() - t0) * 1000.0 / len(users)
+
+    results = []
+    for tables, bits in configs:
+        t0 = time.perf_counter()
+        copy._ann = index = copy.build_ann(tables, bits, seed)
+        build_ms = (time.perf_counter() - t0) * 1000.0
+        found = wanted = candidates = 0
+        t0 = time.perf_counter()
+        for u in users:
+            approx = {other for other, _ in copy.similar_users_ann(u, limit)}
+            found += len(approx & exact[u])
+            wanted += len(exact[u])
+        query_ms = (time.perf_counter() - t0) * 1000.0 / len(users)
+        for u in users:
+            candidates += len(index.candidates(u))
+        results.append({
+            "tables": index.tables,
+            "bits": index.bits,
+            "recall": round(found / wanted, 4) if wanted else 1.0,
+            "msPerQuery": round(query_ms, 3),
+            "speedup": round(exact_ms / query_ms, 2) if query_ms else None,
+            "avgCandidates": round(candidates / len(users), 1),
+            "buildMs": round(build_ms, 1),
+        })
+    return {
+        "users": len(copy.rows),
+        "sample": len(users),
+        "exact": {"engine": copy.engine, "msPerQuery": round(exact_ms, 3)},
+        "configs": results,
+    }
+
+
+def synthetic_matrix(users: int, drinks: int = 40, tastes: int = 30, seed: int = 0):
+    """A UserDrinkMatrix of `users` made-up accounts in `tastes` groups, each
+    ordering mostly from its group's handful of drinks (so there are real
+    neighbours to find). Not tied to the order log."""
+    from app.ml.user_matrix import UserDrinkMatrix
+
+    rnd = random.Random(seed)
+    menu = [f"d{i}" for i in range(max(1, int(drinks)))]
+    groups = [rnd.sample(menu, min(6, len(menu))) for _ in range(max(1, int(tastes)))]
+    matrix = UserDrinkMatrix(ann_min_users=0)
+    for u in range(int(users)):
+        favourites = groups[u % len(groups)]
+        for _ in range(rnd.randint(2, 15)):
+            did = rnd.choice(favourites) if rnd.random() < 0.8 else rnd.choice(menu)
+            matrix._add({"username": f"u{u}", "drinkId": did, "quantity": 1})
+    return matrix
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m app.ml.ann", description="LSH recall/latency vs the exact similar-user search.")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="benchmark N made-up users instead of the order history")
+    parser.add_argument("--sample", type=int, default=200, help="query users (default 200)")
+    parser.add_argument("--limit", type=int, default=25, help="neighbours per query (default 25)")
+    args = parser.parse_args(argv)
+
+    matrix = synthetic_matrix(args.synthetic) if args.synthetic else None
+    result = benchmark(matrix, sample=args.sample, limit=args.limit)
+    exact = result["exact"]
+    print(f"{result['users']} users, {result['sample']} queries, top {args.limit}")
+    if exact is None:
+        return
+    print(f"exact ({exact['engine']}): {exact['msPerQuery']} ms/query")
+    print("tables bits  recall  ms/query  speedup  candidates  build ms")
+    for c in result["configs"]:
+        speedup = f"{c['speedup']:.2f}x" if c["speedup"] else "-"
+        print(f"{c['tables']:>6} {c['bits']:>4}  {c['recall']:>6.3f}  {c['msPerQuery']:>8.3f}  {speedup:>7}  {c['avgCandidates']:>10.1f}  {c['buildMs']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Item-item similarity: "people who ordered X also ordered Y".
+
+co[a][b] is the dot product of drinks a and b as columns of the user x drink
+count matrix (sum over users of count(a) * count(b)); co[a][a] is a's squared
+column norm, so sim(a, b) = co[a][b] / sqrt(co[a][a] * co[b][b]) is the
+cosine between the two drinks' buyers. When one user's count of drink d goes
+from old to new, only co[d][x] for the drinks x in that user's history move
+(by (new - old) * count(x)), so UserDrinkMatrix keeps the table current in
+O(user history) per history row.
+
+Scoring a user sums count(h) * sim(h, x) over each drink h in their history
+and its top neighbours x: O(history x neighbours), however many users there
+are, and the list moves only when the co-occurrence counts do.
+"""
+from __future__ import annotations
+
+from collections import Counter
+from math import sqrt
+from typing import Dict, List, Tuple
+
+
+class ItemSimilarity:
+    def __init__(self):
+        self.co: Dict[str, Dict[str, int]] = {}
+        self._top: Dict[str, List[Tuple[str, float]]] = {}  # drinkId -> neighbours, best first (cache)
+
+    def add(self, vec: Dict[str, int], did: str, old: int, new: int):
+        """One user went from `old` to `new` units of `did`; `vec` is their
+        history before the change."""
+        delta = new - old
+        row = self.co.setdefault(did, {})
+        for x, cx in vec.items():
+            if x == did:
+                continue
+            row[x] = row.get(x, 0) + delta * cx
+            self.co.setdefault(x, {})[did] = row[x]
+        row[did] = row.get(did, 0) + new * new - old * old
+        # did's norm changed, so did every similarity involving it
+        self._top.pop(did, None)
+        for x in row:
+            self._top.pop(x, None)
+
+    def similarity(self, a: str, b: str) -> float:
+        row = self.co.get(str(a))
+        if not row or str(a) == str(b):
+            return 0.0
+        dot = row.get(str(b), 0)
+        if dot <= 0:
+            return 0.0
+        return dot / sqrt(row[str(a)] * self.co[str(b)][str(b)])
+
+    def neighbours(self, drink_id: str, limit: int | None = None) -> List[Tuple[str, float]]:
+        """Drinks ordered by the same users as `drink_id`, most similar first."""
+        did = str(drink_id)
+        top = self._top.get(did)
+        if top is None:
+            sims = [(x, self.similarity(did, x)) for x in self.co.get(did, ())]
+            top = self._top[did] = sorted((x for x in sims if x[1] > 0), key=lambda x: -x[1])
+        return top if limit is None else top[: max(0, int(limit))]
+
+    def score(self, vec: Dict[str, int], neighbours: int) -> Counter:
+        """Untried drinks for a user with history `vec`, scored by item similarity."""
+        scores: Counter = Counter()
+        for h, cnt in vec.items():
+            for x, s in self.neighbours(h, neighbours):
+                if x not in vec:
+                    scores[x] += s * float(cnt)
+        return scores
@@ -1,35 +1,30 @@
 from __future__ import annotations
 
-from collections import Counter, defaultdict
-from math import sqrt
-from typing import Dict, List, Tuple
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List
 
-from app.core.storage import load_orders, load_drinks
+from app.config import RECOMMEND_CACHE_SIZE, RECOMMEND_CACHE_TTL_SEC, RECOMMENDER_CF, RECOMMENDER_ITEM_NEIGHBOURS
+from app.core.storage import _freeze, drinks_stamp, load_drinks
+from app.ml.user_matrix import get_user_matrix
 
 
 def _format_ing(ing: str) -> str:
     return str(ing).replace("_", " ").strip()
 
 def _user_ing_counts(username: str, drink_by_id: Dict[str, dict]) -> Counter:
-    orders = load_orders()
+    matrix = get_user_matrix()
+    with matrix.lock:
+        drink_counts = dict(matrix.rows.get(str(username)) or {})
     c: Counter = Counter()
-    for o in orders:
-        if str(o.get("username")) != str(username):
-            continue
-        did = o.get("drinkId")
-        if did is None:
-            continue
-        d = drink_by_id.get(str(did))
+    for did, qty in drink_counts.items():
+        d = drink_by_id.get(did)
         if not d:
             continue
         ings = d.get("ingredients") if isinstance(d, dict) else None
         if not isinstance(ings, list):
             continue
-        try:
-            qty = int(o.get("quantity", 1))
-        except Exception:
-            qty = 1
-        qty = max(1, qty)
         for ing in ings:
             if ing:
                 c[str(ing)] += qty
@@ -69,56 +64,86 @@ def _attach_why(recs: List[dict], username: str, drink_by_id: Dict[str, dict], m
     return out
 
 
-def _cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
-    """Cosine similarity of sparse vectors."""
-    if not a or not b:
-        return 0.0
-    dot = 0.0
-    for k, av in a.items():
-        bv = b.get(k)
-        if bv is not None:
-            dot += av * bv
-    na = sqrt(sum(v * v for v in a.values()))
-    nb = sqrt(sum(v * v for v in b.values()))
-    if na == 0.0 or nb == 0.0:
-        return 0.0
-    return dot / (na * nb)
-
-
-def _build_user_vectors() -> Tuple[Dict[str, Dict[str, float]], Counter]:
-    """Returns (user->drinkId->count, global_drink_counts)."""
-    orders = load_orders()
-    user_vec: Dict[str, Counter] = defaultdict(Counter)
-    global_counts: Counter = Counter()
-
-    for o in orders:
-        username = o.get("username")
-        drink_id = o.get("drinkId")
-        qty = o.get("quantity", 1)
+class _ResultCache:
+    """Bounded LRU of recommendation lists, keyed by (kind, username, mood, k).
 
-        if not username or not drink_id:
-            continue
+    Each entry keeps the version it was computed at: the user's history
+    version in the user matrix (moves when they check out or the matrix is
+    rebuilt from the log) plus the catalog stamp. A lookup at a different
+    version, or older than the TTL, recomputes.
 
-        try:
-            qty = int(qty)
-        except Exception:
-            qty = 1
+    Results are shared by every caller, so they are frozen like the storage
+    read cache's snapshots: copy one (dict(...)) before changing it.
+    """
 
-        if qty < 1:
-            qty = 1
+    def __init__(self, size: int, ttl: float):
+        self.size = max(0, int(size))
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> (version, computed at, result)
+        self.hits = self.misses = self.invalidated = self.expired = self.evicted = 0
+
+    def get(self, key: tuple, username: str, compute) -> List[dict]:
+        if not self.size:
+            return compute()
+        version = (get_user_matrix().version(username), drinks_stamp())
+        now = time.monotonic()
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and (self.ttl <= 0 or now - entry[1] < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            if entry is not None:
+                if entry[0] != version:
+                    self.invalidated += 1
+                else:
+                    self.expired += 1
+        result = _freeze(compute())
+        with self.lock:
+            self._entries[key] = (version, now, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / total, 4) if total else 0.0,
+                "invalidated": self.invalidated,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+_RESULTS = _ResultCache(RECOMMEND_CACHE_SIZE, RECOMMEND_CACHE_TTL_SEC)
+
+
+def recommendation_cache_stats() -> dict:
+    """Hit/miss counters of the recommendation result cache."""
+    return _RESULTS.stats()
 
-        did = str(drink_id)
-        user_vec[str(username)][did] += qty
-        global_counts[did] += qty
 
-    return ({u: dict(c) for u, c in user_vec.items()}, global_counts)
+def recommend_for_user(username: str, k: int = 5) -> List[dict]:
+    """recommend_for_user() via the result cache (see _recommend_for_user)."""
+    return _RESULTS.get(("user", str(username), None, int(k)), str(username), lambda: _recommend_for_user(username, k))
 
 
-def recommend_for_user(username: str, k: int = 5) -> List[dict]:
+def _recommend_for_user(username: str, k: int = 5) -> List[dict]:
     """
     Collaborative filtering-ish recommender.
 
-    - If user has history: find similar users (cosine) and score drinks they like.
+    - If user has history: find similar users (cosine) and score drinks they
+      like (RECOMMENDER_CF="user", default), or score untried drinks by
+      item-item similarity to the ones they order (RECOMMENDER_CF="item").
     - If not: return globally popular drinks.
 
     Returns list of drink dicts (id, name, calories).
@@ -130,17 +155,31 @@ def recommend_for_user(username: str, k: int = 5) -> List[dict]:
         if isinstance(d, dict) and d.get("id") is not None
     }
 
-    user_vectors, global_counts = _build_user_vectors()
-    target = user_vectors.get(str(username), {})
+    matrix = get_user_matrix()
+    with matrix.lock:
+        target = dict(matrix.rows.get(str(username)) or {})
+        popular_ids = [did for did, _ in matrix.global_counts.most_common()]
+
+        if RECOMMENDER_CF == "item":
+            # --- Drinks ordered by the same people as this user's drinks ---
+            scores = matrix.items.score(target, RECOMMENDER_ITEM_NEIGHBOURS)
+        else:
+            # --- Find similar users, score the drinks they like ---
+            scores: Counter = Counter()
+            for other, s in matrix.similar_users(str(username), limit=25):
+                for did, cnt in matrix.rows[other].items():
+                    if did in target:
+                        continue
+                    scores[did] += s * float(cnt)
 
     def popular(exclude: set[str]) -> List[str]:
-        return [did for did, _ in global_counts.most_common() if did not in exclude]
+        return [did for did in popular_ids if did not in exclude]
 
     tried = set(target.keys())
 
     # --- Cold start: no history for this user ---
     if not target:
-        ids = popular(exclude=set()) if global_counts else [str(d.get("id")) for d in drinks if d.get("id") is not None]
+        ids = popular(exclude=set()) if popular_ids else [str(d.get("id")) for d in drinks if d.get("id") is not None]
         out: List[dict] = []
         for did in ids:
             d = drink_by_id.get(str(did))
@@ -150,27 +189,6 @@ def recommend_for_user(username: str, k: int = 5) -> List[dict]:
                 break
         return _attach_why(out, username, drink_by_id, mood=None)
 
-    # --- Find similar users ---
-    sims: List[Tuple[str, float]] = []
-    for other, vec in user_vectors.items():
-        if other == str(username):
-            continue
-        s = _cosine(target, vec)
-        if s > 0:
-            sims.append((other, s))
-
-    sims.sort(key=lambda x: x[1], reverse=True)
-    sims = sims[:25]  # cap
-
-    # --- Score candidate drinks from similar users ---
-    scores: Counter = Counter()
-    for other, s in sims:
-        vec = user_vectors.get(other, {})
-        for did, cnt in vec.items():
-            if did in tried:
-                continue
-            scores[did] += s * float(cnt)
-
     ranked_ids = [did for did, _ in scores.most_common()]
 
     # If no similar-user signal, fallback to popularity excluding tried
@@ -190,6 +208,24 @@ def recommend_for_user(username: str, k: int = 5) -> List[dict]:
             break
 
     return out
+
+
+def also_ordered(drink_id: str, k: int = 4) -> List[dict]:
+    """"People also ordered": drinks most often ordered by the people who order `drink_id`."""
+    drink_by_id = {str(d.get("id")): d for d in load_drinks() if isinstance(d, dict) and d.get("id") is not None}
+    matrix = get_user_matrix()
+    with matrix.lock:
+        neighbours = matrix.items.neighbours(str(drink_id))
+    out: List[dict] = []
+    for did, _ in neighbours:
+        d = drink_by_id.get(did)
+        if d:
+            out.append(d)
+        if len(out) >= k:
+            break
+    return out
+
+
 # -------------------------
 # Mood-based logic (category rules from the UI)
 # -------------------------
@@ -262,6 +298,12 @@ def _jaccard(a: set[str], b: set[str]) -> float:
 
 
 def recommend_for_user_and_mood(username: str, mood: str, k: int = 3) -> List[dict]:
+    """recommend_for_user_and_mood() via the result cache (see _recommend_for_user_and_mood)."""
+    key = ("mood", str(username), (mood or "").strip().lower(), int(k))
+    return _RESULTS.get(key, str(username), lambda: _recommend_for_user_and_mood(username, mood, k))
+
+
+def _recommend_for_user_and_mood(username: str, mood: str, k: int = 3) -> List[dict]:
     """
     Ingredient + history recommender (matches the capstone demo story):
 
@@ -283,25 +325,11 @@ def recommend_for_user_and_mood(username: str, mood: str, k: int = 3) -> List[di
     drinks = load_drinks()
     drink_by_id = {str(d.get("id")): d for d in drinks if isinstance(d, dict) and d.get("id") is not None}
 
-    # --- Build user drink counts + ingredient counts ---
-    orders = load_orders()
-    user_drink_counts: Counter = Counter()
-    global_counts: Counter = Counter()
-    for o in orders:
-        did = o.get("drinkId")
-        if did is None:
-            continue
-        try:
-            qty = int(o.get("quantity", 1))
-        except Exception:
-            qty = 1
-        qty = max(1, qty)
-
-        did = str(did)
-        global_counts[did] += qty
-
-        if str(o.get("username")) == str(username):
-            user_drink_counts[did] += qty
+    # --- User drink counts + ingredient counts ---
+    matrix = get_user_matrix()
+    with matrix.lock:
+        user_drink_counts: Counter = Counter(matrix.rows.get(str(username)) or {})
+        global_counts: Counter = matrix.global_counts.copy()
 
     user_ing_counts = _user_ing_counts(username, drink_by_id)
     max_ing = max(user_ing_counts.values()) if user_ing_counts else 1
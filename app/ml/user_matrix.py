@@ -0,0 +1,253 @@
+"""User x drink count matrix for the collaborative recommender.
+
+rows[user][drinkId] is how many units of that drink the user has ordered.
+Next to it the matrix keeps its transpose (cols: drinkId -> user -> count,
+to find the users who share a drink), each user's vector norm and the global
+drink counts, so a recommendation never re-reads the order history.
+
+Built with one scan of the order log on first use, then kept current by a
+storage.append_orders() listener: a checkout costs O(items in it). If the log
+changes any other way (save_orders, an edit on disk, another process) the
+stamp stops matching and the next read rebuilds it.
+
+If NumPy is installed (and RECOMMENDER_NUMPY is on) the counts are mirrored
+into a dense users x drinks array, row = order of first appearance, column =
+interned drinkId, so similar_users() is one matrix-vector product plus an
+argpartition for the top N. Counts are integers, so both paths compute the
+exact same similarities and return the same ranking.
+
+From RECOMMENDER_ANN_MIN_USERS accounts on, similar_users() asks a
+random-projection LSH index (app/ml/ann.py) for candidate neighbours and
+ranks only those, instead of scanning every user. The index is built from
+the matrix the first time it's needed and updated per checkout.
+
+The matrix also maintains the item-item co-occurrence table
+(app/ml/item_model.py) that the drink page's "people also ordered" reads and
+that recommend_for_user() scores with when RECOMMENDER_CF=item.
+"""
+from __future__ import annotations
+
+import heapq
+import threading
+from collections import Counter
+from math import sqrt
+from typing import Dict, Iterable, List, Tuple
+
+from app.config import RECOMMENDER_ANN_BITS, RECOMMENDER_ANN_MIN_USERS, RECOMMENDER_ANN_TABLES, RECOMMENDER_NUMPY
+from app.ml.ann import CosineLSH
+from app.ml.item_model import ItemSimilarity
+from app.core.storage import add_orders_listener, orders_stamp, read_orders_stamped
+
+try:
+    import numpy as np
+except ImportError:  # optional; similar_users() falls back to pure Python
+    np = None
+
+_UNBUILT = object()
+
+# Everything refresh() swaps in from a rebuilt matrix
+_STATE = ("rows", "cols", "norms", "global_counts", "_sq", "_rank", "_users", "_col", "_dense", "_dense_norms", "_ann", "items")
+
+
+def _unit(row: dict) -> tuple | None:
+    """(username, drinkId, quantity) of a history row, or None if it doesn't count."""
+    username, drink_id = row.get("username"), row.get("drinkId")
+    if not username or not drink_id:
+        return None
+    try:
+        qty = int(row.get("quantity", 1))
+    except Exception:
+        qty = 1
+    return str(username), str(drink_id), max(1, qty)
+
+
+class UserDrinkMatrix:
+    def __init__(self, use_numpy: bool = RECOMMENDER_NUMPY, ann_min_users: int = RECOMMENDER_ANN_MIN_USERS):
+        # Readers hold `lock` while they look at rows/cols/norms/global_counts
+        self.lock = threading.Lock()
+        self.stamp = _UNBUILT
+        self.generation = 0  # bumped by every rebuild from the log
+        self._user_versions: Dict[str, int] = {}  # bumped when that user's row changes
+        self.use_numpy = bool(use_numpy) and np is not None
+        self.rows: Dict[str, Dict[str, int]] = {}
+        self.cols: Dict[str, Dict[str, int]] = {}
+        self.norms: Dict[str, float] = {}
+        self.global_counts: Counter = Counter()
+        self._sq: Dict[str, int] = {}
+        self._rank: Dict[str, int] = {}  # user -> first appearance in the log (tie order)
+        self._users: List[str] = []      # rank -> user
+        # NumPy mirror: _dense[rank, _col[drinkId]] = count, _dense_norms[rank] = norm
+        self._col: Dict[str, int] = {}
+        self._dense = np.zeros((64, 16)) if self.use_numpy else None
+        self._dense_norms = np.zeros(64) if self.use_numpy else None
+        self.ann_min_users = max(0, int(ann_min_users))  # 0 = always exact
+        self._ann: CosineLSH | None = None
+        self.items = ItemSimilarity()
+
+    @property
+    def engine(self) -> str:
+        return "numpy" if self.use_numpy else "python"
+
+    def _add(self, row: dict):
+        unit = _unit(row) if isinstance(row, dict) else None
+        if unit is None:
+            return
+        user, did, qty = unit
+        vec = self.rows.get(user)
+        if vec is None:
+            vec = self.rows[user] = {}
+            self._rank[user] = len(self._users)
+            self._users.append(user)
+        old = vec.get(did, 0)
+        new = old + qty
+        self.items.add(vec, did, old, new)
+        vec[did] = new
+        self.cols.setdefault(did, {})[user] = new
+        self._sq[user] = sq = self._sq.get(user, 0) + new * new - old * old
+        self.norms[user] = sqrt(sq)
+        self.global_counts[did] += qty
+        if self._dense is not None:
+            self._set_dense(self._rank[user], did, new, self.norms[user])
+
+    def _set_dense(self, r: int, did: str, count: int, norm: float):
+        c = self._col.get(did)
+        if c is None:
+            c = self._col[did] = len(self._col)
+        rows, cols = self._dense.shape
+        if r >= rows or c >= cols:
+            # Grow by doubling so updates stay amortized O(1)
+            grown = np.zeros((rows * 2 if r >= rows else rows, cols * 2 if c >= cols else cols))
+            grown[:rows, :cols] = self._dense
+            self._dense = grown
+            if r >= rows:
+                self._dense_norms = np.concatenate([self._dense_norms, np.zeros(rows)])
+        self._dense[r, c] = count
+        self._dense_norms[r] = norm
+
+    def fit(self, rows: Iterable[dict]):
+        for row in rows:
+            self._add(row)
+
+    def refresh(self):
+        """Rebuild from the log if it changed behind our back (or was never read)."""
+        if self.stamp == orders_stamp():
+            return
+        stamp, rows = read_orders_stamped()
+        fresh = UserDrinkMatrix(self.use_numpy, self.ann_min_users)
+        fresh.fit(rows)
+        with self.lock:
+            for name in _STATE:
+                setattr(self, name, getattr(fresh, name))
+            self.stamp = stamp
+            self.generation += 1
+
+    def on_append(self, before, after, rows: List[dict]):
+        """storage.append_orders() listener: fold a checkout's rows in."""
+        with self.lock:
+            if self.stamp != before:
+                return  # already stale; the next read rebuilds
+            for row in rows:
+                self._add(row)
+            self.stamp = after
+            for user in {unit[0] for unit in map(_unit, rows) if unit}:
+                self._user_versions[user] = self._user_versions.get(user, 0) + 1
+                if self._ann is not None:
+                    self._ann.update(user, self.rows[user])
+
+    def version(self, username: str) -> tuple:
+        """Changes whenever `username`'s history changes (or the matrix is rebuilt)."""
+        return self.generation, self._user_versions.get(str(username), 0)
+
+    def similar_users(self, username: str, limit: int = 25) -> List[Tuple[str, float]]:
+        """Users most cosine-similar to `username` (similarity > 0), best first,
+        ties in order of first appearance. Call with `lock` held."""
+        if self.ann_min_users and len(self._users) >= self.ann_min_users:
+            if self._ann is None:
+                self._ann = self.build_ann()
+            return self.similar_users_ann(username, limit)
+        return self.similar_users_exact(username, limit)
+
+    def similar_users_exact(self, username: str, limit: int = 25) -> List[Tuple[str, float]]:
+        """similar_users() by scanning every user who shares a drink."""
+        target = self.rows.get(str(username))
+        if not target or limit <= 0:
+            return []
+        if self._dense is not None:
+            return self._similar_users_numpy(self._rank[str(username)], int(limit))
+        # Sparse matrix-vector product: only users sharing a drink get a dot product
+        dots: Dict[str, int] = {}
+        for did, tv in target.items():
+            for other, ov in self.cols.get(did, {}).items():
+                dots[other] = dots.get(other, 0) + tv * ov
+        dots.pop(str(username), None)
+        norm = self.norms[str(username)]
+        sims = [(other, dot / (norm * self.norms[other])) for other, dot in dots.items() if dot > 0]
+        return heapq.nsmallest(int(limit), sims, key=lambda x: (-x[1], self._rank[x[0]]))
+
+    def _similar_users_numpy(self, r: int, limit: int, idx=None) -> List[Tuple[str, float]]:
+        """NumPy similar_users() over all users, or only the ranks in `idx`."""
+        n, d = len(self._users), len(self._col)
+        dense = self._dense[:n, :d]
+        if idx is None:
+            dots = dense @ dense[r]
+            dots[r] = 0.0
+            idx = np.flatnonzero(dots > 0)
+            dots = dots[idx]
+        else:
+            dots = dense[idx] @ dense[r]
+            keep = dots > 0
+            idx, dots = idx[keep], dots[keep]
+        if not idx.size:
+            return []
+        sims = dots / (self._dense_norms[r] * self._dense_norms[idx])
+        if idx.size > limit:
+            # Keep everything tied with the limit-th best, then cut after the tie-break
+            kth = sims[np.argpartition(-sims, limit - 1)[limit - 1]]
+            keep = sims >= kth
+            idx, sims = idx[keep], sims[keep]
+        best = np.lexsort((idx, -sims))[:limit]
+        return [(self._users[idx[i]], float(sims[i])) for i in best]
+
+    def similar_users_ann(self, username: str, limit: int = 25) -> List[Tuple[str, float]]:
+        """similar_users() over the LSH candidates only (approximate)."""
+        target = self.rows.get(str(username))
+        if not target or limit <= 0 or self._ann is None:
+            return []
+        candidates = self._ann.candidates(str(username))
+        if self._dense is not None:
+            idx = np.fromiter((self._rank[u] for u in candidates), dtype=np.intp, count=len(candidates))
+            return self._similar_users_numpy(self._rank[str(username)], int(limit), idx)
+        norm = self.norms[str(username)]
+        sims = []
+        for other in candidates:
+            vec = self.rows[other]
+            dot = sum(tv * vec.get(did, 0) for did, tv in target.items())
+            if dot > 0:
+                sims.append((other, dot / (norm * self.norms[other])))
+        return heapq.nsmallest(int(limit), sims, key=lambda x: (-x[1], self._rank[x[0]]))
+
+    def build_ann(self, tables: int = RECOMMENDER_ANN_TABLES, bits: int = RECOMMENDER_ANN_BITS, seed: int = 0) -> CosineLSH:
+        """An LSH index over the current rows. Call with `lock` held."""
+        index = CosineLSH(tables, bits, seed)
+        if self._dense is not None:
+            index.fit_dense(self._users, self._dense[:len(self._users), :len(self._col)], list(self._col))
+        else:
+            index.fit(self.rows)
+        return index
+
+
+_MATRIX: UserDrinkMatrix | None = None
+_MATRIX_LOCK = threading.Lock()
+
+
+def get_user_matrix() -> UserDrinkMatrix:
+    """The process-wide matrix, current with the order log."""
+    global _MATRIX
+    if _MATRIX is None:
+        with _MATRIX_LOCK:
+            if _MATRIX is None:
+                matrix = UserDrinkMatrix()
+                add_orders_listener(matrix.on_append)
+                _MATRIX = matrix
+    _MATRIX.refresh()
+    return _MATRIX
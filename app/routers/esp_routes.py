@@ -1,15 +1,37 @@
+import time
 from datetime import datetime, timezone
-from fastapi import APIRouter, HTTPException
+from typing import List
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
-from app.config import ESP_POLL_KEY, ETA_SECONDS_PER_DRINK, ESP_PREP_SECONDS
+from app.config import (
+    ESP_POLL_KEY,
+    ETA_SECONDS_PER_DRINK,
+    ESP_PREP_SECONDS,
+    ESP_LONG_POLL_MAX_SEC,
+    ESP_DEFAULT_DEVICE,
+    ESP_LEASE_SEC,
+    ESP_MAX_BATCH,
+)
 from app.core.storage import (
-    get_active_order_for_esp,
-    complete_and_archive_order,
+    complete_and_dispatch_esp,
+    complete_esp_units,
+    dispatch_esp_units,
+    etag_matches,
+    eta_model_stats,
+    heartbeat_esp_order,
     load_esp_queue,
-    queue_position,
+    online_esp_devices,
+    touch_esp_device,
+    queue_positions,
+    queue_etag,
+    queue_version,
+    wait_for_queue_change,
     _remaining_seconds_for_order,
 )
+from app.core.wire import MSGPACK_MEDIA_TYPE, packb, shorten, wants_msgpack
 
 
 def _parse_iso(ts: str) -> datetime | None:
@@ -27,25 +49,114 @@ def _check_key(key: str):
         raise HTTPException(status_code=401, detail="Invalid key")
 
 
+def _reply(request: Request, payload: dict, headers: dict | None = None) -> Response:
+    """Device response: compact MessagePack if the device asked for it (Accept), else JSON."""
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if wants_msgpack(request.headers.get("accept")):
+        return Response(packb(shorten(payload)), media_type=MSGPACK_MEDIA_TYPE, headers=headers)
+    return JSONResponse(payload, headers=headers)
+
+
 class CompleteBody(BaseModel):
     id: str
 
 
+class CompleteBatchBody(BaseModel):
+    ids: List[str]
+
+
+class HeartbeatBody(BaseModel):
+    id: str
+
+
 @router.get("/api/esp/next")
-def esp_next(key: str):
-    """ESP polls this endpoint for the current job."""
+async def esp_next(request: Request, key: str, wait: int = 0, device: str = ESP_DEFAULT_DEVICE, batch: int = 1, prefetch: int = 0):
+    """ESP polls this endpoint for the current job.
+
+    Each dispenser passes its own `device` id and gets its own job: the unit it
+    is already pouring, else the oldest Pending unit (claimed for it).
+
+    With wait=N (seconds, capped at ESP_LONG_POLL_MAX_SEC) an idle poll is held
+    open until a job is enqueued or N seconds pass, instead of answering
+    "no job" straight away.
+
+    With batch=N (capped at ESP_MAX_BATCH) the device gets up to N consecutive
+    units at once: "order" is the first, as usual, and "jobs" lists all of them
+    (a few fields each) in pouring order.
+
+    With prefetch=1 the unit after those is reserved for the device too and
+    sent as "next"; /api/esp/complete-next then completes the current unit
+    and hands over the next job (with a fresh look-ahead) in the same call.
+
+    The response's ETag is the queue version it was computed at (after this
+    poll's own claims; lease renewals don't move it). A poll with
+    a matching If-None-Match gets 304 (after `wait`, if nothing changed)
+    without the queue being looked at: nothing changed, so there is nothing
+    new to claim.
+
+    Devices sending `Accept: application/x-msgpack` get every ESP response as
+    MessagePack with short field ids (app/core/wire.py); JSON is the default.
+    """
     _check_key(key)
-    order = get_active_order_for_esp()
-    if not order:
-        return {"ok": True, "order": None}
+    deadline = time.monotonic() + max(0, min(int(wait), ESP_LONG_POLL_MAX_SEC))
+    batch = max(1, min(int(batch), ESP_MAX_BATCH))
+    fmt = "mp" if wants_msgpack(request.headers.get("accept")) else "js"
+    scope = f"esp:{device}:{batch}:{int(bool(prefetch))}:{fmt}"
+    # Anything that takes the engine lock (or loads the queue on first use) runs
+    # in the threadpool: only the wait itself stays on the event loop
+    while True:
+        # Read the version BEFORE looking, so an enqueue in between still wakes us
+        since = await run_in_threadpool(queue_version)
+        etag = queue_etag(scope, version=since, ticking=False)
+        remaining = deadline - time.monotonic()
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            if remaining <= 0:
+                await run_in_threadpool(touch_esp_device, device)
+                return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+        else:
+            payload, version = await run_in_threadpool(_next_job, device, batch, bool(prefetch))
+            remaining = deadline - time.monotonic()
+            if payload["order"] is not None or remaining <= 0:
+                # Tag the reply with the version it was computed at: its own claims
+                # moved the version, and the next poll must still match
+                etag = queue_etag(scope, version=version, ticking=False)
+                return _reply(request, payload, {"ETag": etag, "Cache-Control": "no-cache"})
+        await wait_for_queue_change(since, remaining)
+
+
+def _first_item(order: dict) -> dict:
+    items = order.get("items") or []
+    return items[0] if isinstance(items, list) and items and isinstance(items[0], dict) else {}
+
+
+def _job(order: dict) -> dict:
+    """Minimal job entry for "jobs" / "next" (one drink unit)."""
+    first = _first_item(order)
+    return {
+        "id": order.get("id"),
+        "drinkId": first.get("drinkId", ""),
+        "drinkName": first.get("drinkName", ""),
+        "prepSeconds": int(order.get("prepSeconds", ESP_PREP_SECONDS)),
+    }
 
-    # Queue meta (position + ETA)
-    qinfo = queue_position(order.get("id")) or {}
+
+def _next_job(device: str, batch: int = 1, prefetch: bool = False) -> tuple:
+    """(payload, queue version it reflects)."""
+    # Claim + queue meta (position + ETA) in one pass over the queue
+    units, qinfo, version = dispatch_esp_units(device, batch + (1 if prefetch else 0))
+    return _job_payload(units, qinfo, batch, prefetch), version
+
+
+def _job_payload(units: List[dict], qinfo: dict | None, batch: int = 1, prefetch: bool = False) -> dict:
+    if not units:
+        return {"ok": True, "order": None}
+    order = units[0]
+    qinfo = qinfo or {}
 
     # IMPORTANT: keep payload small for ESP8266 memory.
     # Only send the *current* item (first remaining item), not the full items list.
     items = order.get("items") or []
-    first = (items[0] if isinstance(items, list) and items and isinstance(items[0], dict) else {})
+    first = _first_item(order)
     qty = first.get("quantity", 1)
     try:
         qty = int(qty)
@@ -54,6 +165,7 @@ def esp_next(key: str):
 
     compact = {
         "id": order.get("id"),
+        "device": order.get("device"),
         "drinkId": first.get("drinkId", ""),
         "drinkName": first.get("drinkName", ""),
         "quantity": max(1, qty),
@@ -64,56 +176,137 @@ def esp_next(key: str):
         "queueAhead": qinfo.get("ahead"),
         "queueEtaSeconds": qinfo.get("etaSeconds"),
         "stepSeconds": int(ETA_SECONDS_PER_DRINK),
-        "prepSeconds": int(ESP_PREP_SECONDS),
+        "prepSeconds": int(order.get("prepSeconds", ESP_PREP_SECONDS)),
+        # Heartbeat well within this or the unit goes back to Pending
+        "leaseSeconds": int(ESP_LEASE_SEC),
     }
 
-    return {"ok": True, "order": compact}
+    payload = {"ok": True, "order": compact}
+    if batch > 1:
+        # One drink unit per job; ~80 bytes each
+        payload["jobs"] = [_job(u) for u in units[:batch]]
+    if prefetch:
+        # Reserved look-ahead: pour it after prep without polling again
+        payload["next"] = _job(units[batch]) if len(units) > batch else None
+    return payload
+
+
+@router.post("/api/esp/heartbeat")
+def esp_heartbeat(request: Request, body: HeartbeatBody, key: str, device: str = ESP_DEFAULT_DEVICE):
+    """ESP calls this while pouring to keep its claim on the unit.
+
+    ok=False means the lease already expired (the unit was requeued, maybe
+    claimed by another device): stop and ask /api/esp/next for a job.
+    """
+    _check_key(key)
+    order = heartbeat_esp_order(body.id, device)
+    if order is None:
+        return _reply(request, {"ok": False, "error": "Not this device's active order (lease expired?)"})
+    return _reply(request, {"ok": True, "id": order.get("id"), "leaseUntil": order.get("leaseUntil"), "leaseSeconds": int(ESP_LEASE_SEC)})
 
 
 @router.post("/api/esp/complete")
-def esp_complete(body: CompleteBody, key: str):
+def esp_complete(request: Request, body: CompleteBody, key: str, device: str = ESP_DEFAULT_DEVICE):
     """ESP calls this after finishing ONE drink unit.
 
     Guard: prevent instant completion (e.g., old firmware calling complete too early).
     We require that the current unit has been 'In Progress' for at least ETA_SECONDS_PER_DRINK seconds.
+    Only a unit this device is pouring (In Progress, claimed by it) can be
+    completed from it. The checks and the completion happen in one queue
+    transaction.
+    """
+    _check_key(key)
+    refusal, found = complete_esp_units([body.id], device, _complete_guard(device))
+    if refusal is not None:
+        return _reply(request, refusal)
+    if found[0]:
+        return _reply(request, {"ok": True})
+    return _reply(request, {"ok": False, "error": "Order not found"})
+
+
+def _complete_guard(device: str):
+    """Guard for complete_esp_units(): an error payload if `device` may not
+    complete these units (in this order, one drink each) yet, else None.
+    (The queue engine itself refuses units the device isn't pouring.)"""
+
+    def guard(entries: List[dict | None]) -> dict | None:
+        # Enforce minimum elapsed time per unit, counted from the first one's start
+        first = entries[0] if entries else None
+        if first is not None and first.get("status") in ("Pending", "In Progress"):
+            started = _parse_iso(first.get("startedAt") or "")
+            if started is not None:
+                elapsed = (datetime.now(timezone.utc) - started).total_seconds()
+                required = max(5, int(ETA_SECONDS_PER_DRINK)) * len(entries)  # minimum per unit
+                if elapsed < required:
+                    return {"ok": False, "error": "Too early to complete", "waitSeconds": int(required - elapsed)}
+        return None
+
+    return guard
+
+
+@router.post("/api/esp/complete-next")
+def esp_complete_next(request: Request, body: CompleteBody, key: str, device: str = ESP_DEFAULT_DEVICE, prefetch: int = 1):
+    """/api/esp/complete + /api/esp/next in one round trip (and one queue transaction).
+
+    Completes ONE unit (same guards as /api/esp/complete) and answers with the
+    device's next job like /api/esp/next (never held open), including a new
+    reserved "next" look-ahead unless prefetch=0.
     """
     _check_key(key)
+    prefetch = bool(prefetch)
+    refusal, found, units, qinfo = complete_and_dispatch_esp(body.id, device, 1 + prefetch, _complete_guard(device))
+    if refusal is not None:
+        return _reply(request, refusal)
+    if not found:
+        return _reply(request, {"ok": False, "error": "Order not found"})
+    return _reply(request, {**_job_payload(units, qinfo, 1, prefetch), "completed": body.id})
 
-    # Find the order in queue to check timing
-    q = load_esp_queue() or []
-    target = None
-    for o in q:
-        if str(o.get("id")) == str(body.id) and o.get("status") in ("Pending", "In Progress"):
-            target = o
-            break
 
-    # If we found it, enforce minimum elapsed time per unit
-    if target is not None:
-        started = _parse_iso(target.get("startedAt") or "")
-        if started is not None:
-            elapsed = (datetime.now(timezone.utc) - started).total_seconds()
-            required = max(5, int(ETA_SECONDS_PER_DRINK))  # minimum per unit
-            if elapsed < required:
-                return {"ok": False, "error": "Too early to complete", "waitSeconds": int(required - elapsed)}
+@router.post("/api/esp/complete-batch")
+def esp_complete_batch(request: Request, body: CompleteBatchBody, key: str, device: str = ESP_DEFAULT_DEVICE):
+    """ESP calls this once after pouring a batch from /api/esp/next?batch=N.
 
-    ok = complete_and_archive_order(body.id)
-    if ok:
-        return {"ok": True}
-    return {"ok": False, "error": "Order not found"}
+    `ids` lists the units poured, in order (one entry per drink unit). They are
+    completed in a single queue transaction. Same guards as /api/esp/complete:
+    all units must be this device's, and the batch must have taken at least
+    ETA_SECONDS_PER_DRINK per unit since the first one started.
+    """
+    _check_key(key)
+    if not body.ids:
+        return _reply(request, {"ok": True, "completed": [], "notFound": []})
 
+    refusal, found = complete_esp_units(body.ids, device, _complete_guard(device))
+    if refusal is not None:
+        return _reply(request, refusal)
+    done = [oid for oid, ok in zip(body.ids, found) if ok]
+    return _reply(request, {"ok": bool(done), "completed": done, "notFound": [oid for oid, ok in zip(body.ids, found) if not ok]})
 
 
 @router.get("/api/queue/status")
-def queue_status(orderId: str):
-    """Frontend can poll this to show queue position for a given order."""
-    info = queue_position(orderId)
+def queue_status(request: Request, orderId: str):
+    """Frontend can poll this to show queue position for a given order.
+
+    Conditional GET: answers If-None-Match with 304 while the queue is unchanged.
+    """
+    etag = queue_etag()
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    info = queue_positions([orderId]).get(str(orderId))
     if not info:
-        return {"ok": False, "error": "Not in queue (maybe already completed)"}
-    return {"ok": True, "orderId": orderId, **info}
+        payload = {"ok": False, "error": "Not in queue (maybe already completed)"}
+    else:
+        payload = {"ok": True, "orderId": orderId, **info}
+    return JSONResponse(payload, headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 
 @router.get("/api/queue/active")
 def queue_active(limit: int = 20):
     """(Optional) Show active queue for debugging."""
     q = [o for o in load_esp_queue() if o.get("status") in ("Pending", "In Progress")]
-    return {"ok": True, "count": len(q), "queue": q[: max(1, min(int(limit), 100))]}
+    return {
+        "ok": True,
+        "count": len(q),
+        "devices": online_esp_devices(),
+        "etaModel": eta_model_stats(),
+        "queue": q[: max(1, min(int(limit), 100))],
+    }
@@ -1,16 +1,30 @@
 from __future__ import annotations
 
+import json
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
 from uuid import uuid4
 
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from app.config import ETA_SECONDS_PER_DRINK
 
 from app.core.auth import current_user
-from app.core.storage import load_orders, save_orders, enqueue_esp_order, queue_position, load_esp_queue
+from app.core.storage import (
+    append_orders,
+    enqueue_esp_orders,
+    etag_matches,
+    queue_etag,
+    queue_snapshot,
+    queue_version,
+    user_orders_page,
+    wait_for_queue_change,
+)
+
+# Idle SSE connections get a comment line this often (keeps proxies from closing them)
+SSE_KEEPALIVE_SEC = 15
 
 router = APIRouter()
 
@@ -94,24 +108,26 @@ async def checkout(request: Request) -> JSONResponse:
 
     now = datetime.now(timezone.utc).isoformat()
 
-    # ---- Save history rows (SAME file used by recommender) ----
-    orders = load_orders()
-    for it in norm_items:
-        orders.append(
-            {
-                "username": username,
-                "drinkId": it["drinkId"],
-                "drinkName": it["drinkName"],
-                "quantity": it["quantity"],
-                "calories": it["calories"],
-                "ts": now,
-                "mood": mood,
-            }
-        )
-    save_orders(orders)
+    # ---- Append history rows (SAME log used by recommender) ----
+    # Storage writes take locks and run the recommender's checkout listeners:
+    # keep them off the event loop, like everything else that touches the queue
+    await run_in_threadpool(append_orders, [
+        {
+            "username": username,
+            "drinkId": it["drinkId"],
+            "drinkName": it["drinkName"],
+            "quantity": it["quantity"],
+            "calories": it["calories"],
+            "ts": now,
+            "mood": mood,
+        }
+        for it in norm_items
+    ])
 
     # ---- Enqueue ONE queue entry per DRINK UNIT (1-spot machine + per-drink ETA) ----
+    # All units go in with a single queue write.
     order_ids: List[str] = []
+    entries: List[Dict[str, Any]] = []
 
     for it in norm_items:
         qty = int(it.get("quantity", 1))
@@ -131,7 +147,7 @@ async def checkout(request: Request) -> JSONResponse:
             if isinstance(it.get("ratios"), dict):
                 item_one["ratios"] = it["ratios"]
 
-            enqueue_esp_order(
+            entries.append(
                 {
                     "id": oid,
                     "username": username,
@@ -142,9 +158,11 @@ async def checkout(request: Request) -> JSONResponse:
                 }
             )
 
+    positions = await run_in_threadpool(enqueue_esp_orders, entries)
+
     # Provide queue info for the LAST enqueued unit (most recently added)
     order_id = order_ids[-1]
-    pos = queue_position(order_id) or {}
+    pos = (positions[-1] if positions else None) or {}
 
     return JSONResponse(
         {"ok": True, "saved": True, "count": len(norm_items), "queued": True, "orderId": order_id, "orderIds": order_ids, "queue": pos},
@@ -154,20 +172,13 @@ async def checkout(request: Request) -> JSONResponse:
 
 
 
-@router.get("/api/my/queue")
-def api_my_queue(request: Request) -> JSONResponse:
-    """Return ALL active queue entries for the logged-in user with position + ETA."""
-    username = _username_from_session(request)
-    if not username:
-        return JSONResponse({"ok": False, "error": "Not logged in"}, status_code=401)
-
-    q = load_esp_queue() or []
-    active = [o for o in q if o.get("status") in ("Pending", "In Progress") and str(o.get("username")) == username]
-
+def _my_queue_orders(username: str) -> List[Dict[str, Any]]:
+    # One queue read + one prefix-sum pass for all of this user's entries
     results: List[Dict[str, Any]] = []
-    for o in active:
+    for o, info in queue_snapshot():
+        if str(o.get("username")) != username:
+            continue
         oid = str(o.get("id"))
-        info = queue_position(oid) or {}
         results.append(
             {
                 "orderId": oid,
@@ -185,16 +196,82 @@ def api_my_queue(request: Request) -> JSONResponse:
         )
 # Sort by position if available
     results.sort(key=lambda x: int(x.get("position") or 999999))
+    return results
 
-    return JSONResponse({"ok": True, "username": username, "count": len(results), "orders": results}, status_code=200)
+
+@router.get("/api/my/queue")
+def api_my_queue(request: Request) -> JSONResponse:
+    """Return ALL active queue entries for the logged-in user with position + ETA.
+
+    Conditional GET: answers If-None-Match with 304 while the queue is unchanged.
+    """
+    username = _username_from_session(request)
+    if not username:
+        return JSONResponse({"ok": False, "error": "Not logged in"}, status_code=401)
+
+    etag = queue_etag(username)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    results = _my_queue_orders(username)
+    return JSONResponse(
+        {"ok": True, "username": username, "count": len(results), "orders": results},
+        status_code=200,
+        headers={"ETag": etag, "Cache-Control": "no-cache, private"},
+    )
+
+
+@router.get("/api/my/queue/stream")
+async def api_my_queue_stream(request: Request):
+    """Server-Sent Events version of /api/my/queue.
+
+    Sends the same payload once on connect, then again only when the queue
+    changes (enqueue, claim, complete) -- clients count ETAs down locally in
+    between. Idle connections get a keep-alive comment every SSE_KEEPALIVE_SEC.
+    """
+    username = _username_from_session(request)
+    if not username:
+        return JSONResponse({"ok": False, "error": "Not logged in"}, status_code=401)
+
+    async def events():
+        since, last = None, None
+        while not await request.is_disconnected():
+            if since is not None and await wait_for_queue_change(since, SSE_KEEPALIVE_SEC) == since:
+                yield ": keep-alive\n\n"
+                continue
+            # Read the version BEFORE the snapshot, so a change in between is not missed
+            since = await run_in_threadpool(queue_version)
+            results = await run_in_threadpool(_my_queue_orders, username)
+            data = json.dumps({"ok": True, "username": username, "count": len(results), "orders": results})
+            if data != last:
+                last = data
+                yield f"data: {data}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.get("/api/history")
-def api_history(request: Request) -> JSONResponse:
+def api_history(request: Request, limit: Optional[int] = None, before: Optional[int] = None) -> JSONResponse:
+    """This user's history, oldest first.
+
+    Without `limit` every row is returned. With `limit`, only the newest
+    `limit` rows older than cursor `before` are returned; pass `nextBefore`
+    back as `before` to fetch the next (older) page.
+    """
     username = _username_from_session(request)
     if not username:
         return JSONResponse({"ok": False, "error": "Not logged in"}, status_code=401)
 
-    orders = load_orders()
-    mine = [o for o in orders if str(o.get("username")) == username]
-    return JSONResponse({"ok": True, "username": username, "orders": mine})
+    if limit is not None:
+        limit = max(1, min(int(limit), 500))
+    mine, next_before = user_orders_page(username, limit=limit, before=before)
+    return JSONResponse({
+        "ok": True,
+        "username": username,
+        "orders": mine,
+        "nextBefore": next_before,
+        "hasMore": next_before is not None,
+    })
@@ -22,28 +22,17 @@ def pretty_ingredient(ing: str) -> str:
         return ""
     return INGREDIENT_LABELS.get(ing, ing.replace("_"," ").title())
 from collections import Counter
-from pathlib import Path
 from string import Template
 
 from fastapi import APIRouter, Request, Request
 from fastapi.responses import HTMLResponse, RedirectResponse, RedirectResponse
 
 from app.core.auth import current_user
-from app.core.storage import ensure_drinks_file, load_drinks, load_orders
-from app.ml.recommender import recommend_for_user
+from app.core.storage import ensure_drinks_file, load_drinks, iter_user_orders
+from app.ml.recommender import also_ordered, recommend_for_user
 
 router = APIRouter()
 
-# ---- Read the SAME orders.json used by orders_routes.py ----
-REPO_ROOT = Path(__file__).resolve().parents[2]  # app/routers -> app -> repo_root
-DATA_DIR = REPO_ROOT / "data"
-ORDERS_FILE = DATA_DIR / "orders.json"
-
-
-def _load_orders_shared():
-    """Load orders written by /checkout."""
-    return load_orders()
-
 
 STYLE = """
 <style>
@@ -299,12 +288,10 @@ def _require_user(request: Request):
 
 
 def _top_drinks_for_user(username: str, limit: int = 3):
-    # IMPORTANT: use shared orders file (same one /checkout writes)
-    orders = _load_orders_shared()
+    # Reads only this user's rows (per-user history index)
     c = Counter()
-    for o in orders:
-        if str(o.get("username")) == str(username):
-            c[str(o.get("drinkName", ""))] += int(o.get("quantity", 1) or 1)
+    for o in iter_user_orders(username):
+        c[str(o.get("drinkName", ""))] += int(o.get("quantity", 1) or 1)
     return [name for name, _ in c.most_common(limit) if name]
 
 
@@ -550,13 +537,43 @@ function __renderMyQueue(box){
   }).join('');
 }
 
+// -------------------------
+// Live queue (Server-Sent Events)
+// -------------------------
+// One EventSource per page. The server pushes the /api/my/queue payload on
+// connect and whenever the queue changes; ETAs are counted down locally.
+let __queueStream = null;
+let __queueLast = null;
+const __queueListeners = [];
+
+function onMyQueue(fn, replay){
+  __queueListeners.push(fn);
+  if(replay !== false && __queueLast) fn(__queueLast);
+  if(__queueStream || !window.EventSource) return;
+  __queueStream = new EventSource('/api/my/queue/stream');
+  __queueStream.onmessage = (ev) => {
+    let data;
+    try{ data = JSON.parse(ev.data); }catch(e){ return; }
+    __queueLast = data;
+    __queueListeners.forEach(f => { try{ f(data); }catch(e){} });
+  };
+}
+
 async function loadMyQueue(){
+  try{
+    const res = await fetch('/api/my/queue', {credentials:'include'});
+    __applyMyQueue(await res.json());
+  }catch(e){
+    const box = document.getElementById('myQueue');
+    if(box) box.innerHTML = '<div class="small">Could not load queue.</div>';
+  }
+}
+
+function __applyMyQueue(data){
   const box = document.getElementById('myQueue');
   if(!box) return;
 
   try{
-    const res = await fetch('/api/my/queue', {credentials:'include'});
-    const data = await res.json();
     if(!data.ok){
       box.innerHTML = '<div class="small">Queue unavailable.</div>';
       return;
@@ -595,8 +612,13 @@ function __adjSec(s){
 
 function startMyQueueAutoRefresh(){
   if(myQueueTimer) clearInterval(myQueueTimer);
-  loadMyQueue();
-  myQueueTimer = setInterval(loadMyQueue, 10000);
+  if(window.EventSource){
+    onMyQueue(__applyMyQueue);
+  }else{
+    // Very old browser: fall back to polling
+    loadMyQueue();
+    myQueueTimer = setInterval(loadMyQueue, 10000);
+  }
   if(!__localTickTimer){
     __localTickTimer = setInterval(() => {
       if(document.hidden) return;
@@ -606,14 +628,16 @@ function startMyQueueAutoRefresh(){
       try{ setMainEtaFromOrders(__myOrdersSnapshot); }catch(_e){}
     }, 1000);
   }
-  document.addEventListener('visibilitychange', () => {
-    if(document.hidden){
-      if(myQueueTimer) clearInterval(myQueueTimer);
-      myQueueTimer = null;
-    }else{
-      startMyQueueAutoRefresh();
-    }
-  }, {once:true});
+  if(myQueueTimer){
+    document.addEventListener('visibilitychange', () => {
+      if(document.hidden){
+        if(myQueueTimer) clearInterval(myQueueTimer);
+        myQueueTimer = null;
+      }else{
+        startMyQueueAutoRefresh();
+      }
+    }, {once:true});
+  }
 }
 
 
@@ -1054,29 +1078,55 @@ async function checkout(btnEl) {
 window.checkout = checkout;
 
 
+// Status line for the last checkout: one fetch now, then live updates from the queue stream
+let __trackedOrderId = null;
+let __trackingStream = false;
+
 function startQueuePoll(orderId){
   if(pollTimer) clearInterval(pollTimer);
-  pollTimer = setInterval(async ()=>{
-    try{
-      const r = await fetch(`/api/queue/status?orderId=${encodeURIComponent(orderId)}`);
-      const data = await r.json();
-      if(data && data.ok){
-        const eta = (data.etaSeconds!==undefined) ? formatETA(data.etaSeconds) : '...';
-        const etaStart = (data.etaAheadSeconds!==undefined) ? formatETA(data.etaAheadSeconds) : '...';
-        document.getElementById('status').innerText = `Queued! Orders ahead: ${ (typeof data.ahead==='number') ? data.ahead : (typeof data.position==='number' ? Math.max(0, data.position-1) : 0) }`;
-        setEtaFromServer(data.etaSeconds, data.etaAheadSeconds);
-      } else {
-        document.getElementById('status').innerText = `Order completed (or removed from queue). `;
-        clearInterval(pollTimer);
-        localStorage.removeItem('lastOrderId');
-        localStorage.removeItem('lastOrderTs');
-        localStorage.removeItem('etaInitial');
-        localStorage.removeItem('etaRemaining');
-        localStorage.removeItem('etaUpdatedTs');
-        localStorage.removeItem('etaAheadSeconds');
-      }
-    }catch(e){ /* ignore */ }
-  }, 3000);
+  pollTimer = null;
+  __trackedOrderId = orderId;
+  fetch(`/api/queue/status?orderId=${encodeURIComponent(orderId)}`)
+    .then(r => r.json()).then(__showTrackedOrder).catch(()=>{});
+  if(!window.EventSource){
+    pollTimer = setInterval(async ()=>{
+      try{
+        const r = await fetch(`/api/queue/status?orderId=${encodeURIComponent(__trackedOrderId)}`);
+        __showTrackedOrder(await r.json());
+      }catch(e){ /* ignore */ }
+    }, 3000);
+  }else if(!__trackingStream){
+    __trackingStream = true;
+    // Don't replay a snapshot taken before this checkout was enqueued
+    onMyQueue(data => {
+      if(!__trackedOrderId || !data || !data.ok) return;
+      const o = (data.orders || []).find(x => x.orderId === __trackedOrderId);
+      __showTrackedOrder(o ? {ok:true, ...o} : {ok:false});
+    }, false);
+  }
+}
+
+function __showTrackedOrder(data){
+  if(!__trackedOrderId) return;
+  try{
+    if(data && data.ok){
+      const eta = (data.etaSeconds!==undefined) ? formatETA(data.etaSeconds) : '...';
+      const etaStart = (data.etaAheadSeconds!==undefined) ? formatETA(data.etaAheadSeconds) : '...';
+      document.getElementById('status').innerText = `Queued! Orders ahead: ${ (typeof data.ahead==='number') ? data.ahead : (typeof data.position==='number' ? Math.max(0, data.position-1) : 0) }`;
+      setEtaFromServer(data.etaSeconds, data.etaAheadSeconds);
+    } else {
+      document.getElementById('status').innerText = `Order completed (or removed from queue). `;
+      if(pollTimer) clearInterval(pollTimer);
+      pollTimer = null;
+      __trackedOrderId = null;
+      localStorage.removeItem('lastOrderId');
+      localStorage.removeItem('lastOrderTs');
+      localStorage.removeItem('etaInitial');
+      localStorage.removeItem('etaRemaining');
+      localStorage.removeItem('etaUpdatedTs');
+      localStorage.removeItem('etaAheadSeconds');
+    }
+  }catch(e){ /* ignore */ }
 }
 
 (async function init(){
@@ -1251,6 +1301,13 @@ def drink_page(request: Request, drink_id: str):
     else:
         ingredients_block = ""
 
+    also = also_ordered(drink_id, k=4)
+    if also:
+        links = "".join([f"<li><a href='/drink/{x.get('id')}'>{x.get('name', x.get('id'))}</a></li>" for x in also])
+        also_block = f"<div class='ing' style='margin-top:12px'><div class='small'>People also ordered:</div><ul>{links}</ul></div>"
+    else:
+        also_block = ""
+
     tpl = Template(r"""
 <html><head><title>$name</title>$STYLE</head>
 <body><div class='page'>
@@ -1272,6 +1329,7 @@ def drink_page(request: Request, drink_id: str):
         <button class='secondary' onclick="window.location.href='/builder'">Menu</button>
       </div>
       <div id='status' class='small' style='margin-top:10px'></div>
+      $also_block
     </div>
   </div>
 
@@ -1328,6 +1386,7 @@ setQty();
         drink_id=drink_id,
         cal=str(cal),
         ingredients_block=ingredients_block,
+        also_block=also_block,
     ))
 
 
@@ -1368,8 +1427,28 @@ async function loadQueue(){
       el.innerText = "Queue error: " + (data.error || ("HTTP " + res.status));
       return;
     }
+    renderQueue(data);
+  }catch(e){
+    el.innerText = "Queue error: " + e;
+  }
+}
 
-    const orders = data.orders || [];
+// Last pushed snapshot; ETAs count down locally until the next push
+let queueData = null;
+let queueTs = 0;
+
+function renderQueue(data){
+  queueData = data;
+  queueTs = Date.now();
+  drawQueue();
+}
+
+function drawQueue(){
+  const el = document.getElementById('queue');
+  if(!queueData) return;
+  const elapsed = Math.floor((Date.now() - queueTs) / 1000);
+  try{
+    const orders = queueData.orders || [];
     try{ setMainEtaFromOrders(orders); }catch(e){}
     if(orders.length === 0){
       el.innerHTML = "<span class='small'>No active queued orders.</span>";
@@ -1385,7 +1464,7 @@ async function loadQueue(){
 
       const fmt = (s)=>{
         if(s==null) return "--";
-        s = Math.max(0, Math.floor(s));
+        s = Math.max(0, Math.floor(s) - elapsed);
         const m = Math.floor(s/60);
         const r = s%60;
         return m>0 ? `${m}m ${r}s` : `${r}s`;
@@ -1407,10 +1486,16 @@ async function loadQueue(){
   }
 }
 
-async function loadHistory(){
+const HISTORY_PAGE = 50;
+let historyRows = [];
+let historyBefore = null;
+
+async function loadHistory(more){
   const el = document.getElementById('content');
   try{
-    const res = await fetch('/api/history', {credentials:'include'});
+    let url = '/api/history?limit=' + HISTORY_PAGE;
+    if(more && historyBefore != null) url += '&before=' + historyBefore;
+    const res = await fetch(url, {credentials:'include'});
     const ct = res.headers.get("content-type") || "";
     if(!ct.includes("application/json")){
       el.innerText = "History failed (server returned non-JSON). Please login again.";
@@ -1422,15 +1507,17 @@ async function loadHistory(){
       return;
     }
 
-    const orders = data.orders || [];
-    try{ setMainEtaFromOrders(orders); }catch(e){}
-    if(orders.length === 0){
+    // Pages come oldest-first; keep newest-first for display
+    const page = (data.orders || []).slice().reverse();
+    historyRows = more ? historyRows.concat(page) : page;
+    historyBefore = data.hasMore ? data.nextBefore : null;
+    if(historyRows.length === 0){
       el.innerHTML = "<p class='small'>No orders yet.</p>";
       return;
     }
 
     let html = '<table class="table"><tr><th>Drink</th><th>Qty</th><th>Calories</th><th>Time</th></tr>';
-    orders.slice().reverse().forEach(o=>{
+    historyRows.forEach(o=>{
       html += `<tr>
         <td>${o.drinkName || ''}</td>
         <td>${o.quantity || 1}</td>
@@ -1439,14 +1526,26 @@ async function loadHistory(){
       </tr>`;
     });
     html += '</table>';
+    if(historyBefore != null){
+      html += `<div class='btnrow' style='margin-top:10px'><button class='secondary' onclick='loadHistory(true)'>Load more</button></div>`;
+    }
     el.innerHTML = html;
   }catch(e){
     el.innerText = "History error: " + e;
   }
 }
-loadQueue();
+// Live queue: the server pushes an update whenever the queue changes
+if(window.EventSource){
+  const stream = new EventSource('/api/my/queue/stream');
+  stream.onmessage = (ev) => {
+    try{ renderQueue(JSON.parse(ev.data)); }catch(e){}
+  };
+  setInterval(() => { if(!document.hidden) drawQueue(); }, 1000);
+}else{
+  loadQueue();
+  setInterval(loadQueue, 3000);
+}
 loadHistory();
-setInterval(loadQueue, 3000);
 </script>
 
 </div></body></html>
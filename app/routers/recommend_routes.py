@@ -5,7 +5,7 @@ import json
 from pathlib import Path
 
 from app.core.auth import current_user
-from app.core.storage import load_orders
+from app.core.storage import cache_stats, iter_user_orders
 
 # -------------------------
 # Ingredient labels (normalized id -> display)
@@ -38,7 +38,7 @@ def pretty_ingredient(ing: str) -> str:
     if not ing:
         return ""
     return INGREDIENT_LABELS.get(ing, ing.replace("_"," ").title())
-from app.ml.recommender import recommend_for_user, recommend_for_user_and_mood, ALLOWED_MOODS
+from app.ml.recommender import recommend_for_user, recommend_for_user_and_mood, recommendation_cache_stats, ALLOWED_MOODS
 
 router = APIRouter()
 
@@ -46,12 +46,9 @@ router = APIRouter()
 def _last_ordered_order(username: str) -> dict | None:
     """Return the last order row for this user (dict with drinkId/drinkName), or None."""
     try:
-        orders = load_orders()
+        user_orders = list(iter_user_orders(username))
     except Exception:
-        orders = []
-    if not isinstance(orders, list) or not orders:
-        return None
-    user_orders = [o for o in orders if isinstance(o, dict) and o.get("username") == username]
+        user_orders = []
     if not user_orders:
         return None
     user_orders.sort(key=lambda o: str(o.get("ts") or ""))
@@ -109,4 +106,10 @@ def api_recommendations(request: Request, k: int = 3, mood: str | None = None):
     last_order = _last_ordered_order(user)
     based_on = (last_order or {}).get("drinkName") or (last_order or {}).get("drinkId")
     based_on_ingredients = _based_on_ingredients(last_order)
-    return JSONResponse({"ok": True, "username": user, "mood": None, "based_on": based_on, "based_on_ingredients": based_on_ingredients, "recommendations": recs})
\ No newline at end of file
+    return JSONResponse({"ok": True, "username": user, "mood": None, "based_on": based_on, "based_on_ingredients": based_on_ingredients, "recommendations": recs})
+
+
+@router.get("/api/recommendations/cache")
+def api_recommendations_cache():
+    """(Optional) Hit rates of the recommendation result cache and the storage read cache, for debugging."""
+    return {"ok": True, "recommendations": recommendation_cache_stats(), "storage": cache_stats()}
@@ -7,14 +7,38 @@
   Smart Bartender ESP8266 Worker (Single Mixing Slot + 10s Prep Time)
 
   Behavior:
-  - If idle, poll the server every 10 seconds for the next drink job.
+  - If idle, long-poll the server for the next drink job: the request is held
+    open (up to LONG_POLL_SEC) and answers as soon as a customer checks out.
   - When a job is received, make ONE drink, then call /api/esp/complete.
   - After finishing, wait 10 seconds "prep time", then poll again.
-  - If no job is available, stay idle and keep polling every 10 seconds.
+  - If no job is available, poll again right away (the server did the waiting).
+    A server without long-poll support answers immediately; then we fall
+    back to polling every 10 seconds.
 
   Server endpoints (FastAPI):
-  - GET  /api/esp/next?key=ESP_POLL_KEY
-  - POST /api/esp/complete?key=ESP_POLL_KEY   body: {"id": "<orderId>"}
+  - GET  /api/esp/next?key=ESP_POLL_KEY&device=DEVICE_ID&wait=LONG_POLL_SEC
+  - POST /api/esp/complete?key=ESP_POLL_KEY&device=DEVICE_ID   body: {"id": "<orderId>"}
+  - POST /api/esp/heartbeat?key=ESP_POLL_KEY&device=DEVICE_ID  body: {"id": "<orderId>"}
+  - POST /api/esp/complete-next?key=ESP_POLL_KEY&device=DEVICE_ID  body: {"id": "<orderId>"}
+  - POST /api/esp/complete-batch?key=ESP_POLL_KEY&device=DEVICE_ID  body: {"ids": ["<orderId>", ...]}
+
+  With BATCH_SIZE > 1 the sketch asks for up to that many units per poll
+  (&batch=BATCH_SIZE), pours them back to back with prep in between, and
+  reports them all in one /api/esp/complete-batch call.
+
+  With USE_MSGPACK the job answers (next / complete-next) come as MessagePack
+  with short field ids (Accept: application/x-msgpack); JSON otherwise.
+
+  With PREFETCH the server also reserves the following unit for us, and each
+  unit is reported with /api/esp/complete-next, whose answer is already the
+  next job: after prep the sketch pours it without polling.
+
+  While pouring, the sketch heartbeats every leaseSeconds/3 so the server
+  keeps the unit leased to it; if the ESP reboots or drops off WiFi the lease
+  runs out and the unit goes back to the queue.
+
+  Several dispensers can share one queue: each identifies itself with
+  DEVICE_ID (defaults to its chip id) and gets its own job.
 
   Notes:
   - The backend in this repo is designed to advance an order item-by-item
@@ -32,14 +56,33 @@ const char* WIFI_PASS = "YOUR_WIFI_PASSWORD";
 // --------------------
 const char* SERVER_BASE = "https://YOUR-RENDER-APP.onrender.com"; // or http://<your-computer-ip>:8000
 const char* ESP_KEY     = "YOUR_ESP_POLL_KEY";                    // must match server env ESP_POLL_KEY
+String DEVICE_ID = "";                                             // unique per dispenser; empty = "esp-<chip id>"
 
 // --------------------
 // Timing
 // --------------------
 const unsigned long PREP_MS = 10000;   // 10 seconds prep time / idle poll interval
+const int LONG_POLL_SEC = 25;          // server holds an idle /api/esp/next this long
 unsigned long nextAllowedPoll = 0;
 bool busy = false;
 
+// Units per poll (1 = one drink per poll; server caps at ESP_MAX_BATCH)
+const int BATCH_SIZE = 1;
+const int MAX_JOBS = 4;
+
+// Reserve a look-ahead job and use /api/esp/complete-next (single-unit mode)
+const bool PREFETCH = true;
+bool haveJob = false;  // next job already received from complete-next
+
+// ETag of the last "no job" answer: sent back as If-None-Match so an idle
+// poll with nothing new comes back as an empty 304
+String idleEtag = "";
+
+// Ask for job answers as MessagePack with short keys (smaller, faster to parse)
+// instead of JSON. FIELD(json, short) picks the key name for the active format.
+const bool USE_MSGPACK = true;
+#define FIELD(jsonKey, shortKey) (USE_MSGPACK ? (shortKey) : (jsonKey))
+
 // --------------------
 // Current job fields
 // --------------------
@@ -49,9 +92,17 @@ String currentDrinkName = "";
 // timing from server (seconds)
 int stepSeconds = 25;
 int prepSeconds = 10;
+int leaseSeconds = 60;
 
 String currentDrinkId = "";
 
+// Batch received from the last poll (jobCount == 1 without batching)
+int jobCount = 0;
+String jobIds[MAX_JOBS];
+String jobDrinkIds[MAX_JOBS];
+String jobNames[MAX_JOBS];
+int jobPrep[MAX_JOBS];
+
 // --------------------
 // Helpers
 // --------------------
@@ -68,10 +119,14 @@ String urlJoin(const char* base, const char* pathWithQuery) {
   return u;
 }
 
+bool parseJobPayload(const String& payload);
+
 bool pollNextDrink() {
   // Support BOTH HTTPS (Render) and HTTP (local LAN) based on SERVER_BASE
   HTTPClient http;
-  String url = String(SERVER_BASE) + "/api/esp/next?key=" + ESP_KEY;
+  String url = String(SERVER_BASE) + "/api/esp/next?key=" + ESP_KEY + "&device=" + DEVICE_ID + "&wait=" + String(LONG_POLL_SEC);
+  if (BATCH_SIZE > 1) url += "&batch=" + String(BATCH_SIZE);
+  else if (PREFETCH) url += "&prefetch=1";
 
   Serial.print("[ESP] Polling: ");
   Serial.println(url);
@@ -91,21 +146,46 @@ bool pollNextDrink() {
     return false;
   }
 
+  // Long-poll: allow the server to hold the request open
+  http.setTimeout((LONG_POLL_SEC + 10) * 1000);
+
+  const char* headerKeys[] = {"ETag"};
+  http.collectHeaders(headerKeys, 1);
+  if (idleEtag.length() > 0) http.addHeader("If-None-Match", idleEtag);
+  if (USE_MSGPACK) http.addHeader("Accept", "application/x-msgpack");
+
   int code = http.GET();
   String payload = http.getString();
+  String etag = http.header("ETag");
   http.end();
 
+  if (code == 304) {
+    Serial.println("[ESP] No job (not modified). Staying idle.");
+    return false;
+  }
+  idleEtag = "";
+
   if (code != 200) {
     printHttpDebug(code, payload);
     return false;
   }
 
+  bool got = parseJobPayload(payload);
+  if (!got) idleEtag = etag;
+  return got;
+}
+
+// Reads a /api/esp/next (or /api/esp/complete-next) response into the job fields.
+bool parseJobPayload(const String& payload) {
   // The server may return a full order object (including an items[] list),
   // which can exceed 2KB. Use a larger buffer to avoid deserializeJson NoMemory.
+  // (A MessagePack answer is a fraction of that.)
   StaticJsonDocument<8192> doc;
-  DeserializationError err = deserializeJson(doc, payload);
+  DeserializationError err = USE_MSGPACK
+    ? deserializeMsgPack(doc, payload.c_str(), payload.length())
+    : deserializeJson(doc, payload);
   if (err) {
-    Serial.print("[ESP] JSON parse error: ");
+    Serial.print("[ESP] Payload parse error: ");
     Serial.println(err.c_str());
     Serial.println("[ESP] Tip: If you see 'NoMemory', increase JSON buffer size.");
     return false;
@@ -114,22 +194,45 @@ bool pollNextDrink() {
   bool ok = doc["ok"] | false;
   if (!ok) return false;
 
-  if (doc["order"].isNull()) {
+  if (doc[FIELD("order", "o")].isNull()) {
     Serial.println("[ESP] No job. Staying idle.");
     return false;
   }
 
-  JsonObject order = doc["order"].as<JsonObject>();
-  currentOrderId   = String((const char*)order["id"]);
-  currentDrinkId   = String((const char*)order["drinkId"]);
-  currentDrinkName = String((const char*)order["drinkName"]);
+  JsonObject order = doc[FIELD("order", "o")].as<JsonObject>();
+  currentOrderId   = String((const char*)order[FIELD("id", "i")]);
+  currentDrinkId   = String((const char*)order[FIELD("drinkId", "d")]);
+  currentDrinkName = String((const char*)order[FIELD("drinkName", "n")]);
 
   // Optional timing hints from server
-  if (!order["stepSeconds"].isNull()) stepSeconds = int(order["stepSeconds"]);
-  if (!order["prepSeconds"].isNull()) prepSeconds = int(order["prepSeconds"]);
+  if (!order[FIELD("stepSeconds", "s")].isNull()) stepSeconds = int(order[FIELD("stepSeconds", "s")]);
+  if (!order[FIELD("prepSeconds", "pp")].isNull()) prepSeconds = int(order[FIELD("prepSeconds", "pp")]);
+  if (!order[FIELD("leaseSeconds", "l")].isNull()) leaseSeconds = int(order[FIELD("leaseSeconds", "l")]);
   Serial.print("  stepSeconds: "); Serial.println(stepSeconds);
   Serial.print("  prepSeconds: "); Serial.println(prepSeconds);
 
+  // Batch: the units to pour, in order (the first one is "order")
+  jobCount = 0;
+  JsonArray jobs = doc[FIELD("jobs", "j")].as<JsonArray>();
+  if (!jobs.isNull()) {
+    for (JsonObject j : jobs) {
+      if (jobCount >= MAX_JOBS) break;
+      jobIds[jobCount]      = String((const char*)j[FIELD("id", "i")]);
+      jobDrinkIds[jobCount] = String((const char*)j[FIELD("drinkId", "d")]);
+      jobNames[jobCount]    = String((const char*)j[FIELD("drinkName", "n")]);
+      jobPrep[jobCount]     = j[FIELD("prepSeconds", "pp")] | prepSeconds;
+      jobCount++;
+    }
+  }
+  if (jobCount == 0) {
+    jobIds[0] = currentOrderId;
+    jobDrinkIds[0] = currentDrinkId;
+    jobNames[0] = currentDrinkName;
+    jobPrep[0] = prepSeconds;
+    jobCount = 1;
+  }
+
+  Serial.print("[ESP] Jobs received: "); Serial.println(jobCount);
   Serial.println("[ESP] Job received:");
   Serial.print("  Order ID: "); Serial.println(currentOrderId);
   Serial.print("  Drink:    "); Serial.println(currentDrinkName);
@@ -139,7 +242,7 @@ bool pollNextDrink() {
 
 bool completeCurrentJob() {
   HTTPClient http;
-  String url = String(SERVER_BASE) + "/api/esp/complete?key=" + ESP_KEY;
+  String url = String(SERVER_BASE) + "/api/esp/complete?key=" + ESP_KEY + "&device=" + DEVICE_ID;
 
   StaticJsonDocument<256> bodyDoc;
   bodyDoc["id"] = currentOrderId;
@@ -178,6 +281,125 @@ bool completeCurrentJob() {
   return true;
 }
 
+// Completes the current unit and receives the next job in the same request.
+bool completeAndNext() {
+  HTTPClient http;
+  String url = String(SERVER_BASE) + "/api/esp/complete-next?key=" + ESP_KEY + "&device=" + DEVICE_ID;
+
+  StaticJsonDocument<256> bodyDoc;
+  bodyDoc["id"] = currentOrderId;
+  String body;
+  serializeJson(bodyDoc, body);
+
+  Serial.print("[ESP] Completing + next: ");
+  Serial.println(url);
+
+  bool began = false;
+  if (String(SERVER_BASE).startsWith("https://")) {
+    std::unique_ptr<BearSSL::WiFiClientSecure> client(new BearSSL::WiFiClientSecure);
+    client->setInsecure();
+    began = http.begin(*client, url);
+  } else {
+    WiFiClient client;
+    began = http.begin(client, url);
+  }
+
+  if (!began) {
+    Serial.println("[ESP] http.begin failed");
+    return false;
+  }
+  http.addHeader("Content-Type", "application/json");
+  if (USE_MSGPACK) http.addHeader("Accept", "application/x-msgpack");
+
+  int code = http.POST(body);
+  String payload = http.getString();
+  http.end();
+
+  if (code != 200) {
+    printHttpDebug(code, payload);
+    return false;
+  }
+  return parseJobPayload(payload);
+}
+
+bool completeBatch() {
+  HTTPClient http;
+  String url = String(SERVER_BASE) + "/api/esp/complete-batch?key=" + ESP_KEY + "&device=" + DEVICE_ID;
+
+  StaticJsonDocument<512> bodyDoc;
+  JsonArray ids = bodyDoc.createNestedArray("ids");
+  for (int k = 0; k < jobCount; k++) ids.add(jobIds[k]);
+  String body;
+  serializeJson(bodyDoc, body);
+
+  Serial.print("[ESP] Completing batch: ");
+  Serial.println(url);
+
+  bool began = false;
+  if (String(SERVER_BASE).startsWith("https://")) {
+    std::unique_ptr<BearSSL::WiFiClientSecure> client(new BearSSL::WiFiClientSecure);
+    client->setInsecure();
+    began = http.begin(*client, url);
+  } else {
+    WiFiClient client;
+    began = http.begin(client, url);
+  }
+
+  if (!began) {
+    Serial.println("[ESP] http.begin failed");
+    return false;
+  }
+  http.addHeader("Content-Type", "application/json");
+
+  int code = http.POST(body);
+  String payload = http.getString();
+  http.end();
+
+  if (code != 200 || payload.indexOf("\"ok\":true") < 0) {
+    printHttpDebug(code, payload);
+    return false;
+  }
+
+  Serial.println("[ESP] Batch complete acknowledged.");
+  return true;
+}
+
+bool sendHeartbeat() {
+  HTTPClient http;
+  String url = String(SERVER_BASE) + "/api/esp/heartbeat?key=" + ESP_KEY + "&device=" + DEVICE_ID;
+
+  StaticJsonDocument<256> bodyDoc;
+  bodyDoc["id"] = currentOrderId;
+  String body;
+  serializeJson(bodyDoc, body);
+
+  bool began = false;
+  if (String(SERVER_BASE).startsWith("https://")) {
+    std::unique_ptr<BearSSL::WiFiClientSecure> client(new BearSSL::WiFiClientSecure);
+    client->setInsecure();
+    began = http.begin(*client, url);
+  } else {
+    WiFiClient client;
+    began = http.begin(client, url);
+  }
+
+  if (!began) {
+    Serial.println("[ESP] http.begin failed");
+    return false;
+  }
+  http.addHeader("Content-Type", "application/json");
+
+  int code = http.POST(body);
+  String payload = http.getString();
+  http.end();
+
+  if (code != 200 || payload.indexOf("\"ok\":true") < 0) {
+    printHttpDebug(code, payload);
+    return false;
+  }
+  return true;
+}
+
 // --------------------
 // Your pump / mixing logic goes here
 // --------------------
@@ -187,10 +409,20 @@ void makeDrink() {
   Serial.print("[ESP] Making drink: ");
   Serial.println(currentDrinkName);
 
-  // Simulated dispense duration from server hint (minimum 5s)
+  // Simulated dispense duration from server hint (minimum 5s),
+  // heartbeating so the server keeps this unit leased to us
   int s = stepSeconds;
   if (s < 5) s = 5;
-  delay((unsigned long)s * 1000UL);
+  unsigned long hbEvery = (unsigned long)max(5, leaseSeconds / 3) * 1000UL;
+  unsigned long start = millis();
+  unsigned long lastHb = start;
+  while (millis() - start < (unsigned long)s * 1000UL) {
+    delay(200);
+    if (millis() - lastHb >= hbEvery) {
+      if (!sendHeartbeat()) Serial.println("[ESP] Heartbeat rejected (lease lost?)");
+      lastHb = millis();
+    }
+  }
 
 
   Serial.println("[ESP] Done making drink.");
@@ -206,6 +438,12 @@ void setup() {
   Serial.println();
   Serial.println("[ESP] Booting...");
 
+  if (DEVICE_ID.length() == 0) {
+    DEVICE_ID = "esp-" + String(ESP.getChipId(), HEX);
+  }
+  Serial.print("[ESP] Device id: ");
+  Serial.println(DEVICE_ID);
+
   WiFi.mode(WIFI_STA);
   WiFi.begin(WIFI_SSID, WIFI_PASS);
 
@@ -229,22 +467,50 @@ void loop() {
   // Wait until prep / idle interval expires
   if (millis() < nextAllowedPoll) return;
 
-  // Poll for next job
-  bool gotJob = pollNextDrink();
+  // Poll for next job (long-poll: may block up to LONG_POLL_SEC),
+  // unless complete-next already handed it to us
+  unsigned long pollStart = millis();
+  bool gotJob = haveJob || pollNextDrink();
+  haveJob = false;
 
   if (gotJob) {
     busy = true;
 
-    makeDrink();          // physical dispense
-    completeCurrentJob(); // tell backend one drink is finished
+    for (int k = 0; k < jobCount; k++) {
+      currentOrderId   = jobIds[k];
+      currentDrinkId   = jobDrinkIds[k];
+      currentDrinkName = jobNames[k];
+      prepSeconds      = jobPrep[k];
+
+      makeDrink();        // physical dispense
+
+      if (k + 1 < jobCount) {
+        // Prep between units of a batch (heartbeat keeps the batch leased)
+        Serial.print("[ESP] Prep "); Serial.print(prepSeconds); Serial.println("s before next unit...");
+        delay((unsigned long)prepSeconds * 1000UL);
+        sendHeartbeat();
+      }
+    }
+
+    int prepAfter = prepSeconds;  // the reply below may carry the next job's timing
+    if (jobCount > 1) {
+      completeBatch();      // tell backend the whole batch is finished
+    } else if (PREFETCH) {
+      haveJob = completeAndNext(); // finished + next job in one round trip
+    } else {
+      completeCurrentJob(); // tell backend one drink is finished
+    }
 
     busy = false;
 
     // Start 10s prep time before the next drink
-    nextAllowedPoll = millis() + (unsigned long)prepSeconds * 1000UL;
-    Serial.print("[ESP] Prep/cooldown "); Serial.print(prepSeconds); Serial.println("s...");
+    nextAllowedPoll = millis() + (unsigned long)prepAfter * 1000UL;
+    Serial.print("[ESP] Prep/cooldown "); Serial.print(prepAfter); Serial.println("s...");
+  } else if (millis() - pollStart >= (unsigned long)LONG_POLL_SEC * 500UL) {
+    // Server held the request and nothing came in -> poll again right away
+    nextAllowedPoll = millis();
   } else {
-    // No job -> stay idle, poll again in 10 seconds
+    // Answered quickly with no job (error / no long-poll support) -> poll again in 10 seconds
     nextAllowedPoll = millis() + (unsigned long)prepSeconds * 1000UL;
   }
 }
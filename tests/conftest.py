@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+# Before anything imports app.config: importing app.main initializes the data
+# store, and that must not be app/data
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="bartender-tests-"), "session.db")
+
+import pytest  # noqa: E402
+
+from app.core import eta_model, sqlite_backend, storage  # noqa: E402
+
+# Start from an empty database instead of copying app/data's JSON files
+# (the json_import fixture puts it back)
+_IMPORT_JSON = sqlite_backend.SqliteBackend._import_json
+sqlite_backend.SqliteBackend._import_json = lambda self: None
+
+
+# JsonBackend's files, by the storage module constant that names them
+JSON_FILES = {
+    "USERS_FILE": "users.json",
+    "ORDERS_FILE": "orders.json",
+    "ORDERS_LOG_FILE": "orders.jsonl",
+    "DRINKS_FILE": "drinks.json",
+    "ESP_QUEUE_FILE": "esp_queue.json",
+    "ESP_QUEUE_JOURNAL_FILE": "esp_queue.journal.jsonl",
+    "ESP_DONE_FILE": "esp_done.json",
+    "ESP_DONE_DIR": "esp_done",
+}
+
+
+def _install(db, monkeypatch):
+    """Make `db` the app's backend, with a fresh queue engine, read cache and
+    ETA model, and the starter drinks."""
+    monkeypatch.setattr(storage, "_BACKEND", db)
+    monkeypatch.setattr(storage, "_QUEUE", None)
+    monkeypatch.setattr(storage, "_CACHE", storage._SnapshotCache())
+    monkeypatch.setattr(eta_model, "_MODEL", None)
+    storage.ensure_drinks_file()
+    return db
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """A fresh SQLite backend for one test."""
+    return _install(sqlite_backend.SqliteBackend(tmp_path / "test.db"), monkeypatch)
+
+
+@pytest.fixture
+def json_backend(tmp_path, monkeypatch):
+    """A fresh JSON backend for one test, its files in tmp_path/data."""
+    paths = {name: tmp_path / "data" / file for name, file in JSON_FILES.items()}
+    for name, path in paths.items():
+        monkeypatch.setattr(storage, name, path)
+    monkeypatch.setattr(storage.JsonBackend, "_FILES", {
+        "users": paths["USERS_FILE"],
+        "orders": paths["ORDERS_LOG_FILE"],
+        "drinks": paths["DRINKS_FILE"],
+        "esp_queue": paths["ESP_QUEUE_FILE"],
+    })
+    return _install(storage.JsonBackend(), monkeypatch)
+
+
+@pytest.fixture
+def json_import(monkeypatch):
+    """Let SqliteBackend copy the JSON backend's data on first start again."""
+    monkeypatch.setattr(sqlite_backend.SqliteBackend, "_import_json", _IMPORT_JSON)
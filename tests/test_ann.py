@@ -0,0 +1,20 @@
+from app.ml.ann import benchmark, synthetic_matrix
+
+
+def test_lsh_recall_on_synthetic_users():
+    users = 1000
+    result = benchmark(synthetic_matrix(users), configs=((16, 8),), sample=60)
+    assert result["users"] == users
+    [config] = result["configs"]
+    # Finds most of the exact top 25 while ranking only a fraction of the users
+    assert config["recall"] >= 0.6
+    assert config["avgCandidates"] < users / 4
+
+
+def test_entry_point_prints_a_table(capsys):
+    from app.ml.ann import main
+
+    main(["--synthetic", "200", "--sample", "10"])
+    out = capsys.readouterr().out
+    assert out.startswith("200 users, 10 queries, top 25")
+    assert "recall" in out
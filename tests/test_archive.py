@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from app.core import archive
+from app.core.archive import DoneArchive
+
+
+def _row(order_id: str, day: int | None, hour: int = 12) -> dict:
+    row = {"id": order_id, "status": "complete"}
+    if day is not None:
+        row["completedAt"] = datetime(2026, 3, day, hour, tzinfo=timezone.utc).isoformat()
+    return row
+
+
+@pytest.fixture
+def today(monkeypatch):
+    """Set the archive's clock: today(day) makes 2026-03-<day> the current day."""
+    def set_day(day: int):
+        monkeypatch.setattr(archive, "_utc_now", lambda: datetime(2026, 3, day, 23, tzinfo=timezone.utc))
+    set_day(1)
+    return set_day
+
+
+def _ids(rows) -> list:
+    return [o["id"] for o in rows]
+
+
+def test_range_query_opens_only_overlapping_days(tmp_path, today):
+    done = DoneArchive(tmp_path / "done")
+    done.append([_row("a", 1), _row("b", 2), _row("c", 3), _row("x", None)])
+
+    assert _ids(done.iter_range()) == ["a", "b", "c", "x"]
+    assert _ids(done.iter_range("2026-03-02", "2026-03-03")) == ["b"]
+    assert _ids(done.iter_range(start="2026-03-02T12:00:00+00:00")) == ["b", "c"]
+    assert _ids(done.iter_range(end="2026-03-01T12:00:00+00:00")) == []
+
+
+def test_finished_days_are_sealed(tmp_path, today):
+    done = DoneArchive(tmp_path / "done")
+    done.append([_row("a", 1), _row("b", 2)])
+    today(3)
+    done.append([_row("c", 3)])
+
+    segments = done.manifest()["segments"]
+    assert {day: seg["sealed"] for day, seg in segments.items()} == {
+        "2026-03-01": True, "2026-03-02": True, "2026-03-03": False,
+    }
+    assert sorted(p.name for p in (tmp_path / "done").glob("2026-*")) == [
+        "2026-03-01.jsonl.gz", "2026-03-02.jsonl.gz", "2026-03-03.jsonl",
+    ]
+    assert _ids(done.iter_range()) == ["a", "b", "c"]
+
+    # A late row for a sealed day goes to a side segment, never into the .gz
+    done.append([_row("late", 1, hour=13)])
+    assert done.manifest()["segments"]["2026-03-01+1"]["file"] == "2026-03-01.1.jsonl.gz"
+    assert done.manifest()["segments"]["2026-03-01"]["count"] == 1
+    assert _ids(done.iter_range("2026-03-01", "2026-03-02")) == ["a", "late"]
+
+
+def test_sealing_during_a_query_drops_nothing(tmp_path, today):
+    done = DoneArchive(tmp_path / "done")
+    done.append([_row("a", 1), _row("b", 2), _row("c", 2)])
+
+    rows = done.iter_range("2026-03-01", "2026-03-03")
+    first = next(rows)
+    # Both days get sealed (their .jsonl deleted) while the query is halfway
+    today(4)
+    done.append([_row("d", 4)])
+    assert not list((tmp_path / "done").glob("2026-03-0[12].jsonl"))
+
+    assert _ids([first, *rows]) == ["a", "b", "c"]
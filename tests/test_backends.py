@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+from app.core import sqlite_backend, storage
+
+
+def _order(username: str, n: int) -> dict:
+    return {
+        "username": username,
+        "ts": f"2026-01-01T00:00:{n:02d}+00:00",
+        "items": [{"drinkId": "cola_spark", "drinkName": "Cola Spark", "quantity": n}],
+    }
+
+
+def _unit(order_id: str, username: str = "bob") -> dict:
+    return {
+        "id": order_id,
+        "username": username,
+        "status": "Pending",
+        "items": [{"drinkId": "cola_spark", "drinkName": "Cola Spark", "quantity": 1}],
+    }
+
+
+def _reopen(db):
+    """Another backend object over the same files / database, as after a restart."""
+    return sqlite_backend.SqliteBackend(db.path) if db.name == "sqlite" else storage.JsonBackend()
+
+
+@pytest.fixture(params=["json_backend", "backend"])
+def db(request):
+    """Each test runs once per backend: JsonBackend, then SqliteBackend."""
+    return request.getfixturevalue(request.param)
+
+
+def test_append_then_iter_in_log_order(db):
+    rows = [_order("ann" if n % 2 else "bob", n) for n in range(5)]
+    assert storage.append_orders(rows[:2]) == 2
+    assert storage.append_orders(rows[2:]) == 3
+
+    assert list(db.iter_orders()) == rows
+    assert storage.load_orders() == rows
+
+
+def test_user_history_pages(db):
+    rows = [_order("ann" if n % 2 else "bob", n) for n in range(7)]
+    storage.append_orders(rows)
+    bob = [r for r in rows if r["username"] == "bob"]
+
+    page, cursor = storage.user_orders_page("bob", limit=3)
+    assert page == bob[1:]
+    assert cursor is not None
+    page, cursor = storage.user_orders_page("bob", limit=3, before=cursor)
+    assert page == bob[:1]
+    assert cursor is None
+
+    assert list(storage.iter_user_orders("ann")) == [r for r in rows if r["username"] == "ann"]
+    assert storage.user_orders_page("nobody") == ([], None)
+
+
+def test_queue_survives_a_restart(db):
+    for i in range(4):
+        storage.enqueue_esp_order(_unit(f"u{i}"))
+    assert storage.claim_next_Pending_order()["id"] == "u0"
+    assert storage.complete_and_archive_order("u0")
+    storage.enqueue_esp_order(_unit("u4", "ann"))
+
+    reopened = _reopen(db)
+    assert reopened.load_esp_queue() == storage.load_esp_queue()
+    assert [o["id"] for o in reopened.load_esp_queue()] == ["u1", "u2", "u3", "u4"]
+    assert [o["id"] for o in reopened.load_esp_done()] == ["u0"]
+
+
+def test_sqlite_imports_the_json_data(json_backend, tmp_path, request):
+    storage.save_users({"bob": "hash-b", "ann": "hash-a"})
+    rows = [_order("bob", n) for n in range(3)]
+    storage.append_orders(rows)
+    storage.enqueue_esp_order(_unit("u0"))
+    storage.enqueue_esp_order(_unit("u1"))
+    storage.claim_next_Pending_order()
+    storage.complete_and_archive_order("u0")
+    drinks = json_backend.load_drinks()
+    queue = json_backend.load_esp_queue()
+    done = json_backend.load_esp_done()
+    assert [o["id"] for o in queue] == ["u1"] and [o["id"] for o in done] == ["u0"]
+
+    request.getfixturevalue("json_import")
+    imported = sqlite_backend.SqliteBackend(tmp_path / "imported.db")
+
+    assert imported.load_users() == {"bob": "hash-b", "ann": "hash-a"}
+    assert list(imported.iter_orders()) == rows
+    assert imported.read_orders_at(imported.user_order_refs("bob")) == rows
+    assert imported.load_drinks() == drinks
+    assert imported.load_esp_queue() == queue
+    assert imported.load_esp_done() == done
+
+    # Only on first start: a reopened database doesn't import again
+    storage.append_orders([_order("ann", 9)])
+    assert list(sqlite_backend.SqliteBackend(tmp_path / "imported.db").iter_orders()) == rows
+
+
+def test_a_slow_orders_load_does_not_block_other_collections(backend, monkeypatch):
+    storage.append_orders([_order("bob", 1)])
+    loading, release = threading.Event(), threading.Event()
+    iter_orders = backend.iter_orders
+
+    def slow_iter_orders():
+        loading.set()
+        release.wait(5)
+        return iter_orders()
+
+    monkeypatch.setattr(backend, "iter_orders", slow_iter_orders)
+    storage._CACHE.written("orders")
+    reader = threading.Thread(target=storage.load_orders)
+    reader.start()
+    try:
+        assert loading.wait(5)
+        other = threading.Thread(target=lambda: (storage.save_users({"ann": "h"}), storage.load_users(), storage.load_drinks()))
+        other.start()
+        other.join(2)
+        assert not other.is_alive()
+    finally:
+        release.set()
+        reader.join(5)
+    assert storage.load_users() == {"ann": "h"}
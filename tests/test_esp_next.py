@@ -0,0 +1,54 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.config import ESP_POLL_KEY
+from app.core import storage
+from app.main import app
+
+
+def _unit(order_id: str) -> dict:
+    return {
+        "id": order_id,
+        "username": "bob",
+        "status": "Pending",
+        "items": [{"drinkId": "cola", "drinkName": "Cola", "quantity": 1}],
+    }
+
+
+@pytest.fixture
+def client(backend):
+    return TestClient(app)
+
+
+def _next(client, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get(f"/api/esp/next?key={ESP_POLL_KEY}&device=A", headers=headers)
+
+
+def test_busy_device_repeat_poll_is_not_modified(client):
+    storage.enqueue_esp_orders([_unit("u0"), _unit("u1")])
+    first = _next(client)
+    assert first.status_code == 200
+    assert first.json()["order"]["id"] == "u0"
+
+    # Polling again and heartbeats renew the lease but change nothing else
+    lease = storage.get_queue_engine().get("u0")["leaseUntil"]
+    time.sleep(0.01)
+    again = _next(client, first.headers["etag"])
+    assert again.status_code == 304
+    assert again.headers["etag"] == first.headers["etag"]
+    assert storage.get_queue_engine().get("u0")["leaseUntil"] > lease
+    hb = client.post(f"/api/esp/heartbeat?key={ESP_POLL_KEY}&device=A", json={"id": "u0"})
+    assert hb.json()["ok"] is True
+    assert _next(client, first.headers["etag"]).status_code == 304
+
+
+def test_queue_change_invalidates_poll_etag(client):
+    storage.enqueue_esp_orders([_unit("u0")])
+    first = _next(client)
+    storage.enqueue_esp_orders([_unit("u1")])
+    again = _next(client, first.headers["etag"])
+    assert again.status_code == 200
+    assert again.headers["etag"] != first.headers["etag"]
@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+import pytest
+
+from app.core import storage
+from app.core.eta_model import get_eta_model, unit_seconds_of
+
+
+def _unit(order_id: str, drink_id: str = "cola_spark") -> dict:
+    return {
+        "id": order_id,
+        "username": "bob",
+        "status": "Pending",
+        "prepSeconds": 10,
+        "items": [{"drinkId": drink_id, "drinkName": drink_id, "quantity": 1}],
+    }
+
+
+def _started_ago(order_id: str, seconds: float):
+    """Pretend the unit started pouring `seconds` ago."""
+    engine = storage.get_queue_engine()
+    o = engine._by_slot[engine._slot_of[order_id]]
+    o["startedAt"] = (storage._utc_now() - timedelta(seconds=seconds)).isoformat()
+
+
+def _learned(drink_id: str) -> tuple:
+    st = get_eta_model().stats()[drink_id]
+    return st["seconds"], st["samples"]
+
+
+def test_single_completion_learns_its_duration(backend):
+    storage.enqueue_esp_orders([_unit("u0")])
+    storage.dispatch_esp_units("A", 1)
+    _started_ago("u0", 5)
+    assert storage.complete_esp_units(["u0"], "A") == (None, [True])
+
+    [done] = storage.load_esp_done()
+    assert unit_seconds_of(done["unitTimes"][0]) == pytest.approx(5, abs=0.5)
+    assert _learned("cola_spark") == (pytest.approx(5, abs=0.5), 1)
+
+
+def test_batch_completion_splits_the_elapsed_time(backend):
+    storage.enqueue_esp_orders([_unit("u0"), _unit("u1")])
+    units, _, _ = storage.dispatch_esp_units("A", 2)
+    assert [u["id"] for u in units] == ["u0", "u1"]
+    # Two 5 s pours with 10 s of prep in between, completed in one call
+    _started_ago("u0", 20)
+    assert storage.complete_esp_units(["u0", "u1"], "A") == (None, [True, True])
+
+    recs = {d["id"]: d["unitTimes"][0] for d in storage.load_esp_done()}
+    assert [unit_seconds_of(recs[u]) for u in ("u0", "u1")] == [pytest.approx(5, abs=0.5)] * 2
+    assert recs["u1"]["startedAt"] > recs["u0"]["completedAt"]
+    assert recs["u0"]["batchOf"] == 2
+    assert _learned("cola_spark") == (pytest.approx(5, abs=0.5), 2)
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+
+import pytest
+
+from app.core import storage
+from app.core.queue_engine import QueueEngine
+
+
+def _unit(order_id: str, username: str = "bob") -> dict:
+    return {
+        "id": order_id,
+        "username": username,
+        "status": "Pending",
+        "items": [{"drinkId": "cola_spark", "drinkName": "Cola Spark", "quantity": 1}],
+    }
+
+
+def _state(entries) -> list:
+    """Entries without their lease deadline (renewed on every load)."""
+    return [{k: v for k, v in o.items() if k != "leaseUntil"} for o in entries]
+
+
+def _snapshot() -> list:
+    return json.loads(storage.ESP_QUEUE_FILE.read_text(encoding="utf-8"))
+
+
+def _hand_edit(entries: list):
+    """Rewrite esp_queue.json the way a person would (and make sure the
+    engine sees a new file stamp)."""
+    path = storage.ESP_QUEUE_FILE
+    before = path.stat().st_mtime_ns
+    path.write_text(json.dumps(entries, indent=4), encoding="utf-8")
+    os.utime(path, ns=(before + 10**9, before + 10**9))
+
+
+@pytest.fixture
+def engine(json_backend):
+    engine = storage.get_queue_engine()
+    storage.enqueue_esp_orders([_unit(f"u{i}") for i in range(4)])
+    engine.compact_if_idle(idle_seconds=0)
+    assert _state(_snapshot()) == _state(engine.entries())
+    return engine
+
+
+def test_snapshot_plus_journal_reloads_the_same_queue(engine):
+    storage.dispatch_esp_units("A", 2)
+    storage.complete_esp_units(["u0"], "A")
+    storage.enqueue_esp_orders([_unit("u4", "ann")])
+    assert storage.ESP_QUEUE_JOURNAL_FILE.exists()
+
+    reloaded = QueueEngine(storage.get_backend())
+    assert _state(reloaded.entries()) == _state(engine.entries())
+    assert [o["id"] for o in reloaded.entries()] == ["u1", "u2", "u3", "u4"]
+    # Loading compacts: the snapshot alone is the whole queue again
+    assert not storage.ESP_QUEUE_JOURNAL_FILE.exists()
+    assert _state(_snapshot()) == _state(engine.entries())
+
+
+def test_hand_edit_keeps_changes_journaled_since_the_snapshot(engine):
+    edited = _snapshot()
+    # Meanwhile (journaled, not compacted): u0 claimed, u1 completed, u4 enqueued
+    storage.dispatch_esp_units("A", 1)
+    storage.complete_esp_units(["u0"], "A")
+    storage.dispatch_esp_units("A", 1)
+    storage.enqueue_esp_orders([_unit("u4")])
+
+    # The edit (made from the older snapshot) removes u2 and adds a unit
+    _hand_edit([o for o in edited if o["id"] != "u2"] + [_unit("h1", "ann")])
+
+    entries = {o["id"]: o for o in engine.entries()}
+    assert list(entries) == ["u1", "u3", "h1", "u4"]
+    assert entries["u1"]["status"] == "In Progress" and entries["u1"]["device"] == "A"
+    assert entries["h1"]["username"] == "ann"
+    assert not storage.ESP_QUEUE_JOURNAL_FILE.exists()
+    assert [o["id"] for o in _snapshot()] == list(entries)
+    assert storage.queue_position("h1")["position"] == 3
+
+
+def test_hand_edit_wins_a_conflict_and_logs_it(engine, caplog):
+    edited = _snapshot()
+    storage.dispatch_esp_units("A", 1)  # claims u0 after the snapshot
+    edited[0]["items"][0]["quantity"] = 2
+
+    with caplog.at_level(logging.WARNING, logger="app.core.queue_engine"):
+        _hand_edit(edited)
+        entries = engine.entries()
+
+    assert entries[0]["status"] == "Pending"
+    assert entries[0]["items"][0]["quantity"] == 2
+    assert "u0" in caplog.text
+
+
+def test_only_the_pouring_device_completes_a_unit(engine):
+    storage.dispatch_esp_units("A", 1)  # A pours u0
+
+    assert storage.complete_esp_units(["u0"], "B") == ({"ok": False, "error": "Order is claimed by another device"}, [])
+    assert not storage.complete_and_archive_order("u0", "B")
+    # Nobody is pouring u1 yet, so the batch is refused as a whole
+    assert storage.complete_esp_units(["u0", "u1"], "A") == ({"ok": False, "error": "Order is not in progress"}, [])
+    assert not storage.complete_and_archive_order("u1", "A")
+    assert [(o["id"], o["status"]) for o in engine.entries()][:2] == [("u0", "In Progress"), ("u1", "Pending")]
+
+    assert storage.complete_and_archive_order("u0", "A")
+    # Without a device (not an ESP call) nothing is checked
+    assert storage.complete_and_archive_order("u1")
+    assert [o["id"] for o in engine.entries()] == ["u2", "u3"]
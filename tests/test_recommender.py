@@ -0,0 +1,40 @@
+import copy
+
+import pytest
+
+from app.core import storage
+from app.ml import recommender
+
+
+@pytest.fixture
+def results(backend, monkeypatch):
+    """An empty result cache, so hits come from this test only."""
+    cache = recommender._ResultCache(size=16, ttl=0)
+    monkeypatch.setattr(recommender, "_RESULTS", cache)
+    drinks = ["amber_storm", "cola_spark", "sunset_fizz", "dark_amber"]
+    storage.append_orders([
+        {"username": f"u{i % 5}", "drinkId": did, "quantity": 1}
+        for i, did in enumerate(drinks * 5)
+    ])
+    return cache
+
+
+@pytest.mark.parametrize("recommend", [
+    lambda: recommender.recommend_for_user("u1", 3),
+    lambda: recommender.recommend_for_user_and_mood("u1", "sweet", 3),
+])
+def test_cached_results_are_read_only(results, recommend):
+    first = recommend()
+    want = copy.deepcopy(first)
+    assert first
+
+    # Shared with the next caller, so nobody gets to change it in place
+    with pytest.raises(TypeError):
+        first.clear()
+    with pytest.raises(TypeError):
+        first[0]["name"] = "edited"
+    mine = copy.deepcopy(first)
+    mine[0]["name"] = "edited"
+
+    assert recommend() == want
+    assert results.hits == 1
@@ -0,0 +1,106 @@
+import pytest
+
+from app.core import storage
+from app.core.scheduler import BatchPolicy, FairPolicy, FifoPolicy, get_policy
+
+
+def _unit(order_id: str, username: str = "bob", drink_id: str = "cola_spark") -> dict:
+    return {
+        "id": order_id,
+        "username": username,
+        "status": "Pending",
+        "items": [{"drinkId": drink_id, "drinkName": drink_id, "quantity": 1}],
+    }
+
+
+def _use(policy):
+    engine = storage.get_queue_engine()
+    engine.policy = policy
+    engine._plan_cache = None
+    return engine
+
+
+def _planned() -> list:
+    """Pending ids in the order positions/ETAs assume."""
+    rows = [(info["position"], o["id"]) for o, info in storage.queue_snapshot() if o["status"] == "Pending"]
+    return [oid for _, oid in sorted(rows)]
+
+
+def _claim(device: str, done: str | None = None) -> str:
+    if done is not None:
+        assert storage.complete_and_archive_order(done, device)
+    return storage.get_active_order_for_esp(device)["id"]
+
+
+def _pour_all(device: str = "A") -> list:
+    """Claim units one at a time on one dispenser, completing each before the next."""
+    got = [_claim(device)]
+    while any(o["status"] == "Pending" for o in storage.load_esp_queue()):
+        got.append(_claim(device, got[-1]))
+    return got
+
+
+def test_batch_pours_the_same_recipe_back_to_back(backend):
+    _use(BatchPolicy(window=4))
+    storage.enqueue_esp_orders([
+        _unit("a0"), _unit("x0", drink_id="crystal_chill"), _unit("a1"),
+        _unit("x1", drink_id="crystal_chill"), _unit("a2"),
+    ])
+    planned = _planned()
+
+    got = _pour_all()
+    assert got == ["a0", "a1", "a2", "x0", "x1"]
+    assert planned == got
+
+
+def test_batch_falls_back_to_the_same_ingredients(backend):
+    _use(BatchPolicy(window=4))
+    # dark_amber is a different recipe with amber_storm's ingredients
+    storage.enqueue_esp_orders([
+        _unit("s0", drink_id="amber_storm"), _unit("c0"), _unit("d0", drink_id="dark_amber"),
+    ])
+
+    assert _pour_all() == ["s0", "d0", "c0"]
+
+
+def test_batch_stops_passing_over_a_unit_after_window_times(backend):
+    _use(BatchPolicy(window=2))
+    storage.enqueue_esp_orders([_unit("a0"), _unit("x0", drink_id="crystal_chill")] + [_unit(f"a{i}") for i in range(1, 4)])
+    planned = _planned()
+
+    got = [_claim("A"), _claim("A", "a0")]
+    got.append(_claim("A", got[-1]))
+    # x0 was passed over for a1 and a2: it can't be passed a third time
+    assert storage.get_queue_entry("x0")["bypassed"] == 2
+    got.append(_claim("A", got[-1]))
+    assert got == ["a0", "a1", "a2", "x0"]
+    got.append(_claim("A", got[-1]))
+    assert got[-1] == "a3"
+    assert planned == got
+
+
+def test_batch_keeps_arrival_order_when_nothing_matches(backend):
+    _use(BatchPolicy(window=4))
+    drinks = ["cola_spark", "crystal_chill", "voltage_fizz", "energy_sunrise"]
+    storage.enqueue_esp_orders([_unit(f"u{i}", drink_id=d) for i, d in enumerate(drinks)])
+
+    assert _pour_all() == ["u0", "u1", "u2", "u3"]
+    assert isinstance(get_policy("no-such-policy"), FifoPolicy)
+
+
+def test_fair_plan_follows_the_per_user_cap(backend):
+    _use(FairPolicy({"bob": 4.0}, max_inflight=1))
+    storage.enqueue_esp_orders([_unit(f"b{i}") for i in range(3)] + [_unit(f"c{i}", "cid") for i in range(2)])
+    for device in ("A", "B"):
+        storage.touch_esp_device(device)
+    planned = _planned()
+
+    # Two dispensers, each completing its unit and claiming the next in turn
+    got = [_claim("A"), _claim("B")]
+    got.append(_claim("A", got[0]))
+    got.append(_claim("B", got[1]))
+    got.append(_claim("A", got[2]))
+
+    # bob's b2 would be his second unit pouring at once, so c1 goes first
+    assert got == ["b0", "c0", "b1", "c1", "b2"]
+    assert planned == got
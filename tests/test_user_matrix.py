@@ -0,0 +1,48 @@
+import pytest
+
+from app.ml.user_matrix import UserDrinkMatrix
+
+pytest.importorskip("numpy")
+
+
+def _rows():
+    """Duplicated users (ties), a user nobody shares a drink with (zero
+    similarity everywhere) and users overlapping only partly."""
+    history = {
+        "ann": {"cola": 2, "gin": 1},
+        "bob": {"cola": 2, "gin": 1},   # same vector as ann
+        "cid": {"cola": 4, "gin": 2},   # same direction as ann
+        "dee": {"cola": 1},
+        "eve": {"gin": 1},
+        "fay": {"absinthe": 3},         # shares nothing
+        "gus": {"cola": 1, "rum": 1},
+        "hal": {"rum": 1, "gin": 1},
+        "ivy": {"cola": 1, "gin": 2},
+    }
+    return [
+        {"username": user, "drinkId": did, "quantity": qty}
+        for user, vec in history.items()
+        for did, qty in vec.items()
+    ]
+
+
+def _matrix(use_numpy: bool) -> UserDrinkMatrix:
+    matrix = UserDrinkMatrix(use_numpy=use_numpy, ann_min_users=0)
+    matrix.fit(_rows())
+    assert matrix.engine == ("numpy" if use_numpy else "python")
+    return matrix
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 25])
+def test_numpy_and_python_rank_the_same(limit):
+    fast, slow = _matrix(True), _matrix(False)
+    for user in list(slow.rows) + ["nobody"]:
+        got, want = fast.similar_users(user, limit), slow.similar_users(user, limit)
+        assert [u for u, _ in got] == [u for u, _ in want], user
+        assert [s for _, s in got] == pytest.approx([s for _, s in want]), user
+
+
+def test_zero_similarity_users_are_left_out():
+    for matrix in (_matrix(True), _matrix(False)):
+        assert matrix.similar_users("fay") == []
+        assert all(u != "fay" for u, _ in matrix.similar_users("ann"))
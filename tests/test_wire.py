@@ -0,0 +1,80 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.config import ESP_POLL_KEY
+from app.core.wire import packb, shorten, wants_msgpack
+from app.main import app
+
+
+@pytest.mark.parametrize("value, packed", [
+    (None, "c0"),
+    (False, "c2"),
+    (True, "c3"),
+    # positive fixint / uint 8, 16, 32, 64
+    (0, "00"),
+    (127, "7f"),
+    (128, "cc80"),
+    (255, "ccff"),
+    (256, "cd0100"),
+    (65535, "cdffff"),
+    (65536, "ce00010000"),
+    (2**32 - 1, "ceffffffff"),
+    (2**32, "cf0000000100000000"),
+    # negative fixint / int 8, 16, 32, 64
+    (-1, "ff"),
+    (-32, "e0"),
+    (-33, "d0df"),
+    (-128, "d080"),
+    (-129, "d1ff7f"),
+    (-32768, "d18000"),
+    (-32769, "d2ffff7fff"),
+    (-(2**31) - 1, "d3ffffffff7fffffff"),
+    (1.5, "cb3ff8000000000000"),
+    # fixstr / str 8 / str 16 (length in UTF-8 bytes)
+    ("", "a0"),
+    ("hé", "a368c3a9"),
+    ("x" * 31, "bf" + "78" * 31),
+    ("x" * 32, "d920" + "78" * 32),
+    ("x" * 256, "da0100" + "78" * 256),
+    (b"ab", "c4026162"),
+    # fixarray / array 16, fixmap / map 16
+    ([], "90"),
+    ([1, None], "9201c0"),
+    ([0] * 16, "dc0010" + "00" * 16),
+    ({}, "80"),
+    ({"a": 1}, "81a16101"),
+    ({f"k{i:02d}": i for i in range(16)}, "de0010" + "".join(f"a36b{ord(str(i // 10)):02x}{ord(str(i % 10)):02x}{i:02x}" for i in range(16))),
+])
+def test_packb_byte_vectors(value, packed):
+    assert packb(value).hex() == packed
+
+
+def test_packb_nested_payload():
+    payload = shorten({"ok": True, "order": {"id": "u0", "queuePosition": 1, "etaSeconds": 300}})
+    assert payload == {"ok": True, "o": {"i": "u0", "p": 1, "e": 300}}
+    assert packb(payload) == bytes.fromhex("82 a26f6b c3 a16f 83 a169 a27530 a170 01 a165 cd012c")
+
+
+@pytest.mark.parametrize("accept, wanted", [
+    (None, False),
+    ("application/json", False),
+    ("application/x-msgpack", True),
+    ("application/msgpack", True),
+    ("text/html, Application/MsgPack;q=0.9", True),
+])
+def test_wants_msgpack(accept, wanted):
+    assert wants_msgpack(accept) is wanted
+
+
+@pytest.mark.parametrize("accept", ["application/msgpack", "application/x-msgpack"])
+def test_esp_reply_negotiates_msgpack(backend, accept):
+    client = TestClient(app)
+    r = client.get(f"/api/esp/next?key={ESP_POLL_KEY}&device=A", headers={"Accept": accept})
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/x-msgpack"
+    assert r.headers["vary"] == "Accept"
+    assert r.content == packb({"ok": True, "o": None}) == bytes.fromhex("82a26f6bc3a16fc0")
+
+    r = client.get(f"/api/esp/next?key={ESP_POLL_KEY}&device=A")
+    assert r.headers["content-type"] == "application/json"
+    assert r.json() == {"ok": True, "order": None}